@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow', 'tools'))
+import bam_reheader
+import synthetic_data
+
+"""
+CPU time against disk traffic of the BGZF levels for the intermediate BAMs (see
+workflow/tools/intermediate_codec.py):
+- the BAM records (of --bam, or of a synthetic lane BAM) are compressed at each level with
+  zlib, the deflate the JDK deflater of Picard uses, and decompressed again, the CPU seconds
+  and the size per GB of uncompressed BAM are measured
+- for each node type, given by the bandwidth of its scratch disk, the seconds for one GB of
+  records to be written and read back once, as an intermediate BAM is, are derived: with
+  asynchronous I/O the disk transfers overlap the compression, the slower of the two counts,
+  without it both add up
+- synthetic reads are random, they compress less than real ones, use --bam with a lane BAM
+  of the kind of data the nodes get for numbers to decide on
+"""
+
+DEFAULT_NODES = ['hdd=150', 'ssd=500', 'nvme=2000']
+GB = 1e9
+
+
+def bam_records(path):
+    """ The uncompressed BAM stream of 'path' """
+    data = bytearray()
+    with open(path, 'rb') as f:
+        while True:
+            _, block = bam_reheader.read_block(f)
+            if not block:
+                break
+            data += block
+    return bytes(data)
+
+
+def measure(raw, level):
+    out = io.BytesIO()
+    start = time.process_time()
+    bam_reheader.write_blocks(out, raw, level)
+    write_cpu = time.process_time() - start
+
+    out.seek(0)
+    start = time.process_time()
+    while bam_reheader.read_block(out)[1]:
+        pass
+    read_cpu = time.process_time() - start
+    return {
+        'level': level,
+        'size_ratio': round(len(out.getvalue()) / len(raw), 4),
+        'write_cpu_s_per_gb': round(write_cpu * GB / len(raw), 2),
+        'read_cpu_s_per_gb': round(read_cpu * GB / len(raw), 2)
+    }
+
+
+def node_seconds(result, mbps):
+    """ Seconds to write and read back one GB of records on a disk of 'mbps' MB/s """
+    disk = result['size_ratio'] * GB / (mbps * 1e6)
+    return {
+        'async_s_per_gb': round(max(result['write_cpu_s_per_gb'], disk) + max(result['read_cpu_s_per_gb'], disk), 2),
+        'sync_s_per_gb': round(result['write_cpu_s_per_gb'] + result['read_cpu_s_per_gb'] + 2 * disk, 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU time and disk traffic of BGZF levels for intermediate BAMs')
+    parser.add_argument('--bam', help='BAM to take the records from, a synthetic lane BAM by default')
+    parser.add_argument('--reads', type=int, default=100000, help='read pairs of the synthetic lane BAM')
+    parser.add_argument('--read-length', dest='read_length', type=int, default=150)
+    parser.add_argument('--levels', type=int, nargs='+', default=[0, 1, 5, 6])
+    parser.add_argument('--node', dest='nodes', action='append', metavar='NAME=MBPS',
+                        help='node type and the bandwidth of its scratch disk in MB/s, default %s' % ' '.join(DEFAULT_NODES))
+    parser.add_argument('--output', help='write the report as JSON')
+    args = parser.parse_args()
+
+    work_dir = None
+    bam = args.bam
+    if not bam:
+        work_dir = tempfile.mkdtemp(prefix='codec_bench_')
+        bam = synthetic_data.write_bam(os.path.join(work_dir, 'lane.bam'), ['lane1'], args.reads, args.read_length)
+    try:
+        raw = bam_records(bam)
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    nodes = [n.split('=', 1) for n in args.nodes or DEFAULT_NODES]
+    results = []
+    for level in args.levels:
+        result = measure(raw, level)
+        result['nodes'] = dict([(name, node_seconds(result, float(mbps))) for name, mbps in nodes])
+        results.append(result)
+
+    print('%s MB of BAM records from %s' % (round(len(raw) / 1e6, 1), args.bam or 'a synthetic lane BAM'))
+    print('%-6s %8s %10s %10s' % ('level', 'size', 'write s/GB', 'read s/GB') +
+          ''.join([' %18s' % ('%s async/sync' % name) for name, _ in nodes]))
+    for r in results:
+        print('%-6s %8s %10s %10s' % (r['level'], r['size_ratio'], r['write_cpu_s_per_gb'], r['read_cpu_s_per_gb']) +
+              ''.join([' %18s' % ('%s/%s' % (r['nodes'][name]['async_s_per_gb'], r['nodes'][name]['sync_s_per_gb']))
+                       for name, _ in nodes]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps({'bam': args.bam, 'bytes': len(raw), 'nodes': dict(nodes), 'levels': results}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow', 'tools'))
+import bam_reheader
+import fused_revert
+from synthetic_data import random_read, write_bam
+
+"""
+Throughput of the fused revert (workflow/tools/fused_revert.py) against the RevertSam it
+replaces:
+- the routing of the SAM records by read group, done by one Python thread, is timed on
+  synthetic SAM text, in MB/s and records/s. The fused path can not run faster than this,
+  whatever the number of cores
+- with a picard.jar, both paths are run on a BAM (--bam, or a synthetic one): the fused
+  revert, and RevertSam by read group as revert_bam.py runs it, whose read group replacement
+  and comments are header rewrites (bam_reheader.py) that take no time next to it
+"""
+
+
+def sam_text(read_groups, records, read_length, seed=1):
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(records):
+        seq, qual = random_read(rnd, read_length)
+        lines.append(('read%08d\t77\t*\t0\t0\t*\t*\t0\t0\t%s\t%s\tRG:Z:%s\n' %
+                      (i, seq, qual, read_groups[i % len(read_groups)])).encode())
+    return b''.join(lines)
+
+
+def time_routing(text, read_groups):
+    sinks = dict([(rg.encode(), io.BytesIO()) for rg in read_groups])
+    new_ids = dict([(rg.encode(), ('\tRG:Z:%s.new' % rg).encode()) for rg in read_groups])
+    reader = io.BytesIO(text)
+    start = time.process_time()
+    fused_revert.route(reader, reader.readline(), sinks, new_ids)
+    return time.process_time() - start
+
+
+def revert_args(bam):
+    return ['I=%s' % bam, 'SANITIZE=true', 'SORT_ORDER=queryname', 'RESTORE_ORIGINAL_QUALITIES=true',
+            'REMOVE_DUPLICATE_INFORMATION=true', 'REMOVE_ALIGNMENT_INFORMATION=true', 'VALIDATION_STRINGENCY=LENIENT']
+
+
+def bam_read_groups(bam):
+    with open(bam, 'rb') as f:
+        header = bam_reheader.read_header(f)[0]
+    return [dict([f.split(':', 1) for f in l.split('\t')[1:]])['ID'] for l in header.splitlines() if l.startswith('@RG\t')]
+
+
+def compare(picard_jar, bam, work_dir):
+    read_groups = bam_read_groups(bam)
+    out_dir = os.path.join(work_dir, 'picard')
+    os.makedirs(out_dir)
+    start = time.time()
+    subprocess.run(['java', '-jar', picard_jar, 'RevertSam'] + revert_args(bam) +
+                   ['OUTPUT_BY_READGROUP=true', 'O=%s' % out_dir], check=True)
+    picard_s = time.time() - start
+
+    out_dir = os.path.join(work_dir, 'fused')
+    os.makedirs(out_dir)
+    rg_replace = dict([(rg, {'ID': rg, 'SM': 'bench', 'LB': 'lib', 'PL': 'ILLUMINA'}) for rg in read_groups])
+    outputs = dict([(rg, os.path.join(out_dir, '%s.lane.bam' % rg)) for rg in read_groups])
+    start = time.time()
+    error = fused_revert.run(picard_jar, revert_args(bam), rg_replace, ['bench'], outputs)
+    if error:
+        sys.exit('fused revert failed: %s' % error)
+    return picard_s, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the fused revert against RevertSam')
+    parser.add_argument('--records', type=int, default=200000, help='SAM records for the routing')
+    parser.add_argument('--read-groups', dest='read_groups', type=int, default=4)
+    parser.add_argument('--read-length', dest='read_length', type=int, default=150)
+    parser.add_argument('--picard-jar', dest='picard_jar')
+    parser.add_argument('--bam', help='BAM for the comparison with Picard, a synthetic one by default')
+    args = parser.parse_args()
+
+    read_groups = ['rg%s' % i for i in range(args.read_groups)]
+    text = sam_text(read_groups, args.records, args.read_length)
+    seconds = time_routing(text, read_groups)
+    print('routing: %.1f MB/s of SAM text, %.0f records/s' % (len(text) / 1e6 / seconds, args.records / seconds))
+
+    if not args.picard_jar:
+        return 0
+    work_dir = tempfile.mkdtemp(prefix='fused_revert_bench_')
+    try:
+        bam = args.bam or write_bam(os.path.join(work_dir, 'input.bam'), read_groups,
+                                    args.records // 2 // len(read_groups), args.read_length)
+        picard_s, fused_s = compare(args.picard_jar, bam, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print('RevertSam by read group: %.2fs, fused revert: %.2fs' % (picard_s, fused_s))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import uuid
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow', 'tools'))
+import local_runner
+import synthetic_data
+from local_runner import default_inputs, load_workflow, write_shims
+
+"""
+Per-stage benchmark of the workflow on synthetic inputs, no patient data, Picard, docker
+daemon or object storage needed:
+- the tasks of workflow/main.jt run one after the other, in dependency order, in a job
+  directory laid out as JTracker does, by workflow/tools/local_runner.py
+- java, docker and score-client are the stubs in benchmark/stubs, they do the cheap part of the
+  real work and sleep for the rest as given by a cost model (see stubs/stub_common.py)
+- runs a matrix of lane counts and reads per lane, reports the seconds each stage took per
+  configuration, and with --baseline, exits with 1 when a stage got slower than the report
+  of an earlier run allows
+"""
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+STUBS_DIR = os.path.join(BENCH_DIR, 'stubs')
+sys.path.insert(0, STUBS_DIR)
+import object_store
+
+
+def run_job(workflow, inputs, job_dir, env):
+    """ local_runner.run_job, marking the payload step skipped when the stub could not make a payload """
+    outputs = {}
+    results = local_runner.run_job(workflow, inputs, job_dir, env, outputs, runner='pipeline_bench')
+    payload = outputs.get('generate_song_payload', {}).get('payload')
+    if payload:
+        with open(payload, 'r') as f:
+            if 'skipped' in json.load(f):
+                results[-1]['skipped'] = True
+    return results
+
+
+def bench_config(workflow, work_dir, lanes, reads, args):
+    store_dir = os.path.join(work_dir, 'store') if args.storage == 'score' else None
+    metadata_yaml = synthetic_data.generate(work_dir, args.input_format, lanes, reads, args.read_length, store_dir)
+    inputs = default_inputs(workflow)
+    inputs.update(synthetic_data.write_reference(os.path.join(work_dir, 'reference')))
+    inputs['picard_jar'] = os.path.join(work_dir, 'picard.jar')
+    open(inputs['picard_jar'], 'w').close()
+    inputs.update({'metadata_yaml': metadata_yaml, 'min_coverage': 0})
+    inputs.update(args.inputs)
+
+    with open(metadata_yaml, 'r') as f:
+        input_bytes = sum([fi['fileSize'] for rg in json.load(f)['readGroups'] for fi in rg['files']])
+    if args.input_format == 'BAM':
+        input_bytes //= lanes  # the one BAM is listed under every read group
+
+    # song:// objects are fetched in ranges from the object store stub, which runs in this
+    # process and charges the cost model of the stubs
+    os.environ['BENCH_COST_MODEL'] = json.dumps(args.cost_model)
+    server = object_store.start(store_dir) if store_dir else None
+    env = dict(os.environ)
+    env.pop('TASK_CACHE_DIR', None)
+    env.update({
+        'PATH': os.pathsep.join([STUBS_DIR, os.path.join(work_dir, 'shims'), env.get('PATH', '')]),
+        'TMPDIR': os.path.join(work_dir, 'tmp'),  # docker image state, Picard launcher classes
+        'BENCH_COST_MODEL': json.dumps(args.cost_model),
+        'BENCH_SCORE_STORE': store_dir or '',
+        'BENCH_SCORE_URL': 'http://127.0.0.1:%s' % server.server_port if server else '',
+        'SCORE_TOKEN': 'bench',
+        'SONG_TOKEN': 'bench'
+    })
+    os.makedirs(env['TMPDIR'], exist_ok=True)
+    write_shims(os.path.join(work_dir, 'shims'))
+
+    runs = []
+    for _ in range(args.repeat):
+        job_dir = os.path.join(work_dir, 'jobs', str(uuid.uuid4()))
+        runs.append(run_job(workflow, inputs, job_dir, env))
+        if runs[-1][-1]['returncode'] != 0:
+            break
+    if server:
+        server.shutdown()
+
+    stages = {}
+    for task in [r['task'] for r in runs[0]]:
+        seconds = [r['seconds'] for run in runs for r in run if r['task'] == task]
+        stages[task] = round(statistics.median(seconds), 3)
+    failed = [r for r in runs[-1] if r['returncode'] != 0]
+    return {
+        'name': 'lanes=%s,reads=%s' % (lanes, reads),
+        'lanes': lanes,
+        'reads': reads,
+        'input_bytes': input_bytes,
+        'stages': stages,
+        'total_s': round(sum(stages.values()), 3),
+        'failed': failed[0] if failed else None,
+        'skipped': [r['task'] for r in runs[-1] if r.get('skipped')]
+    }
+
+
+def print_report(report):
+    configs = report['configs']
+    tasks = []
+    for c in configs:
+        tasks.extend([t for t in c['stages'] if t not in tasks])
+    width = max([len(c['name']) for c in configs] + [10])
+    print('%-24s' % 'stage' + ''.join(['%*s' % (width + 2, c['name']) for c in configs]))
+    for task in tasks + ['total_s']:
+        row = [c['stages'].get(task) if task != 'total_s' else c['total_s'] for c in configs]
+        print('%-24s' % task + ''.join(['%*s' % (width + 2, '-' if v is None else '%.2f' % v) for v in row]))
+    print('%-24s' % 'input MB' + ''.join(['%*.1f' % (width + 2, c['input_bytes'] / 1e6) for c in configs]))
+
+    # scaling between the smallest and the largest input, 1.0 is linear in the input size
+    if len(configs) > 1:
+        small, large = min(configs, key=lambda c: c['input_bytes']), max(configs, key=lambda c: c['input_bytes'])
+        if large['input_bytes'] > small['input_bytes']:
+            ratio = large['input_bytes'] / small['input_bytes']
+            print('\nseconds ratio per input size ratio (%.1fx), %s -> %s' % (ratio, small['name'], large['name']))
+            for task in tasks:
+                if small['stages'].get(task) and large['stages'].get(task):
+                    print('%-24s %.2f' % (task, large['stages'][task] / small['stages'][task] / ratio))
+
+    for c in configs:
+        if c['failed']:
+            print('\n%s: %s failed with %s\n%s' % (c['name'], c['failed']['task'], c['failed']['returncode'],
+                                                   c['failed'].get('error', '')), file=sys.stderr)
+        if c['skipped']:
+            print('%s: %s skipped, see the stderr.log of the task' % (c['name'], ', '.join(c['skipped'])))
+
+
+def regressions(report, baseline, tolerance, min_delta):
+    found = []
+    base_configs = {c['name']: c for c in baseline['configs']}
+    for c in report['configs']:
+        base = base_configs.get(c['name'])
+        if base is None:
+            continue
+        for task, seconds in c['stages'].items():
+            before = base['stages'].get(task)
+            if before is not None and seconds > before * (1 + tolerance) and seconds - before > min_delta:
+                found.append('%s %s: %.2fs, was %.2fs' % (c['name'], task, seconds, before))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-stage benchmark of the workflow with synthetic data and stub executables')
+    parser.add_argument('--lanes', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--reads', type=int, nargs='+', default=[20000], help='read pairs per lane')
+    parser.add_argument('--read-length', dest='read_length', type=int, default=150)
+    parser.add_argument('--format', dest='input_format', choices=['FASTQ', 'BAM'], default='FASTQ')
+    parser.add_argument('--storage', choices=['local', 'score'], default='local',
+                        help='file:// inputs, or song:// inputs downloaded by the score-client stub')
+    parser.add_argument('-i', '--input', dest='inputs', action='append', default=[], metavar='KEY=VALUE',
+                        help='workflow input, e.g. -i fastq_streaming=true')
+    parser.add_argument('--cost-model', dest='cost_model', help='JSON file overriding entries of the stub cost model')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per configuration, the median is reported')
+    parser.add_argument('--work-dir', dest='work_dir', help='kept after the run when given')
+    parser.add_argument('--output', help='write the report as JSON')
+    parser.add_argument('--baseline', help='JSON report of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown of a stage, relative')
+    parser.add_argument('--min-delta', dest='min_delta', type=float, default=0.5, help='allowed slowdown of a stage, seconds')
+    args = parser.parse_args()
+
+    args.inputs = dict([(k, yaml.safe_load(v)) for k, v in [i.split('=', 1) for i in args.inputs]])
+    cost_model = {}
+    if args.cost_model:
+        with open(args.cost_model, 'r') as f:
+            cost_model = json.load(f)
+    args.cost_model = cost_model
+
+    workflow = load_workflow()
+
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix='pipeline_bench_')
+    report = {'format': args.input_format, 'storage': args.storage, 'inputs': args.inputs,
+              'cost_model': cost_model, 'configs': []}
+    try:
+        for lanes in args.lanes:
+            for reads in args.reads:
+                config_dir = os.path.join(work_dir, 'lanes%s_reads%s' % (lanes, reads))
+                report['configs'].append(bench_config(workflow, config_dir, lanes, reads, args))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(report, indent=2))
+
+    failed = [c for c in report['configs'] if c['failed']]
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            found = regressions(report, json.load(f), args.tolerance, args.min_delta)
+        for r in found:
+            print('REGRESSION %s' % r)
+        if found:
+            return 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
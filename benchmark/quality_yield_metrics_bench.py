@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow', 'tools'))
+import quality_yield_metrics
+from synthetic_data import write_fastq_pair
+
+"""
+Compare the native quality yield calculator with the Picard FastqToSam +
+CollectQualityYieldMetrics pass it replaces, on a synthetic FASTQ pair:
+- reports wall time of both and whether the metrics agree
+- the Picard side is skipped when no picard.jar is given
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark native quality yield metrics against Picard')
+    parser.add_argument('--reads', type=int, default=200000)
+    parser.add_argument('--read-length', dest='read_length', type=int, default=150)
+    parser.add_argument('--picard-jar', dest='picard_jar')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='qym_bench_')
+    fastqs = write_fastq_pair(os.path.join(work_dir, 'sample'), args.reads, args.read_length)
+
+    start = time.time()
+    native = quality_yield_metrics.fastq_metrics(fastqs)
+    print('native (%s): %.2fs' % ('numpy' if quality_yield_metrics.np is not None else 'pure python',
+                                  time.time() - start))
+
+    if not args.picard_jar:
+        print(native)
+        return 0
+
+    bam = os.path.join(work_dir, 'sample.lane.bam')
+    metrics_file = bam + '.quality_yield_metrics.txt'
+    start = time.time()
+    subprocess.run(['java', '-jar', args.picard_jar, 'FastqToSam', 'FASTQ=%s' % fastqs[0], 'FASTQ2=%s' % fastqs[1],
+                    'SAMPLE_NAME=bench', 'OUTPUT=%s' % bam], check=True, stderr=subprocess.DEVNULL)
+    converted = time.time()
+    subprocess.run(['java', '-jar', args.picard_jar, 'CollectQualityYieldMetrics', 'I=%s' % bam, 'O=%s' % metrics_file],
+                   check=True, stderr=subprocess.DEVNULL)
+    print('picard CollectQualityYieldMetrics: %.2fs (FastqToSam before it: %.2fs)' % (time.time() - converted, converted - start))
+
+    picard = quality_yield_metrics.load_metrics(metrics_file)
+    diff = [c for c in quality_yield_metrics.METRICS_COLUMNS if str(native[c]) != picard.get(c)]
+    print('metrics agree' if not diff else 'metrics differ: %s' % ', '.join(diff))
+    return 1 if diff else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import stub_common
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Stands in for the upload gateway of the object store, to exercise object_upload.py without
+one: parts are kept under <store>/uploads/<upload id>/, a completed upload is checked against
+the md5 it is completed with and moved to <store>/<object id>/<file name>, the layout the
+score-client stub downloads from. A given share of the requests fails with 503, POSTs with
+429, and --fail-after-parts drops the connection after that many parts, to exercise resuming.
+GET /objects/<object id> serves the ranges download.py fetches, at the rate the cost model
+gives score-client for each object.
+"""
+
+
+class StoreState(object):
+    def __init__(self, store_dir, fail_rate=0.0, fail_after_parts=None):
+        self.store_dir = store_dir
+        self.fail_rate = fail_rate
+        self.fail_after_parts = fail_after_parts
+        self.lock = threading.Lock()
+        self.parts_received = 0
+        self.bytes_received = 0
+        self.requests = 0
+        self.object_locks = {}
+
+    def upload_dir(self, upload_id):
+        return os.path.join(self.store_dir, 'uploads', os.path.basename(upload_id))
+
+
+class StoreHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_call(self):
+        state = self.server.state
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with state.lock:
+            state.requests += 1
+        if random.random() < state.fail_rate:
+            # unprocessed, the one failure a client may send a POST again for
+            return self.reply(429 if self.command == 'POST' else 503, {'message': 'stub failure'})
+        path = self.path.strip('/').split('/')
+        if path[0] == 'objects' and self.command == 'GET' and len(path) == 2:
+            return self.send_range(os.path.join(state.store_dir, os.path.basename(path[1])))
+        if path[0] != 'uploads':
+            return self.reply(404, {'message': 'not found: %s %s' % (self.command, self.path)})
+
+        if self.command == 'POST' and len(path) == 1:
+            upload_id = str(uuid.uuid4())
+            os.makedirs(state.upload_dir(upload_id))
+            with open(os.path.join(state.upload_dir(upload_id), 'upload.json'), 'w') as f:
+                f.write(body.decode())
+            return self.reply(200, {'uploadId': upload_id})
+
+        upload_dir = state.upload_dir(path[1])
+        if not os.path.isdir(upload_dir):
+            return self.reply(404, {'message': 'no upload %s' % path[1]})
+        with open(os.path.join(upload_dir, 'upload.json'), 'r') as f:
+            upload = json.load(f)
+        part_files = sorted([int(p) for p in os.listdir(upload_dir) if p.isdigit()])
+
+        if self.command == 'GET' and len(path) == 2:
+            parts = []
+            for n in part_files:
+                with open(os.path.join(upload_dir, str(n)), 'rb') as f:
+                    data = f.read()
+                parts.append({'partNumber': n, 'etag': hashlib.md5(data).hexdigest(), 'size': len(data)})
+            return self.reply(200, {'parts': parts})
+
+        if self.command == 'PUT' and len(path) == 4 and path[2] == 'parts':
+            with state.lock:
+                if state.fail_after_parts is not None and state.parts_received >= state.fail_after_parts:
+                    self.close_connection = True
+                    return
+                state.parts_received += 1
+                state.bytes_received += len(body)
+            with open(os.path.join(upload_dir, '.%s' % path[3]), 'wb') as f:
+                f.write(body)
+            os.replace(os.path.join(upload_dir, '.%s' % path[3]), os.path.join(upload_dir, path[3]))
+            return self.reply(200, {'etag': hashlib.md5(body).hexdigest()})
+
+        if self.command == 'POST' and len(path) == 3 and path[2] == 'complete':
+            request = json.loads(body.decode())
+            numbers = [p['partNumber'] for p in request['parts']]
+            if numbers != part_files or numbers != list(range(1, len(numbers) + 1)):
+                return self.reply(400, {'message': 'parts %s do not match the uploaded parts %s' % (numbers, part_files)})
+            object_dir = os.path.join(state.store_dir, request['objectId'])
+            os.makedirs(object_dir, exist_ok=True)
+            md5 = hashlib.md5()
+            target = os.path.join(object_dir, upload['fileName'])
+            with open(target, 'wb') as o:
+                for n in numbers:
+                    with open(os.path.join(upload_dir, str(n)), 'rb') as f:
+                        data = f.read()
+                    md5.update(data)
+                    o.write(data)
+            if md5.hexdigest() != request['fileMd5sum'] or os.path.getsize(target) != upload['fileSize']:
+                shutil.rmtree(object_dir)
+                return self.reply(400, {'message': 'md5 %s of the object does not match %s' % (md5.hexdigest(), request['fileMd5sum'])})
+            shutil.rmtree(upload_dir)
+            return self.reply(200, {'objectId': request['objectId']})
+
+        if self.command == 'DELETE' and len(path) == 2:
+            shutil.rmtree(upload_dir)
+            return self.reply(200, {})
+        self.reply(404, {'message': 'not found: %s %s' % (self.command, self.path)})
+
+    def send_range(self, object_dir):
+        state = self.server.state
+        if not os.path.isdir(object_dir) or not os.listdir(object_dir):
+            return self.reply(404, {'message': 'no object %s' % os.path.basename(object_dir)})
+        source = os.path.join(object_dir, os.listdir(object_dir)[0])
+        size = os.path.getsize(source)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if match:
+            start, end = int(match.group(1)), min(int(match.group(2) or end), end)
+        with open(source, 'rb') as f:
+            f.seek(start)
+            data = f.read(max(0, end - start + 1))
+        # the parts of an object come at the rate of one score-client download
+        with state.lock:
+            lock = state.object_locks.setdefault(object_dir, threading.Lock())
+        with lock:
+            stub_common.charge('score-client', len(data), invocation_only=True)
+        self.send_response(206 if match else 200)
+        if match:
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, start + len(data) - 1, size))
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_call
+
+
+def start(store_dir, port=0, fail_rate=0.0, fail_after_parts=None):
+    """ Serves in a background thread, returns the server, its URL is 'http://127.0.0.1:<server.server_port>' """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StoreHandler)
+    server.daemon_threads = True
+    server.state = StoreState(store_dir, fail_rate, fail_after_parts)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Object store upload gateway stub')
+    parser.add_argument('--store', help='where the objects go, a temporary directory by default')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--fail-rate', dest='fail_rate', type=float, default=0.0, help='share of requests failing with 503, 429 for POSTs')
+    parser.add_argument('--fail-after-parts', dest='fail_after_parts', type=int,
+                        help='drop the connection of every part request after this many parts')
+    args = parser.parse_args()
+
+    server = start(args.store or tempfile.mkdtemp(prefix='object_store_'), args.port, args.fail_rate, args.fail_after_parts)
+    print('http://127.0.0.1:%s %s' % (server.server_port, server.state.store_dir), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    print('requests: %s, parts: %s, MB: %.1f' % (server.state.requests, server.state.parts_received,
+                                                 server.state.bytes_received / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Stands in for a SONG server, to exercise song_client.py without one: keeps uploads and
+analyses in memory, answers with keep-alive HTTP/1.1, and fails a given share of the
+requests with 503, POSTs with 429, so the retries get used. Prints its URL, then the number
+of connections and requests it served when stopped.
+"""
+
+
+class SongState(object):
+    def __init__(self, fail_rate=0.0, latency=0.0):
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.uploads = {}
+        self.analyses = {}
+        self.connections = 0
+        self.requests = 0
+
+
+class SongHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super(SongHandler, self).setup()
+        with self.server.state.lock:
+            self.server.state.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_call(self):
+        state = self.server.state
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with state.lock:
+            state.requests += 1
+        time.sleep(state.latency)
+        if random.random() < state.fail_rate:
+            # unprocessed, the one failure a client may send a POST again for
+            return self.reply(429 if self.command == 'POST' else 503, {'message': 'stub failure'})
+        path = self.path.strip('/').split('/')
+
+        with state.lock:
+            if self.command == 'POST' and len(path) == 2 and path[0] == 'upload':
+                upload_id = str(uuid.uuid4())
+                state.uploads[upload_id] = json.loads(body.decode())
+                return self.reply(200, {'status': 'ok', 'uploadId': upload_id})
+            if self.command == 'POST' and len(path) == 4 and path[2] == 'save' and path[3] in state.uploads:
+                analysis_id = str(uuid.uuid4())
+                analysis = dict(state.uploads[path[3]], analysisId=analysis_id, analysisState='UNPUBLISHED')
+                analysis['file'] = [dict(f, objectId=str(uuid.uuid4())) for f in analysis.get('file', [])]
+                state.analyses[analysis_id] = analysis
+                return self.reply(200, {'status': 'ok', 'analysisId': analysis_id})
+            if self.command == 'GET' and len(path) == 4 and path[2] == 'analysis' and path[3] in state.analyses:
+                return self.reply(200, state.analyses[path[3]])
+            if self.command == 'PUT' and len(path) == 5 and path[3] == 'publish' and path[4] in state.analyses:
+                state.analyses[path[4]]['analysisState'] = 'PUBLISHED'
+                return self.reply(200, {'message': 'AnalysisId %s successfully published' % path[4]})
+        self.reply(404, {'message': 'not found: %s %s' % (self.command, self.path)})
+
+    do_GET = do_POST = do_PUT = handle_call
+
+
+def start(port=0, fail_rate=0.0, latency=0.0):
+    """ Serves in a background thread, returns the server, its URL is 'http://127.0.0.1:<server.server_port>' """
+    server = ThreadingHTTPServer(('127.0.0.1', port), SongHandler)
+    server.daemon_threads = True
+    server.state = SongState(fail_rate, latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='In-memory SONG server stub')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--fail-rate', dest='fail_rate', type=float, default=0.0, help='share of requests failing with 503, 429 for POSTs')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    args = parser.parse_args()
+
+    server = start(args.port, args.fail_rate, args.latency)
+    print('http://127.0.0.1:%s' % server.server_port, flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    print('connections: %s, requests: %s' % (server.state.connections, server.state.requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'workflow', 'tools'))
+
+"""
+Cost model shared by the stub executables. A stub does the real (cheap) data handling of the
+command it stands in for, then sleeps for the time the real command would have taken:
+  fixed_s + s_per_gb * input GB / parallelism
+Entries are keyed by Picard tool name, docker image command or 'score-client'. The JSON in
+BENCH_COST_MODEL overrides the defaults entry by entry.
+"""
+
+DEFAULT_COST_MODEL = {
+    'java': {'fixed_s': 0.5, 's_per_gb': 20},  # JVM start, any Picard tool without its own entry
+    'FastqToSam': {'fixed_s': 0.5, 's_per_gb': 40},
+    'RevertSam': {'fixed_s': 0.5, 's_per_gb': 60},
+    'RevertSam unsorted': {'fixed_s': 0.5, 's_per_gb': 15},  # no sort, fast compression
+    'SamFormatConverter': {'fixed_s': 0.5, 's_per_gb': 20},
+    'SplitSamByNumberOfReads': {'fixed_s': 0.5, 's_per_gb': 10},
+    'CollectQualityYieldMetrics': {'fixed_s': 0.5, 's_per_gb': 15},
+    'CollectMultipleMetrics': {'fixed_s': 0.5, 's_per_gb': 80},
+    'CollectOxoGMetrics': {'fixed_s': 0.5, 's_per_gb': 60},
+    'PicardBatch': {'fixed_s': 0.5, 's_per_gb': 0},  # JVM start only, each invocation pays its tool's s_per_gb
+    'docker pull': {'fixed_s': 2.0, 's_per_gb': 0},
+    'docker run': {'fixed_s': 0.3, 's_per_gb': 0},
+    'bwa-mem-aligner.py': {'fixed_s': 1.0, 's_per_gb': 1000},  # per cpu given to the container
+    'bam-merge-sort-markdup.py': {'fixed_s': 1.0, 's_per_gb': 100},
+    'score-client': {'fixed_s': 0.5, 's_per_gb': 10}
+}
+
+
+def cost_model():
+    model = dict(DEFAULT_COST_MODEL)
+    model.update(json.loads(os.environ.get('BENCH_COST_MODEL') or '{}'))
+    return model
+
+
+def cost(key, nbytes=0, parallelism=1, invocation_only=False):
+    """ Seconds 'key' takes for 'nbytes' of input, 'invocation_only' leaves out the fixed start up cost """
+    model = cost_model()
+    entry = model.get(key, model['java'] if key[:1].isupper() else {'fixed_s': 0, 's_per_gb': 0})
+    seconds = entry.get('s_per_gb', 0) * nbytes / 1e9 / max(1, parallelism)
+    if not invocation_only:
+        seconds += entry.get('fixed_s', 0)
+    return seconds
+
+
+def charge(key, nbytes=0, parallelism=1, invocation_only=False, started=None):
+    """ Sleeps until the modelled time has passed, counting from 'started' when given """
+    remaining = cost(key, nbytes, parallelism, invocation_only) - (time.time() - started if started else 0)
+    if remaining > 0:
+        time.sleep(remaining)
+
+
+def input_size(path):
+    try:
+        return os.path.getsize(path) if os.path.isfile(path) else 0
+    except OSError:
+        return 0
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import struct
+import sys
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow', 'tools'))
+import bam_reheader
+
+"""
+Synthetic inputs for the benchmarks, no patient data needed:
+- paired FASTQs per lane, or one multi read group BAM of unmapped read pairs
+- reference files of the names the workflow expects (content is irrelevant to the stubs)
+- the metadata YAML describing them, with file:// paths or song:// paths served by the
+  score-client stub from a store directory
+Also the minimal BAM record codec the stubs in benchmark/stubs use.
+"""
+
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+SEQ_CODES = '=ACMGRSVTWYHKDBN'
+REFERENCE_FILES = {
+    'reference_gz': 'GRCh38_hla_decoy_ebv.fa.gz',
+    'reference_gz_fai': 'GRCh38_hla_decoy_ebv.fa.gz.fai',
+    'reference_gz_alt': 'GRCh38_hla_decoy_ebv.fa.gz.alt',
+    'reference_gz_bwt': 'GRCh38_hla_decoy_ebv.fa.gz.bwt',
+    'reference_gz_ann': 'GRCh38_hla_decoy_ebv.fa.gz.ann',
+    'reference_gz_pac': 'GRCh38_hla_decoy_ebv.fa.gz.pac',
+    'reference_gz_sa': 'GRCh38_hla_decoy_ebv.fa.gz.sa',
+    'reference_gz_amb': 'GRCh38_hla_decoy_ebv.fa.gz.amb',
+    'reference': 'GRCh38_hla_decoy_ebv.fa',
+    'reference_fai': 'GRCh38_hla_decoy_ebv.fa.fai'
+}
+
+
+class BamWriter(object):
+    def __init__(self, f, header_text, level=1):
+        self.f = f
+        self.level = level
+        text = header_text.encode()
+        self.buffer = bytearray(b'BAM\x01' + struct.pack('<i', len(text)) + text + struct.pack('<i', 0))
+
+    def write(self, name, flag, seq, qual, rg=None):
+        self.buffer += encode_record(name, flag, seq, qual, rg)
+        if len(self.buffer) >= 16 * bam_reheader.BGZF_MAX_BLOCK_DATA:
+            bam_reheader.write_blocks(self.f, bytes(self.buffer), self.level)
+            self.buffer = bytearray()
+
+    def close(self):
+        bam_reheader.write_blocks(self.f, bytes(self.buffer), self.level)
+        self.f.write(BGZF_EOF)
+        self.f.close()
+
+
+def encode_record(name, flag, seq, qual, rg=None):
+    """ An unmapped BAM record, 'qual' is phred+33 text like in FASTQ/SAM """
+    read_name = name.encode() + b'\x00'
+    packed = bytearray((len(seq) + 1) // 2)
+    for i, base in enumerate(seq):
+        code = SEQ_CODES.find(base.upper())
+        packed[i // 2] |= (code if code >= 0 else 15) << (4 if i % 2 == 0 else 0)
+    tags = b'RGZ' + rg.encode() + b'\x00' if rg else b''
+    body = struct.pack('<iiBBHHHiiii', -1, -1, len(read_name), 0, 4680, 0, flag, len(seq), -1, -1, 0) + \
+        read_name + bytes(packed) + bytes([ord(q) - 33 for q in qual]) + tags
+    return struct.pack('<i', len(body)) + body
+
+
+def read_tags(data):
+    tags = {}
+    i = 0
+    sizes = {'A': 1, 'c': 1, 'C': 1, 's': 2, 'S': 2, 'i': 4, 'I': 4, 'f': 4}
+    while i < len(data):
+        tag, t = data[i:i + 2].decode(), chr(data[i + 2])
+        i += 3
+        if t in ('Z', 'H'):
+            end = data.index(b'\x00', i)
+            tags[tag] = data[i:end].decode()
+            i = end + 1
+        elif t == 'B':
+            sub, count = chr(data[i]), struct.unpack('<i', data[i + 1:i + 5])[0]
+            i += 5 + sizes[sub] * count
+        else:
+            i += sizes[t]
+    return tags
+
+
+def read_bam(f):
+    """ Yields the header text, then (name, flag, seq, qual, rg) of each record of an open BAM """
+    bam = gzip.GzipFile(fileobj=f, mode='rb')
+    magic, l_text = bam.read(4), struct.unpack('<i', bam.read(4))[0]
+    if magic != b'BAM\x01':
+        raise ValueError('not a BAM file')
+    yield bam.read(l_text).rstrip(b'\x00').decode()
+    for _ in range(struct.unpack('<i', bam.read(4))[0]):
+        l_name = struct.unpack('<i', bam.read(4))[0]
+        bam.read(l_name + 4)
+    while True:
+        size = bam.read(4)
+        if len(size) < 4:
+            break
+        body = bam.read(struct.unpack('<i', size)[0])
+        l_read_name, n_cigar, flag, l_seq = body[8], struct.unpack('<H', body[12:14])[0], \
+            struct.unpack('<H', body[14:16])[0], struct.unpack('<i', body[16:20])[0]
+        i = 32
+        name = body[i:i + l_read_name - 1].decode()
+        i += l_read_name + 4 * n_cigar
+        seq = ''.join([SEQ_CODES[(body[i + j // 2] >> (4 if j % 2 == 0 else 0)) & 15] for j in range(l_seq)])
+        i += (l_seq + 1) // 2
+        qual = ''.join([chr(q + 33) for q in body[i:i + l_seq]])
+        yield name, flag, seq, qual, read_tags(body[i + l_seq:]).get('RG')
+
+
+def random_read(rnd, read_length):
+    quals = ''.join([chr(33 + q) for q in range(2, 42)])
+    return ''.join(rnd.choice('ACGT') for _ in range(read_length)), ''.join(rnd.choice(quals) for _ in range(read_length))
+
+
+def write_fastq_pair(prefix, reads, read_length, seed=1):
+    rnd = random.Random(seed)
+    paths = ['%s_%s.fq.gz' % (prefix, mate) for mate in (1, 2)]
+    with gzip.open(paths[0], 'wt', compresslevel=1) as f1, gzip.open(paths[1], 'wt', compresslevel=1) as f2:
+        for i in range(reads):
+            for mate, f in ((1, f1), (2, f2)):
+                seq, qual = random_read(rnd, read_length)
+                f.write('@read%s/%s\n%s\n+\n%s\n' % (i, mate, seq, qual))
+    return paths
+
+
+def write_bam(path, read_groups, reads_per_rg, read_length, seed=1):
+    """ Queryname sorted BAM of unmapped pairs, 'reads_per_rg' pairs in each of 'read_groups' """
+    rnd = random.Random(seed)
+    header = '@HD\tVN:1.6\tSO:queryname\n' + ''.join(['@RG\tID:%s\tSM:bench\tLB:lib\tPL:ILLUMINA\n' % rg for rg in read_groups])
+    writer = BamWriter(open(path, 'wb'), header)
+    records = sorted([('%s.read%08d' % (rg, i), rg) for rg in read_groups for i in range(reads_per_rg)])
+    for name, rg in records:
+        for flag in (77, 141):
+            seq, qual = random_read(rnd, read_length)
+            writer.write(name, flag, seq, qual, rg)
+    writer.close()
+    return path
+
+
+def file_entry(path, store_dir, **fields):
+    with open(path, 'rb') as f:
+        md5 = hashlib.md5(f.read()).hexdigest()
+    entry = dict(fields, fileName=os.path.basename(path), fileSize=os.path.getsize(path), fileMd5sum=md5)
+    if store_dir:
+        # served by the score-client stub: <store>/<object id>/<file name>
+        object_id = str(uuid.uuid5(uuid.NAMESPACE_URL, path))
+        os.makedirs(os.path.join(store_dir, object_id), exist_ok=True)
+        os.replace(path, os.path.join(store_dir, object_id, os.path.basename(path)))
+        entry['path'] = 'song://collaboratory/%s/%s' % (uuid.uuid5(uuid.NAMESPACE_URL, store_dir), object_id)
+    else:
+        entry['path'] = 'file://%s' % path
+    return entry
+
+
+def write_reference(ref_dir):
+    os.makedirs(ref_dir, exist_ok=True)
+    paths = {}
+    for key, name in REFERENCE_FILES.items():
+        paths[key] = os.path.join(ref_dir, name)
+        with open(paths[key], 'wb') as f:
+            f.write(b'>chr1\n' + b'ACGT' * 1024 + b'\n')
+    return paths
+
+
+def generate(work_dir, input_format='FASTQ', lanes=2, reads=10000, read_length=150, store_dir=None):
+    """ Writes the inputs of one aliquot, returns the path of its metadata YAML """
+    data_dir = os.path.join(work_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    read_groups = ['%s.lane%s' % ('C0ABCACXX', i + 1) for i in range(lanes)]
+    metadata = {
+        'study': 'PACA-CA',
+        'donorSubmitterId': 'bench_donor',
+        'donorGender': 'female',
+        'specimenSubmitterId': 'bench_specimen',
+        'specimenType': 'Normal - blood derived',
+        'sampleSubmitterId': 'bench_sample',
+        'aliquotId': str(uuid.uuid5(uuid.NAMESPACE_URL, work_dir)),
+        'libraryStrategy': 'WGS',
+        'useCntl': 'N/A',
+        'readGroups': []
+    }
+
+    if input_format == 'BAM':
+        bam = write_bam(os.path.join(data_dir, 'bench.bam'), read_groups, reads, read_length)
+        bam_entry = None
+    for i, rg in enumerate(read_groups):
+        read_group = {
+            'readGroupId': rg,
+            'sequencingPlatform': 'ILLUMINA',
+            'platformUnit': 'bench-%s' % (i + 1),
+            'libraryName': 'bench_lib',
+            'insertSize': 400,
+            'sequencingCenter': 'OICR',
+            'files': []
+        }
+        if input_format == 'FASTQ':
+            for fastq in write_fastq_pair(os.path.join(data_dir, rg), reads, read_length, seed=i + 1):
+                read_group['files'].append(file_entry(fastq, store_dir, fileType='FASTQ', readGroupIdInFile=rg))
+        else:
+            # the same BAM is listed under every read group
+            if bam_entry is None:
+                bam_entry = file_entry(bam, store_dir, fileType='BAM')
+            read_group['files'].append(dict(bam_entry, readGroupIdInFile=rg))
+        metadata['readGroups'].append(read_group)
+
+    metadata_yaml = os.path.join(work_dir, 'metadata.yaml')
+    with open(metadata_yaml, 'w') as f:
+        # JSON is valid YAML, keeps this free of a PyYAML dependency
+        f.write(json.dumps(metadata, indent=2))
+    return metadata_yaml
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic pipeline inputs and their metadata YAML')
+    parser.add_argument('work_dir')
+    parser.add_argument('--format', dest='input_format', choices=['FASTQ', 'BAM'], default='FASTQ')
+    parser.add_argument('--lanes', type=int, default=2)
+    parser.add_argument('--reads', type=int, default=10000, help='read pairs per lane')
+    parser.add_argument('--read-length', dest='read_length', type=int, default=150)
+    parser.add_argument('--store-dir', dest='store_dir', help='serve the files through the score-client stub from here')
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir)
+    print(generate(work_dir, args.input_format, args.lanes, args.reads, args.read_length,
+                   os.path.abspath(args.store_dir) if args.store_dir else None))
+    write_reference(os.path.join(work_dir, 'reference'))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOOLS_DIR = os.path.join(ROOT, 'workflow', 'tools')
+STUBS_DIR = os.path.join(ROOT, 'benchmark', 'stubs')
+sys.path.insert(0, TOOLS_DIR)
+BENCH_DIR = os.path.join(ROOT, 'benchmark')
+sys.path.insert(1, BENCH_DIR)
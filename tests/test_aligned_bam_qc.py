@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import file_checksum
+import oxog_metrics
+from conftest import TOOLS_DIR, STUBS_DIR
+from synthetic_data import BamWriter, random_read
+
+HEADER = '@HD\tVN:1.6\tSO:coordinate\n' + \
+    ''.join(['@SQ\tSN:chr%s\tLN:%s\n' % (n, length) for n, length in [(1, 5000), (2, 4000), (3, 3000), (4, 1000)]]) + \
+    '@RG\tID:rg1\tSM:bench\tLB:bench_lib\n'
+NO_COST = {'CollectMultipleMetrics': {'fixed_s': 0, 's_per_gb': 0},
+           'CollectOxoGMetrics': {'fixed_s': 0, 's_per_gb': 0}}
+
+
+def write_aligned_bam(path, pairs=300):
+    rnd = random.Random(1)
+    writer = BamWriter(open(path, 'wb'), HEADER)
+    for i in range(pairs):
+        for flag in (77, 141):
+            seq, qual = random_read(rnd, 100)
+            writer.write('read%05d' % i, flag, seq, qual, 'rg1')
+    writer.close()
+    with open(path + '.bai', 'wb'):
+        pass
+
+
+def run_qc(tmp_path, name, oxog_shards, path=None):
+    bam = str(tmp_path / 'aligned.bam')
+    if not os.path.exists(bam):
+        write_aligned_bam(bam)
+    task_dir = tmp_path / name / 'task.aligned_bam_qc'
+    task_dir.mkdir(parents=True)
+    env = dict(os.environ, PATH=os.pathsep.join(([path] if path else []) + [STUBS_DIR, os.environ.get('PATH', '')]),
+               BENCH_COST_MODEL=json.dumps(NO_COST))
+    for var in ('TASK_CACHE_DIR', 'NODE_BUDGET_DIR'):
+        env.pop(var, None)
+    task = {'input': {'picard_jar': 'picard.jar', 'aligned_bam': bam, 'oxog_shards': oxog_shards,
+                      'reference_sequence': 'genome.fa.gz', 'reference': 'genome.fa'}}
+    result = subprocess.run([sys.executable, os.path.join(TOOLS_DIR, 'aligned_bam_qc.py'), json.dumps(task)],
+                            cwd=str(task_dir), env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, timeout=120)
+    return result, task_dir
+
+
+def test_sharded_oxog_adds_up_to_a_single_run(tmp_path):
+    single, single_dir = run_qc(tmp_path, 'single', 1)
+    assert single.returncode == 0, single.stderr
+    sharded, sharded_dir = run_qc(tmp_path, 'sharded', 3)
+    assert sharded.returncode == 0, sharded.stderr
+
+    _, columns, rows = oxog_metrics.load_metrics(str(sharded_dir / 'oxoG_metrics.txt'))
+    assert columns == oxog_metrics.METRICS_COLUMNS
+    assert rows == oxog_metrics.load_metrics(str(single_dir / 'oxoG_metrics.txt'))[2]
+    assert sum([int(r['TOTAL_SITES']) for r in rows]) == 600
+    # the FIFOs, interval lists and shard outputs are gone, the metrics of both collectors are there
+    files = os.listdir(str(sharded_dir))
+    assert 'multiple_metrics.alignment_summary_metrics' in files
+    assert [f for f in files if f.startswith('oxoG_metrics') or f.endswith('.bam')] == ['oxoG_metrics.txt']
+
+
+def test_checksum_sidecars_from_the_collectors_read(tmp_path):
+    result, _ = run_qc(tmp_path, 'sidecars', 2)
+    assert result.returncode == 0, result.stderr
+    for path in (str(tmp_path / 'aligned.bam'), str(tmp_path / 'aligned.bam.bai')):
+        with open(path, 'rb') as f:
+            data = f.read()
+        assert file_checksum.read_sidecar(path) == (hashlib.md5(data).hexdigest(), len(data))
+
+
+def test_failed_collector_stops_the_others(tmp_path):
+    # dies before opening its FIFO, tee and the other collectors must not wait for it
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    with open(str(bin_dir / 'java'), 'w') as f:
+        f.write('#!/bin/sh\ncase "$*" in *CollectMultipleMetrics*) exit 3;; esac\nexec %s "$@"\n'
+                % os.path.join(STUBS_DIR, 'java'))
+    os.chmod(str(bin_dir / 'java'), 0o755)
+    for shards in (1, 3):
+        result, task_dir = run_qc(tmp_path, 'failed%s' % shards, shards, path=str(bin_dir))
+        assert result.returncode != 0
+        assert 'CollectMultipleMetrics failed' in result.stderr
+        assert not os.path.exists(str(task_dir / 'output.json'))
+        assert not [f for f in os.listdir(str(task_dir)) if f.endswith('.bam')]
+        assert not os.path.exists(str(tmp_path / 'aligned.bam.checksum.json'))
+
+
+def test_interval_lists_balance_whole_sequences(tmp_path):
+    files = oxog_metrics.interval_lists(HEADER, 2, str(tmp_path / 'oxog'))
+    intervals = []
+    for path in files:
+        with open(path) as f:
+            lines = f.read().splitlines()
+        assert [l for l in lines if l.startswith('@')] == HEADER.splitlines()[:5]
+        intervals.append([l.split('\t') for l in lines if not l.startswith('@')])
+    assert intervals == [[['chr1', '1', '5000', '+', 'chr1'], ['chr4', '1', '1000', '+', 'chr4']],
+                         [['chr2', '1', '4000', '+', 'chr2'], ['chr3', '1', '3000', '+', 'chr3']]]
+    assert oxog_metrics.interval_lists('@HD\tVN:1.6\n', 4, str(tmp_path / 'none')) == []
+
+
+def test_merge_derives_rates_from_the_summed_counts(tmp_path):
+    row = dict([(k, 0) for k in oxog_metrics.COUNT_COLUMNS], SAMPLE_ALIAS='s', LIBRARY='l', CONTEXT='CCG')
+    shards = [dict(row, TOTAL_SITES=10, TOTAL_BASES=1000, ALT_OXO_BASES=30, ALT_NONOXO_BASES=10,
+                   C_REF_REF_BASES=400, C_REF_ALT_BASES=30, G_REF_REF_BASES=500, G_REF_ALT_BASES=10),
+              dict(row, TOTAL_SITES=5, TOTAL_BASES=1000, ALT_OXO_BASES=0, ALT_NONOXO_BASES=20,
+                   C_REF_REF_BASES=500, C_REF_ALT_BASES=40, G_REF_REF_BASES=400, G_REF_ALT_BASES=20)]
+    paths = []
+    for n, shard in enumerate(shards):
+        paths.append(str(tmp_path / ('shard%s.txt' % n)))
+        oxog_metrics.write_metrics([shard, dict(row, CONTEXT='ACA', TOTAL_BASES=1)], paths[-1])
+    oxog_metrics.merge(paths, str(tmp_path / 'merged.txt'))
+
+    header, _, rows = oxog_metrics.load_metrics(str(tmp_path / 'merged.txt'))
+    assert header[:2] == ['## htsjdk.samtools.metrics.StringHeader', '# oxog_metrics.py']
+    assert [r['CONTEXT'] for r in rows] == ['CCG', 'ACA']
+    merged = rows[0]
+    assert (merged['TOTAL_SITES'], merged['TOTAL_BASES'], merged['C_REF_ALT_BASES']) == ('15', '2000', '70')
+    # max(30 - 30, 1) / 2000, not the mean of the shard rates
+    assert (merged['OXIDATION_ERROR_RATE'], merged['OXIDATION_Q']) == ('0.0005', '33.0103')
+    # C ref 70 / 970, G ref 30 / 930
+    assert (merged['C_REF_OXO_ERROR_RATE'], merged['C_REF_OXO_Q']) == ('0.039907', '13.989522')
+    assert (merged['G_REF_OXO_ERROR_RATE'], merged['G_REF_OXO_Q']) == ('0', '100')
+    # no C or G ref bases: NaN rates, printed as Picard prints them
+    assert rows[1]['C_REF_OXO_ERROR_RATE'] == '?'
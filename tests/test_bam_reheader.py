@@ -0,0 +1,84 @@
+import gzip
+import struct
+import time
+import pytest
+import bam_reheader
+import readgroup_metadata
+import synthetic_data
+
+
+def records(path):
+    """ The uncompressed bytes of a BAM after its header """
+    with open(path, 'rb') as f:
+        bam_reheader.read_header(f)
+        f.seek(0)
+        data = gzip.GzipFile(fileobj=f).read()
+    l_text = struct.unpack('<i', data[4:8])[0]
+    return data[8 + l_text + 4:]
+
+
+def header(path):
+    with open(path, 'rb') as f:
+        return bam_reheader.read_header(f)[0]
+
+
+@pytest.fixture
+def bam(tmp_path):
+    return synthetic_data.write_bam(str(tmp_path / 'in.bam'), ['rg1'], 2000, 100)
+
+
+def test_add_comments(tmp_path, bam):
+    out = str(tmp_path / 'out.bam')
+    bam_reheader.reheader(bam, out, lambda text: bam_reheader.add_comments(text, ['a comment', 'another']))
+    assert header(out) == header(bam) + '@CO\ta comment\n@CO\tanother\n'
+    assert records(out) == records(bam)
+    reads = list(synthetic_data.read_bam(open(out, 'rb')))[1:]
+    assert len(reads) == 4000 and reads[0][4] == 'rg1'
+
+
+def test_replace_readgroups(tmp_path, bam):
+    out = str(tmp_path / 'out.bam')
+    bam_reheader.reheader(bam, out, lambda text: bam_reheader.replace_readgroups(text, '@RG\tID:rg1\tSM:new'))
+    assert header(out) == '@HD\tVN:1.6\tSO:queryname\n@RG\tID:rg1\tSM:new\n'
+    assert records(out) == records(bam)
+
+
+def test_replace_readgroups_writes_dt_as_picard(tmp_path, bam, monkeypatch):
+    # the header rewrite of replace_readgroup.py, AddOrReplaceReadGroups when it is not possible
+    monkeypatch.setenv('TZ', 'UTC')
+    time.tzset()
+    out = str(tmp_path / 'out.bam')
+    rg_line = readgroup_metadata.rg_header_line({'ID': 'rg1', 'SM': 's1', 'DT': '2014-12-12T10:11:12-05:00'})
+    bam_reheader.reheader(bam, out, lambda text: bam_reheader.replace_readgroups(text, rg_line))
+    monkeypatch.undo()
+    time.tzset()
+    assert header(out) == '@HD\tVN:1.6\tSO:queryname\n@RG\tID:rg1\tSM:s1\tDT:2014-12-12T15:11:12+0000\n'
+
+
+def test_header_over_several_blocks(tmp_path):
+    # a header larger than a BGZF block, the records start in the block the header ends in
+    text = '@HD\tVN:1.6\tSO:queryname\n' + ''.join(['@CO\t%s\n' % ('x' * 1000) for _ in range(200)])
+    path = str(tmp_path / 'in.bam')
+    writer = synthetic_data.BamWriter(open(path, 'wb'), text)
+    writer.write('read1', 77, 'ACGT', 'IIII', 'rg1')
+    writer.write('read1', 141, 'TTGA', 'IIII', 'rg1')
+    writer.close()
+
+    out = str(tmp_path / 'out.bam')
+    bam_reheader.reheader(path, out, lambda text: bam_reheader.add_comments(text, ['new']))
+    assert header(out) == text + '@CO\tnew\n'
+    assert records(out) == records(path)
+
+
+def test_not_bgzf(tmp_path):
+    plain_gzip = str(tmp_path / 'plain.bam')
+    with gzip.open(plain_gzip, 'wb') as f:
+        f.write(b'BAM\x01' + b'\x00' * 100)
+    with pytest.raises(bam_reheader.NotBgzfError):
+        bam_reheader.reheader(plain_gzip, str(tmp_path / 'out.bam'), lambda text: text)
+
+
+def test_missing_input_is_not_a_bgzf_error(tmp_path):
+    # the callers fall back to Picard on NotBgzfError only, anything else fails the task
+    with pytest.raises(OSError):
+        bam_reheader.reheader(str(tmp_path / 'missing.bam'), str(tmp_path / 'out.bam'), lambda text: text)
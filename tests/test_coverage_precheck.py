@@ -0,0 +1,126 @@
+import gzip
+import json
+import os
+import random
+import subprocess
+import sys
+import pytest
+import coverage_precheck
+from conftest import TOOLS_DIR
+from synthetic_data import BamWriter, random_read
+
+READ_LENGTH = 100
+
+
+def write_bam(path, pairs, filtered_every=0):
+    """ Returns the PF bases, with a QC failed and a secondary record in every 'filtered_every' pairs """
+    rnd = random.Random(1)
+    writer = BamWriter(open(path, 'wb'), '@HD\tVN:1.6\tSO:queryname\n@RG\tID:rg1\n')
+    pf_bases = 0
+    for i in range(pairs):
+        filtered = filtered_every and i % filtered_every == 0
+        for flag in (77, 141):
+            seq, qual = random_read(rnd, READ_LENGTH)
+            writer.write('read%06d' % i, flag | (0x200 if filtered else 0), seq, qual, 'rg1')
+            pf_bases += 0 if filtered else READ_LENGTH
+        if filtered:
+            writer.write('read%06d' % i, 77 | 0x100, *random_read(rnd, READ_LENGTH), rg='rg1')
+    writer.close()
+    return pf_bases
+
+
+def fastq_text(reads, seed=1, vendor_failed=False):
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(reads):
+        seq, qual = random_read(rnd, READ_LENGTH)
+        lines.append('@read%06d 1:%s:0:ACGT\n%s\n+\n%s\n' % (i, 'Y' if vendor_failed else 'N', seq, qual))
+    return ''.join(lines).encode()
+
+
+def test_bam_segments_count_the_pf_bases(tmp_path):
+    pf_bases = write_bam(str(tmp_path / 'in.bam'), 2000, filtered_every=4)
+    data = (tmp_path / 'in.bam').read_bytes()
+    segments, header_bytes = coverage_precheck.bam_segments(data)
+    assert len(segments) > 2
+    assert sum([b for _, b in segments]) == pf_bases
+    assert header_bytes + sum([c for c, _ in segments]) == len(data)
+
+
+def test_bam_sample_within_the_header():
+    with pytest.raises(Exception, match='does not reach past the BAM header'):
+        coverage_precheck.bam_segments(b'')
+    with pytest.raises(Exception, match='not a BGZF block'):
+        list(coverage_precheck.bgzf_blocks(gzip.compress(b'BAM\x01' + b'\0' * 64)))
+
+
+def test_fastq_segments_across_gzip_members():
+    data = gzip.compress(fastq_text(1500, seed=1)) + gzip.compress(fastq_text(1500, seed=2))
+    segments = coverage_precheck.fastq_segments(data)
+    # complete segments only, the reads of the last partial one are left out
+    assert segments and all([c == coverage_precheck.SEGMENT_BYTES for c, _ in segments])
+    assert len(segments) == len(data) // coverage_precheck.SEGMENT_BYTES
+    assert len(gzip.compress(fastq_text(1500, seed=1))) < coverage_precheck.SEGMENT_BYTES * (len(segments) - 1)
+    bases = sum([b for _, b in segments])
+    assert bases % READ_LENGTH == 0 and 0 < bases < 3000 * READ_LENGTH
+    # the same bases per compressed byte in the second member
+    rates = [b / c for c, b in segments]
+    assert max(rates) / min(rates) < 1.2
+
+
+def test_fastq_vendor_failed_reads_left_out():
+    segments = coverage_precheck.fastq_segments(gzip.compress(fastq_text(3000, vendor_failed=True)))
+    assert len(segments) > 1 and [b for _, b in segments] == [0] * len(segments)
+
+
+def test_estimate_bounds():
+    # rate 2.5 bases per byte, standard error 0.5
+    estimate, low, high = coverage_precheck.estimate_file([(100, 200), (0, 0), (100, 300)], 1000)
+    assert estimate == pytest.approx(2500)
+    assert low == pytest.approx(1000 * (2.5 - 3 * 0.5) * (1 - coverage_precheck.BIAS_MARGIN))
+    assert high == pytest.approx(1000 * (2.5 + 3 * 0.5) * (1 + coverage_precheck.BIAS_MARGIN))
+    assert coverage_precheck.estimate_file([(100, 0), (100, 1000)], 1000)[1] == 0
+    with pytest.raises(Exception, match='too few segments'):
+        coverage_precheck.estimate_file([(100, 200), (0, 0)], 1000)
+
+
+def test_head_of_the_file_bounds_its_pf_bases(tmp_path):
+    pf_bases = write_bam(str(tmp_path / 'in.bam'), 10000, filtered_every=10)
+    data = (tmp_path / 'in.bam').read_bytes()
+    segments, header_bytes = coverage_precheck.bam_segments(data[:len(data) // 5])
+    estimate, low, high = coverage_precheck.estimate_file(segments, len(data) - header_bytes)
+    assert low < pf_bases < high
+    assert abs(estimate - pf_bases) / pf_bases < coverage_precheck.BIAS_MARGIN
+
+
+def run_precheck(tmp_path, min_coverage, files):
+    task_dir = tmp_path / 'job' / 'task.coverage_precheck'
+    task_dir.mkdir(parents=True)
+    metadata = tmp_path / 'metadata.json'
+    metadata.write_text(json.dumps({'readGroups': [{'readGroupId': 'rg1', 'files': files}]}))
+    task = {'input': {'metadata_json': str(metadata), 'input_format': 'FASTQ', 'min_coverage': min_coverage,
+                      'sample_mb': 0.5}}
+    env = dict(os.environ)
+    env.pop('TASK_CACHE_DIR', None)
+    result = subprocess.run([sys.executable, os.path.join(TOOLS_DIR, 'coverage_precheck.py'), json.dumps(task)],
+                            cwd=str(task_dir), env=env, stderr=subprocess.PIPE, universal_newlines=True, timeout=60)
+    with open(str(task_dir / 'output.json')) as f:
+        return result, json.load(f)
+
+
+def test_sample_turned_down_before_the_download(tmp_path):
+    fastq = tmp_path / 'rg1_1.fq.gz'
+    fastq.write_bytes(gzip.compress(fastq_text(6000)))
+    entry = {'fileName': fastq.name, 'fileSize': fastq.stat().st_size, 'path': 'file://%s' % fastq}
+    result, output = run_precheck(tmp_path, 30, [entry])
+    assert result.returncode != 0
+    assert 'lower than 30, the files are not downloaded' in result.stderr
+    low, high = output['files'][0]['pf_bases_low'], output['files'][0]['pf_bases_high']
+    assert low < 6000 * READ_LENGTH < high
+
+
+def test_file_not_sampled_leaves_the_coverage_open(tmp_path):
+    entry = {'fileName': 'missing.fq.gz', 'fileSize': 1000, 'path': 'file://%s' % (tmp_path / 'missing.fq.gz')}
+    result, output = run_precheck(tmp_path, 30, [entry])
+    assert result.returncode == 0, result.stderr
+    assert output['coverage'] is None and 'error' in output['files'][0]
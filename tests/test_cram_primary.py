@@ -0,0 +1,47 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import pytest
+import local_runner
+import pipeline_bench
+import stub_common
+from conftest import TOOLS_DIR
+
+NO_COST = dict([(key, {'fixed_s': 0, 's_per_gb': 0}) for key in stub_common.DEFAULT_COST_MODEL])
+
+
+def task_output(job_dir, task):
+    with open(os.path.join(job_dir, 'task.%s' % task, 'output.json')) as f:
+        return json.load(f)
+
+
+def test_cram_primary_publishes_the_cram_and_crai(tmp_path, monkeypatch):
+    monkeypatch.setenv('BENCH_COST_MODEL', json.dumps(NO_COST))
+    args = argparse.Namespace(storage='local', input_format='BAM', read_length=50, repeat=1, cost_model=NO_COST,
+                              inputs={'cram_primary': True})
+    result = pipeline_bench.bench_config(local_runner.load_workflow(), str(tmp_path), 1, 200, args)
+    assert result['failed'] is None
+    job_dir, = glob.glob(str(tmp_path / 'jobs' / '*'))
+
+    merged = task_output(job_dir, 'bam_merge_sort_markdup')
+    assert merged['primary_output'] == merged['merged_output_cram']
+    assert merged['primary_index'] == merged['merged_output_crai']
+    assert os.path.isfile(merged['primary_output']) and os.path.isfile(merged['primary_index'])
+    assert not os.path.exists(merged['merged_output_bam']) and not os.path.exists(merged['merged_output_bai'])
+    # the QC read the CRAM, the sidecars the payload takes its checksums from are the CRAM's
+    for path in (merged['primary_output'], merged['primary_index']):
+        with open(path + '.checksum.json') as f:
+            assert json.load(f)['fileSize'] == os.path.getsize(path)
+    assert not glob.glob(os.path.join(os.path.dirname(merged['merged_output_bam']), '*.bam*.checksum.json'))
+
+
+def test_payload_file_types():
+    pytest.importorskip('overture_song_payload')
+    sys.path.insert(0, os.path.join(TOOLS_DIR, 'util_in_docker'))
+    import generate_song_payload
+    assert generate_song_payload.get_file_type('a.wgs.grch38.cram') == 'CRAM'
+    assert generate_song_payload.get_file_type('a.wgs.grch38.cram.crai') == 'CRAI'
+    assert generate_song_payload.get_file_type('a.wgs.grch38.bam') == 'BAM'
+    assert generate_song_payload.get_file_type('a.wgs.grch38.bam.bai') == 'BAI'
@@ -0,0 +1,89 @@
+import os
+import stat
+import subprocess
+import sys
+import time
+from conftest import TOOLS_DIR
+
+FAKE_DOCKER = '''#!/bin/sh
+# the repositories are "present" once pulled, a pull takes a second
+images="%s"
+case "$1" in
+  pull)
+    echo "$2" >> "$images/pulls.log"
+    sleep 1
+    repo=${2%%%%[:@]*}
+    touch "$images/$(echo "$repo" | tr '/' '_')"
+    ;;
+  image)
+    repo=${5%%%%[:@]*}
+    [ -f "$images/$(echo "$repo" | tr '/' '_')" ] || exit 1
+    echo '["'$repo'@sha256:0123"] sha256:4567'
+    ;;
+esac
+'''
+
+
+def fake_env(tmp_path):
+    images = tmp_path / 'images'
+    images.mkdir()
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    docker = bin_dir / 'docker'
+    docker.write_text(FAKE_DOCKER % images)
+    docker.chmod(docker.stat().st_mode | stat.S_IEXEC)
+    return dict(os.environ, PATH=os.pathsep.join([str(bin_dir), os.environ.get('PATH', '')]),
+                DOCKER_IMAGE_STATE_DIR=str(tmp_path / 'state'))
+
+
+def resolve(env, image, job_id='job1'):
+    return subprocess.Popen([sys.executable, os.path.join(TOOLS_DIR, 'docker_image.py'), image, '--job-id', job_id],
+                            cwd=os.path.dirname(env['DOCKER_IMAGE_STATE_DIR']), env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def pulls(tmp_path):
+    log = tmp_path / 'images' / 'pulls.log'
+    return log.read_text().split() if log.exists() else []
+
+
+def test_resolves_once(tmp_path):
+    env = fake_env(tmp_path)
+    first = resolve(env, 'quay.io/org/tool:1.0')
+    assert first.communicate()[0].strip() == 'quay.io/org/tool@sha256:0123'
+    second = resolve(env, 'quay.io/org/tool:1.0', job_id='job2')
+    assert second.communicate()[0].strip() == 'quay.io/org/tool@sha256:0123'
+    assert pulls(tmp_path) == ['quay.io/org/tool:1.0']
+
+
+def test_same_image_pulled_once_concurrently(tmp_path):
+    env = fake_env(tmp_path)
+    processes = [resolve(env, 'quay.io/org/tool:1.0', job_id='job%s' % i) for i in range(3)]
+    for p in processes:
+        assert p.wait() == 0
+    assert pulls(tmp_path) == ['quay.io/org/tool:1.0']
+
+
+def test_different_images_pulled_in_parallel(tmp_path):
+    env = fake_env(tmp_path)
+    started = time.time()
+    processes = [resolve(env, 'quay.io/org/tool%s:1.0' % i) for i in range(3)]
+    for p in processes:
+        assert p.wait() == 0
+    assert sorted(pulls(tmp_path)) == ['quay.io/org/tool%s:1.0' % i for i in range(3)]
+    # one pull takes a second, serialized pulls would take three
+    assert time.time() - started < 2.5
+
+
+def test_private_state_dir(tmp_path, monkeypatch):
+    import docker_image
+    monkeypatch.delenv('DOCKER_IMAGE_STATE_DIR', raising=False)
+    monkeypatch.setattr(docker_image.tempfile, 'gettempdir', lambda: str(tmp_path))
+    directory = docker_image.state_dir()
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    os.chmod(directory, 0o777)
+    try:
+        docker_image.state_dir()
+        assert False, 'a directory others can write to is not used'
+    except SystemExit:
+        pass
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+import pytest
+from conftest import TOOLS_DIR, STUBS_DIR
+
+sys.path.insert(0, STUBS_DIR)
+import object_store
+
+
+def metadata(files):
+    return {'readGroups': [{'submitterReadGroupId': 'rg1', 'files': files}]}
+
+
+def fastq(name, path, data, md5sum=None):
+    return {'fileName': name, 'fileType': 'FASTQ', 'path': path, 'fileSize': len(data),
+            'fileMd5sum': md5sum or hashlib.md5(data).hexdigest()}
+
+
+def store_object(store, object_id, name, data):
+    os.makedirs(os.path.join(store, object_id))
+    with open(os.path.join(store, object_id, name), 'wb') as f:
+        f.write(data)
+
+
+def run_download(tmp_path, files, cost_model=None, score_url=None):
+    with open(tmp_path / 'metadata.json', 'w') as f:
+        json.dump(metadata(files), f)
+    task_dir = tmp_path / 'job' / 'task.download'
+    task_dir.mkdir(parents=True)
+    env = dict(os.environ, PATH=os.pathsep.join([STUBS_DIR, os.environ.get('PATH', '')]),
+               BENCH_SCORE_STORE=str(tmp_path / 'store'), BENCH_SCORE_URL=score_url or '',
+               BENCH_COST_MODEL=json.dumps(cost_model or {}))
+    env.pop('TASK_CACHE_DIR', None)
+    task = {'input': {'metadata_json': str(tmp_path / 'metadata.json'), 'input_format': 'FASTQ'}}
+    started = time.time()
+    result = subprocess.run([sys.executable, os.path.join(TOOLS_DIR, 'download.py'), json.dumps(task)],
+                            cwd=str(task_dir), env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    return result, time.time() - started, task_dir
+
+
+def test_downloads_and_verifies(tmp_path):
+    store_object(str(tmp_path / 'store'), 'obj1', 'a_1.fq.gz', b'a' * 1000)
+    store_object(str(tmp_path / 'store'), 'obj2', 'a_2.fq.gz', b'b' * 1000)
+    result, _, task_dir = run_download(tmp_path, [
+        fastq('a_1.fq.gz', 'song://collaboratory/an1/obj1', b'a' * 1000),
+        fastq('a_2.fq.gz', 'song://collaboratory/an1/obj2', b'b' * 1000)
+    ], {'score-client': {'fixed_s': 0, 's_per_gb': 0}})
+    assert result.returncode == 0, result.stderr
+    with open(str(task_dir / 'output.json')) as f:
+        output = json.load(f)
+    assert [d['local_path'] for d in output['download_files']] == \
+        [str(task_dir / 'a_1.fq.gz'), str(task_dir / 'a_2.fq.gz')]
+
+
+@pytest.fixture
+def score_url(tmp_path, monkeypatch):
+    # the object store stub charges the cost model of this process
+    monkeypatch.setenv('BENCH_COST_MODEL', json.dumps({'score-client': {'fixed_s': 0, 's_per_gb': 0}}))
+    server = object_store.start(str(tmp_path / 'store'))
+    yield 'http://127.0.0.1:%s' % server.server_port
+    server.shutdown()
+
+
+def test_parts_fetched_over_http_are_hashed_in_order(tmp_path, score_url):
+    # three parts, the last one short
+    data = os.urandom(2 * 16 * 1024 * 1024 + 1000)
+    store_object(str(tmp_path / 'store'), 'obj1', 'a.bam', data)
+    result, _, task_dir = run_download(tmp_path, [
+        fastq('a.bam', 'song://collaboratory/an1/obj1', data)
+    ], {'score-client': {'fixed_s': 0, 's_per_gb': 0}}, score_url=score_url)
+    assert result.returncode == 0, result.stderr
+    assert (task_dir / 'a.bam').read_bytes() == data
+
+
+def test_object_larger_than_its_file_size(tmp_path, score_url):
+    store_object(str(tmp_path / 'store'), 'obj1', 'a.bam', b'a' * 1001)
+    result, _, _ = run_download(tmp_path, [
+        fastq('a.bam', 'song://collaboratory/an1/obj1', b'a' * 1000)
+    ], {'score-client': {'fixed_s': 0, 's_per_gb': 0}}, score_url=score_url)
+    assert result.returncode != 0
+    assert 'got 1001 bytes for the range 0-1000, expected 1000' in result.stderr
+
+
+def test_md5_mismatch(tmp_path):
+    store_object(str(tmp_path / 'store'), 'obj1', 'a_1.fq.gz', b'a' * 1000)
+    result, _, _ = run_download(tmp_path, [
+        fastq('a_1.fq.gz', 'song://collaboratory/an1/obj1', b'a' * 1000, md5sum='0' * 32)
+    ], {'score-client': {'fixed_s': 0, 's_per_gb': 0}})
+    assert result.returncode != 0
+    assert 'md5sum mismatch for a_1.fq.gz' in result.stderr
+
+
+def test_first_failure_stops_the_other_downloads(tmp_path):
+    # obj2 is missing and fails at once, obj1 would take 30 seconds
+    store_object(str(tmp_path / 'store'), 'obj1', 'a_1.fq.gz', b'a' * 1000)
+    result, seconds, _ = run_download(tmp_path, [
+        fastq('a_1.fq.gz', 'song://collaboratory/an1/obj1', b'a' * 1000),
+        fastq('a_2.fq.gz', 'song://collaboratory/an1/obj2', b'b' * 1000)
+    ], {'score-client': {'fixed_s': 30, 's_per_gb': 0}})
+    assert result.returncode != 0
+    assert 'Download object failed: obj2' in result.stderr
+    assert seconds < 20
+
+
+def test_missing_local_file(tmp_path):
+    result, _, _ = run_download(tmp_path, [
+        fastq('a_1.fq.gz', 'file://%s' % (tmp_path / 'missing' / 'a_1.fq.gz'), b'a' * 1000)
+    ])
+    assert result.returncode != 0
+    assert 'Local file not found: %s' % (tmp_path / 'missing' / 'a_1.fq.gz') in result.stderr
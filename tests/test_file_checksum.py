@@ -0,0 +1,45 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+from conftest import TOOLS_DIR
+import file_checksum
+
+
+def run(tmp_path, outputs, script):
+    return subprocess.run([sys.executable, os.path.join(TOOLS_DIR, 'file_checksum.py')] +
+                          [a for o in outputs for a in ('--output', str(o))] +
+                          ['--', sys.executable, '-c', script], cwd=str(tmp_path))
+
+
+def test_sidecar_of_the_final_content(tmp_path):
+    bam = tmp_path / 'out.bam'
+    # the writer rewrites its header once done, as a reader following it would miss
+    script = ('f = open(%r, "wb"); f.write(b"x" * 100 + b"y" * (20 * 1024 * 1024)); '
+              'f.seek(0); f.write(b"H" * 100); f.close()' % str(bam))
+    assert run(tmp_path, [bam, tmp_path / 'out.cram'], script).returncode == 0
+    data = bam.read_bytes()
+    assert file_checksum.read_sidecar(str(bam)) == (hashlib.md5(data).hexdigest(), len(data))
+    # not written by the command
+    assert not (tmp_path / 'out.cram.checksum.json').exists()
+
+
+def test_failed_command_leaves_no_sidecar(tmp_path):
+    bam = tmp_path / 'out.bam'
+    bam.write_bytes(b'old')
+    file_checksum.write_sidecar(str(bam), hashlib.md5(b'old').hexdigest(), 3)
+    script = 'import sys; open(%r, "wb").write(b"partial"); sys.exit(3)' % str(bam)
+    assert run(tmp_path, [bam], script).returncode == 3
+    assert not (tmp_path / 'out.bam.checksum.json').exists()
+
+
+def test_stale_sidecar_ignored(tmp_path):
+    bam = tmp_path / 'out.bam'
+    bam.write_bytes(b'data')
+    file_checksum.write_sidecar(str(bam), hashlib.md5(b'data').hexdigest(), 4)
+    with open(str(bam), 'ab') as f:
+        f.write(b'more')
+    assert file_checksum.read_sidecar(str(bam)) is None
+    with open(str(tmp_path / 'out.bam.checksum.json')) as s:
+        assert json.load(s)['fileSize'] == 4
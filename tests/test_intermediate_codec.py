@@ -0,0 +1,57 @@
+import json
+import os
+import struct
+import intermediate_codec
+import lane_scatter
+import synthetic_data
+from conftest import STUBS_DIR
+
+
+def test_level_from_the_environment(monkeypatch):
+    monkeypatch.delenv('INTERMEDIATE_COMPRESSION', raising=False)
+    assert intermediate_codec.picard_args() == ['COMPRESSION_LEVEL=1']
+    assert intermediate_codec.size_factor() == 1.15
+    monkeypatch.setenv('INTERMEDIATE_COMPRESSION', '0')
+    assert intermediate_codec.picard_args() == ['COMPRESSION_LEVEL=0']
+    assert intermediate_codec.size_factor() == 3.0
+    # levels at or above Picard's default are the size of its BAMs
+    monkeypatch.setenv('INTERMEDIATE_COMPRESSION', '6')
+    assert intermediate_codec.size_factor() == 1.0
+
+
+def test_piped_bams_stay_uncompressed(monkeypatch):
+    monkeypatch.setenv('INTERMEDIATE_COMPRESSION', '6')
+    assert intermediate_codec.picard_args(piped=True) == ['COMPRESSION_LEVEL=0']
+
+
+def deflate_block_types(path):
+    """ BTYPE of the first deflate block in each BGZF block of a BAM """
+    with open(path, 'rb') as f:
+        data = f.read()
+    types, pos = [], 0
+    while pos < len(data):
+        xlen = struct.unpack('<H', data[pos + 10:pos + 12])[0]
+        bsize = struct.unpack('<H', data[pos + 16:pos + 18])[0]
+        types.append((data[pos + 12 + xlen] >> 1) & 3)
+        pos += bsize + 1
+    return types
+
+
+def test_intermediate_bams_written_at_the_level(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('PATH', os.pathsep.join([STUBS_DIR, os.environ['PATH']]))
+    monkeypatch.setenv('BENCH_COST_MODEL', json.dumps({'SplitSamByNumberOfReads': {'fixed_s': 0, 's_per_gb': 0}}))
+    monkeypatch.delenv('NODE_BUDGET_DIR', raising=False)
+    lane = synthetic_data.write_bam(str(tmp_path / 'rg1.lane.bam'), ['rg1'], 100, 50)
+
+    sizes = {}
+    for level in ('0', '1'):
+        monkeypatch.setenv('INTERMEDIATE_COMPRESSION', level)
+        chunks, error = lane_scatter.split('picard.jar', [lane], str(tmp_path / ('chunks%s' % level)),
+                                           chunk_read_pairs=50)
+        assert error is None and len(chunks[lane]) == 2
+        # stored blocks at level 0, compressed ones otherwise, the EOF block aside
+        types = set(sum([deflate_block_types(c)[:-1] for c in chunks[lane]], []))
+        assert types == {0} if level == '0' else types and 0 not in types
+        sizes[level] = sum([os.path.getsize(c) for c in chunks[lane]])
+    assert sizes['0'] > sizes['1']
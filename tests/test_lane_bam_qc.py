@@ -0,0 +1,70 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import quality_yield_metrics
+from conftest import TOOLS_DIR, STUBS_DIR
+from synthetic_data import BamWriter, random_read
+
+NO_COST = {'PicardBatch': {'fixed_s': 0, 's_per_gb': 0},
+           'CollectQualityYieldMetrics': {'fixed_s': 0, 's_per_gb': 0}}
+
+
+def write_lane(path, pairs, compressible):
+    rnd = random.Random(1)
+    writer = BamWriter(open(path, 'wb'), '@HD\tVN:1.6\tSO:queryname\n@RG\tID:%s\n' % os.path.basename(path))
+    for i in range(pairs):
+        for flag in (77, 141):
+            seq, qual = ('A' * 150, 'I' * 150) if compressible else random_read(rnd, 150)
+            writer.write('read%06d' % i, flag, seq, qual, os.path.basename(path))
+    writer.close()
+    return path
+
+
+def run_qc(tmp_path, min_coverage, early_gate_slack=None):
+    task_dir = tmp_path / 'job' / 'task.lane_bam_qc'
+    task_dir.mkdir(parents=True)
+    # the largest lane, done first, has the fewest bases per byte
+    lanes = [write_lane(str(tmp_path / 'random.lane.bam'), 400, False),
+             write_lane(str(tmp_path / 'compressible.lane.bam'), 4000, True)]
+    assert os.path.getsize(lanes[0]) > os.path.getsize(lanes[1])
+    env = dict(os.environ, PATH=os.pathsep.join([STUBS_DIR, os.environ.get('PATH', '')]),
+               BENCH_COST_MODEL=json.dumps(NO_COST))
+    env.pop('TASK_CACHE_DIR', None)
+    task = {'input': {'picard_jar': 'picard.jar', 'lane_bams': lanes, 'min_coverage': min_coverage,
+                      'picard_workers': 1, 'early_gate_slack': early_gate_slack}}
+    result = subprocess.run([sys.executable, os.path.join(TOOLS_DIR, 'lane_bam_qc.py'), json.dumps(task)],
+                            cwd=str(task_dir), env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, timeout=120)
+    with open(str(task_dir / 'output.json')) as f:
+        return result, json.load(f)
+
+
+# both lanes: 4400 pairs of 2 x 150 bases
+COVERAGE = 4400 * 300 / quality_yield_metrics.GENOME_SIZE
+
+
+def test_no_early_gate_by_default(tmp_path):
+    # the random lane alone extrapolates to less than min_coverage, the sample still passes
+    result, output = run_qc(tmp_path, COVERAGE * 0.9)
+    assert result.returncode == 0, result.stderr
+    assert output['pass_cov']
+    assert abs(output['coverage'] - COVERAGE) < 1e-12
+    assert len(output['metrics']) == 2
+    assert 'coverage_upper_bound' not in output
+
+
+def test_early_gate_when_asked_for(tmp_path):
+    result, output = run_qc(tmp_path, COVERAGE * 0.9, early_gate_slack=1.5)
+    assert result.returncode != 0
+    assert 'with 1 of 2 lanes done' in result.stderr
+    assert output['metrics'] == [str(tmp_path / 'random.lane.bam.quality_yield_metrics.txt')]
+    assert output['coverage_upper_bound'] < COVERAGE * 0.9
+
+
+def test_low_coverage_fails_without_the_gate(tmp_path):
+    result, output = run_qc(tmp_path, COVERAGE * 1.1)
+    assert result.returncode != 0
+    assert 'Pass filter coverage lower than' in result.stderr
+    assert not output['pass_cov']
@@ -0,0 +1,68 @@
+import json
+import os
+import pytest
+import lane_scatter
+import synthetic_data
+from conftest import STUBS_DIR
+
+NO_COST = json.dumps({'SplitSamByNumberOfReads': {'fixed_s': 0, 's_per_gb': 0}, 'java': {'fixed_s': 0, 's_per_gb': 0}})
+
+
+@pytest.fixture
+def stub_java(tmp_path, monkeypatch):
+    # resource_usage.json of the split jobs goes to the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('PATH', os.pathsep.join([STUBS_DIR, os.environ['PATH']]))
+    monkeypatch.setenv('BENCH_COST_MODEL', NO_COST)
+    monkeypatch.delenv('NODE_BUDGET_DIR', raising=False)
+
+
+def bam_records(path):
+    with open(path, 'rb') as f:
+        records = synthetic_data.read_bam(f)
+        return next(records), list(records)
+
+
+def test_chunk_prefix():
+    assert lane_scatter.chunk_prefix('/job/task.revert_bam/WTSI_1.lane.bam') == 'WTSI_1.chunk'
+    assert lane_scatter.chunk_prefix('rg1.bam') == 'rg1.chunk'
+
+
+def test_lanes_split_into_read_pair_chunks(tmp_path, stub_java):
+    lanes = [synthetic_data.write_bam(str(tmp_path / ('WTSI_%s.lane.bam' % n)), ['WTSI:%s' % n], 25, 50)
+             for n in (1, 2)]
+    chunks, error = lane_scatter.split('picard.jar', lanes, str(tmp_path / 'chunks'), chunk_read_pairs=10, workers=2)
+    assert error is None
+    # the names of the aligned chunks come from these, unique across the lanes and in read order
+    assert dict([(lane, [os.path.relpath(c, str(tmp_path)) for c in chunks[lane]]) for lane in lanes]) == dict([
+        (lane, [os.path.join('chunks', 'WTSI_%s.chunk' % n, 'WTSI_%s.chunk_%04d.bam' % (n, i)) for i in (1, 2, 3)])
+        for n, lane in zip((1, 2), lanes)])
+
+    for lane in lanes:
+        header, records = bam_records(lane)
+        pairs = []
+        for chunk in chunks[lane]:
+            chunk_header, chunk_records = bam_records(chunk)
+            # the header of the lane and its read group go with every chunk
+            assert chunk_header == header
+            names = [r[0] for r in chunk_records]
+            assert names[::2] == names[1::2]
+            pairs.append(len(names) // 2)
+        assert pairs == [10, 10, 5]
+        assert sum([bam_records(c)[1] for c in chunks[lane]], []) == records
+
+
+def test_lane_of_one_chunk_is_not_split(tmp_path, stub_java):
+    lane = synthetic_data.write_bam(str(tmp_path / 'rg1.lane.bam'), ['rg1'], 10, 50)
+    chunk_dir = tmp_path / 'chunks' / 'rg1.chunk'
+    chunk_dir.mkdir(parents=True)
+    (chunk_dir / 'rg1.chunk_0009.bam').write_bytes(b'left from an earlier run')
+    chunks, error = lane_scatter.split('picard.jar', [lane], str(tmp_path / 'chunks'), chunk_read_pairs=10)
+    assert (chunks, error) == ({lane: []}, None)
+    assert not chunk_dir.exists()
+
+
+def test_failed_split(tmp_path, stub_java):
+    chunks, error = lane_scatter.split('picard.jar', [str(tmp_path / 'missing.lane.bam')], str(tmp_path / 'chunks'))
+    assert chunks is None
+    assert error.startswith('splitting missing.lane.bam failed with')
@@ -0,0 +1,94 @@
+import subprocess
+import threading
+import time
+import batch_runner
+import node_budget
+import synthetic_data
+
+
+def test_request_larger_than_the_budget(tmp_path):
+    budget = str(tmp_path)
+    node_budget.configure(budget, cpus=1, mem=2, scratch=100)
+    # held by batch_runner.py for as long as the aliquot runs
+    aliquot = node_budget.try_acquire(budget, 'job1', scratch=40)
+    assert aliquot
+
+    lane = node_budget.try_acquire(budget, 'job1', cpus=4, mem=8)
+    assert lane
+    assert node_budget.try_acquire(budget, 'job2', cpus=1, mem=1) is None
+    node_budget.release(budget, lane)
+    assert node_budget.try_acquire(budget, 'job2', cpus=1, mem=1)
+
+
+def test_waiting_job_goes_first(tmp_path):
+    budget = str(tmp_path)
+    node_budget.configure(budget, cpus=4, mem=16, scratch=100)
+    first = node_budget.try_acquire(budget, 'job1', cpus=2, mem=4)
+    node_budget.try_acquire(budget, 'job1', cpus=2, mem=4)
+    assert node_budget.try_acquire(budget, 'job2', cpus=2, mem=4) is None
+
+    node_budget.release(budget, first)
+    # job2 holds fewer grants and its request fits now
+    assert node_budget.try_acquire(budget, 'job1', cpus=2, mem=4) is None
+    assert node_budget.try_acquire(budget, 'job2', cpus=2, mem=4)
+
+
+def test_totals(tmp_path, monkeypatch):
+    node_budget.configure(str(tmp_path), cpus=3, mem=5, scratch=100)
+    monkeypatch.setenv('NODE_BUDGET_DIR', str(tmp_path))
+    assert node_budget.totals() == (3, 5)
+    node_budget.try_acquire(str(tmp_path), 'job1', cpus=1, mem=2)
+    assert node_budget.task_mem_gb() == 3
+
+
+def test_waiting_job_that_stopped_asking_does_not_hold_back(tmp_path, monkeypatch):
+    budget = str(tmp_path)
+    node_budget.configure(budget, cpus=4, mem=16, scratch=100)
+    first = node_budget.try_acquire(budget, 'job1', cpus=2, mem=4)
+    node_budget.try_acquire(budget, 'job1', cpus=2, mem=4)
+    assert node_budget.try_acquire(budget, 'job2', cpus=2, mem=4) is None
+    node_budget.release(budget, first)
+
+    now = time.time()
+    monkeypatch.setattr(node_budget.time, 'time', lambda: now + node_budget.WAIT_EXPIRY + 1)
+    assert node_budget.try_acquire(budget, 'job1', cpus=2, mem=4)
+
+
+def test_grants_of_exited_processes_are_reclaimed(tmp_path):
+    budget = str(tmp_path)
+    node_budget.configure(budget, cpus=2, mem=8, scratch=100)
+    lane = subprocess.Popen(['true'])
+    lane.wait()
+    assert node_budget.try_acquire(budget, 'job1', cpus=2, mem=8, pid=lane.pid)
+    assert node_budget.try_acquire(budget, 'job2', cpus=2, mem=8)
+
+
+def test_acquire_waits_for_a_release(tmp_path):
+    budget = str(tmp_path)
+    node_budget.configure(budget, cpus=2, mem=8, scratch=100)
+    held = node_budget.try_acquire(budget, 'job1', cpus=2, mem=8)
+    timer = threading.Timer(0.3, node_budget.release, (budget, held))
+    timer.start()
+    started = time.time()
+    assert node_budget.acquire(budget, 'job2', cpus=1, mem=1, poll_interval=0.05)
+    assert time.time() - started >= 0.3
+    timer.join()
+
+
+
+def test_aliquot_holds_its_scratch_while_it_runs(tmp_path, monkeypatch):
+    budget = str(tmp_path / 'budget')
+    node_budget.configure(budget, cpus=4, mem=16, scratch=100)
+    metadata_yaml = synthetic_data.generate(str(tmp_path), lanes=1, reads=100)
+    held = []
+
+    def run_job(workflow, inputs, job_dir, env, runner=None):
+        held.append(node_budget.update(budget, node_budget.free)['scratch'])
+        return [{'task': 'download', 'returncode': 0}]
+    monkeypatch.setattr(batch_runner.local_runner, 'run_job', run_job)
+
+    aliquot = {'metadata_yaml': metadata_yaml, 'aliquot_id': 'aliquot1'}
+    batch_runner.run_aliquot(aliquot, {}, {}, str(tmp_path / 'batch'), {}, budget)
+    assert aliquot['status'] == 'succeeded'
+    assert held == [100 - aliquot['scratch_gb']]
+    assert node_budget.update(budget, node_budget.free)['scratch'] == 100
@@ -0,0 +1,62 @@
+import hashlib
+import os
+import sys
+import pytest
+from conftest import STUBS_DIR
+import object_upload
+from song_client import RequestError
+
+sys.path.insert(0, STUBS_DIR)
+import object_store
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(object_upload, 'PART_SIZE', 1024)
+    server = object_store.start(str(tmp_path / 'store'))
+    yield server
+    server.shutdown()
+
+
+def client(server, retries=0):
+    return object_upload.ObjectStoreClient('http://127.0.0.1:%s' % server.server_port, token='t',
+                                           retries=retries, backoff=0.01)
+
+
+def test_resumed_stage_sends_only_missing_parts(tmp_path, store):
+    bam = tmp_path / 'out.bam'
+    data = os.urandom(10 * 1024 + 100)
+    bam.write_bytes(data)
+
+    store.state.fail_after_parts = 4
+    with pytest.raises(RequestError):
+        object_upload.stage(client(store), str(bam), workers=1)
+    assert store.state.parts_received == 4
+
+    store.state.fail_after_parts = None
+    object_upload.commit(client(store), str(bam), 'obj1', hashlib.md5(data).hexdigest(), workers=3)
+    assert store.state.parts_received == 11
+    assert (tmp_path / 'store' / 'obj1' / 'out.bam').read_bytes() == data
+    assert not os.path.exists(object_upload.state_file(str(bam), client(store).url))
+
+
+def test_changed_file_staged_again(tmp_path, store):
+    bam = tmp_path / 'out.bam'
+    bam.write_bytes(os.urandom(3 * 1024))
+    first = object_upload.stage(client(store), str(bam))
+    data = os.urandom(2 * 1024)
+    bam.write_bytes(data)
+    os.utime(str(bam), ns=(0, 0))
+
+    object_upload.commit(client(store), str(bam), 'obj1', hashlib.md5(data).hexdigest())
+    assert not os.path.isdir(str(tmp_path / 'store' / 'uploads' / first['uploadId']))
+    assert (tmp_path / 'store' / 'obj1' / 'out.bam').read_bytes() == data
+
+
+def test_retried_through_failures(tmp_path, store):
+    bam = tmp_path / 'out.bam'
+    data = os.urandom(8 * 1024)
+    bam.write_bytes(data)
+    store.state.fail_rate = 0.3
+    object_upload.commit(client(store, retries=20), str(bam), 'obj1', hashlib.md5(data).hexdigest())
+    assert (tmp_path / 'store' / 'obj1' / 'out.bam').read_bytes() == data
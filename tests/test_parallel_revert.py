@@ -0,0 +1,117 @@
+import json
+import os
+import subprocess
+import sys
+import node_budget
+import parallel_revert
+import resource_scheduler
+import synthetic_data
+from conftest import TOOLS_DIR, STUBS_DIR
+
+NO_COST = json.dumps({'java': {'fixed_s': 0, 's_per_gb': 0}})
+READ_GROUPS = ['WTSI:3', 'WTSI:1', 'WTSI:2']
+
+
+def logging_java(tmp_path):
+    """ A java on PATH logging each command line, and the partitions left when a sort starts """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    with open(str(bin_dir / 'java'), 'w') as f:
+        f.write('#!/bin/sh\necho "$*" >> %s\n' % (tmp_path / 'java.log') +
+                'case "$*" in *SORT_ORDER=queryname*) for a; do case "$a" in I=*) partition="${a#I=}";; esac; done\n'
+                '  echo "left: $(ls "$(dirname "$partition")" | tr "\\n" " ")" >> %s;; esac\n' % (tmp_path / 'java.log') +
+                'exec %s "$@"\n' % os.path.join(STUBS_DIR, 'java'))
+    os.chmod(str(bin_dir / 'java'), 0o755)
+    return str(bin_dir)
+
+
+def test_partitions_go_as_their_sorts_succeed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('PATH', os.pathsep.join([logging_java(tmp_path), STUBS_DIR, os.environ['PATH']]))
+    monkeypatch.setenv('BENCH_COST_MODEL', NO_COST)
+    bam = synthetic_data.write_bam(str(tmp_path / 'in.bam'), READ_GROUPS, 20, 50)
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+
+    lane_bams, error = parallel_revert.run('picard.jar', bam, ['I=%s' % bam, 'SANITIZE=true', 'SORT_ORDER=queryname'],
+                                           str(out_dir), 1, mem=2)
+    assert error is None
+    assert [os.path.basename(b) for b in lane_bams] == ['WTSI_1.lane.bam', 'WTSI_2.lane.bam', 'WTSI_3.lane.bam']
+    with open(str(tmp_path / 'java.log')) as f:
+        left = [l.split()[1:] for l in f.read().splitlines() if l.startswith('left:')]
+    # one worker, the sorts run one after the other
+    assert [len(partitions) for partitions in left] == [3, 2, 1]
+    assert sorted(os.listdir(str(out_dir))) == ['WTSI_1.lane.bam', 'WTSI_2.lane.bam', 'WTSI_3.lane.bam']
+
+
+def test_sorts_get_the_memory_the_node_budget_has_free(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('PATH', os.pathsep.join([logging_java(tmp_path), STUBS_DIR, os.environ['PATH']]))
+    monkeypatch.setenv('BENCH_COST_MODEL', NO_COST)
+    budget = str(tmp_path / 'budget')
+    node_budget.configure(budget, cpus=4, mem=11, scratch=100)
+    monkeypatch.setenv('NODE_BUDGET_DIR', budget)
+    node_budget.try_acquire(budget, 'other', cpus=1, mem=4)
+    bam = synthetic_data.write_bam(str(tmp_path / 'in.bam'), READ_GROUPS[:2], 20, 50)
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+
+    _, error = parallel_revert.run('picard.jar', bam, [], str(out_dir), 2)
+    assert error is None
+    with open(str(tmp_path / 'java.log')) as f:
+        sorts = [l.split() for l in f.read().splitlines() if 'SORT_ORDER=queryname' in l and not l.startswith('left:')]
+    # 7 GB free, split between the two sorts of about the same size
+    assert sorted([[a for a in s if a.startswith(('-Xmx', 'MAX_RECORDS_IN_RAM'))] for s in sorts]) == \
+        [['-Xmx3g', 'MAX_RECORDS_IN_RAM=%s' % (3 * parallel_revert.RECORDS_PER_GB)]] * 2
+
+
+def test_task_mem_gb(tmp_path, monkeypatch):
+    monkeypatch.delenv('NODE_BUDGET_DIR', raising=False)
+    monkeypatch.setattr(resource_scheduler, 'available_mem_gb', lambda: 7)
+    assert node_budget.task_mem_gb() == 7
+
+    budget = str(tmp_path)
+    node_budget.configure(budget, cpus=2, mem=8, scratch=100)
+    monkeypatch.setenv('NODE_BUDGET_DIR', budget)
+    assert node_budget.task_mem_gb() == 8
+    node_budget.try_acquire(budget, 'job1', cpus=2, mem=8)
+    # nothing left, a task still gets to run its processes
+    assert node_budget.task_mem_gb() == 1
+
+
+def revert_bam(tmp_path, name, bam, revert_workers):
+    metadata = {'aliquotId': 'aliquot1', 'files': [{'path': 'file://' + bam, 'fileName': 'in.bam'}]}
+    with open(str(tmp_path / 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+    # the BAM is not the first download of the job
+    download_files = [{'path': 'file:///other/in.bam', 'name': 'in.bam', 'local_path': '/other/in.bam'},
+                      {'path': 'file://' + bam, 'name': 'in.bam', 'local_path': bam}]
+    task_dir = tmp_path / name / 'task.revert_bam'
+    task_dir.mkdir(parents=True)
+    env = dict(os.environ, PATH=os.pathsep.join([STUBS_DIR, os.environ.get('PATH', '')]), BENCH_COST_MODEL=NO_COST)
+    for var in ('TASK_CACHE_DIR', 'NODE_BUDGET_DIR'):
+        env.pop(var, None)
+    task = {'input': {'metadata_json': str(tmp_path / 'metadata.json'), 'picard_jar': 'picard.jar',
+                      'input_format': 'BAM', 'download_files': download_files, 'revert_workers': revert_workers}}
+    subprocess.run([sys.executable, os.path.join(TOOLS_DIR, 'revert_bam.py'), json.dumps(task)], cwd=str(task_dir),
+                   env=env, check=True, stdout=subprocess.PIPE, timeout=120)
+    with open(str(task_dir / 'output.json')) as f:
+        return json.load(f)['bams']
+
+
+def records(bam):
+    with open(bam, 'rb') as f:
+        return [r for r in synthetic_data.read_bam(f) if isinstance(r, tuple)]
+
+
+def test_parallel_lane_bams_as_the_single_revert_sam(tmp_path):
+    bam = synthetic_data.write_bam(str(tmp_path / 'in.bam'), READ_GROUPS, 20, 50)
+    single = revert_bam(tmp_path, 'single', bam, 1)
+    parallel = revert_bam(tmp_path, 'parallel', bam, 3)
+
+    assert [os.path.basename(b) for b in single] == ['WTSI_1.lane.bam', 'WTSI_2.lane.bam', 'WTSI_3.lane.bam']
+    assert [os.path.basename(b) for b in parallel] == [os.path.basename(b) for b in single]
+    for s, p in zip(single, parallel):
+        assert records(s) == records(p)
+        assert len(records(s)) == 40
+    assert not os.path.exists(str(tmp_path / 'parallel' / 'task.revert_bam' / 'revert_scratch'))
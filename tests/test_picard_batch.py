@@ -0,0 +1,89 @@
+import json
+import os
+import pytest
+import picard_batch
+import synthetic_data
+from conftest import STUBS_DIR
+
+NO_COST = json.dumps({'PicardBatch': {'fixed_s': 0, 's_per_gb': 0}, 'java': {'fixed_s': 0, 's_per_gb': 0}})
+
+
+@pytest.fixture
+def java(tmp_path, monkeypatch):
+    """ The java stub behind a wrapper logging each command line, returns the log """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('BENCH_COST_MODEL', NO_COST)
+    monkeypatch.delenv('NODE_BUDGET_DIR', raising=False)
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    with open(str(bin_dir / 'java'), 'w') as f:
+        f.write('#!/bin/sh\necho "$*" >> %s\n' % (tmp_path / 'java.log') +
+                # BATCH_DIES: a PicardBatch JVM that exits without answering
+                'case "$*" in *PicardBatch*) [ -n "$BATCH_DIES" ] && exit 1;; esac\n'
+                'exec %s "$@"\n' % os.path.join(STUBS_DIR, 'java'))
+    os.chmod(str(bin_dir / 'java'), 0o755)
+    monkeypatch.setenv('PATH', os.pathsep.join([str(bin_dir), os.environ['PATH']]))
+
+    def command_lines():
+        with open(str(tmp_path / 'java.log')) as f:
+            return f.read().splitlines()
+    return command_lines
+
+
+def invocations(tmp_path, lanes):
+    result = []
+    for n in range(lanes):
+        bam = synthetic_data.write_bam(str(tmp_path / ('rg%s.bam' % n)), ['rg%s' % n], 10, 50)
+        result.append(['CollectQualityYieldMetrics', 'I=%s' % bam, 'O=%s.metrics.txt' % bam])
+    return result
+
+
+def test_invocations_share_the_jvms(tmp_path, java):
+    args = invocations(tmp_path, 5)
+    results = picard_batch.run_batch('picard.jar', args, workers=2, mem_gb=8)
+    assert [r['args'] for r in results] == args
+    assert [r['returncode'] for r in results] == [0] * 5
+    assert [r['outputs'] for r in results] == [[a[2][len('O='):]] for a in args]
+    # two JVMs for the five invocations, each with its share of the memory as heap
+    assert len(java()) == 2
+    assert all(['-Xmx3072m' in line.split() and 'PicardBatch' in line for line in java()])
+
+
+def test_failed_invocation_keeps_its_status(tmp_path, java):
+    args = invocations(tmp_path, 2)
+    args.insert(1, ['CollectQualityYieldMetrics', 'I=%s' % (tmp_path / 'missing.bam'), 'O=missing.txt'])
+    results = picard_batch.run_batch('picard.jar', args, workers=1, mem_gb=8)
+    assert [r['returncode'] for r in results] == [0, 1, 0]
+    assert results[1]['outputs'] == []
+
+
+def test_dead_jvm_falls_back_to_java_jar(tmp_path, java, monkeypatch):
+    monkeypatch.setenv('BATCH_DIES', '1')
+    args = invocations(tmp_path, 3)
+    results = picard_batch.run_batch('picard.jar', args, workers=1, mem_gb=8)
+    assert [r['returncode'] for r in results] == [0] * 3
+    assert [line.split()[-3:] for line in java() if '-jar' in line] == [[a[0], a[1], a[2]] for a in args]
+
+
+def test_abort_from_on_result(tmp_path, java):
+    args = invocations(tmp_path, 4)
+    results = picard_batch.run_batch('picard.jar', args, workers=1, mem_gb=8, on_result=lambda i, r: i == 1)
+    assert [r is not None for r in results] == [True, True, False, False]
+
+
+def test_heap_opts():
+    assert picard_batch.heap_opts(['-Xmx2g'], 4, 64) == []
+    assert picard_batch.heap_opts([], 2, 8) == ['-Xmx3072m']
+    assert picard_batch.heap_opts([], 1, 64) == ['-Xmx%sm' % (picard_batch.MAX_HEAP_GB * 1024)]
+    assert picard_batch.heap_opts([], 16, 1) == ['-Xmx256m']
+
+
+def test_launcher_not_loaded_from_a_shared_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(picard_batch.tempfile, 'tempdir', str(tmp_path))
+    shared = tmp_path / ('picard_batch-%s' % os.getuid())
+    shared.mkdir()
+    os.chmod(str(shared), 0o777)
+    assert picard_batch.user_dir() is None
+    assert picard_batch.launcher_cmd('picard.jar', []) == ['java', '-cp', 'picard.jar', picard_batch.LAUNCHER_SOURCE]
+    os.chmod(str(shared), 0o700)
+    assert picard_batch.user_dir() == str(shared)
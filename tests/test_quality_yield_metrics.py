@@ -0,0 +1,52 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import quality_yield_metrics
+from conftest import TOOLS_DIR, STUBS_DIR
+from synthetic_data import read_bam, write_fastq_pair
+
+
+def serve(tmp_path, fastqs):
+    """ Starts the FIFO server of a streamed lane, returns it with its FIFOs once they exist """
+    fifos = [str(tmp_path / ('lane.%s.fastq' % mate)) for mate in (1, 2)]
+    server = subprocess.Popen([sys.executable, os.path.join(TOOLS_DIR, 'quality_yield_metrics.py'),
+                               str(tmp_path / 'lane.metrics.txt')] +
+                              ['%s=%s' % pair for pair in zip(fastqs, fifos)], stderr=subprocess.PIPE,
+                              universal_newlines=True)
+    while not all([os.path.exists(f) for f in fifos]):
+        assert server.poll() is None
+        time.sleep(0.05)
+    return server, fifos
+
+
+def test_metrics_of_the_fastqs_fed_to_fastq_to_sam(tmp_path):
+    # larger than a pipe buffer: the encoding guess of FastqToSam stops reading in the middle
+    fastqs = write_fastq_pair(str(tmp_path / 'rg1'), 3000, 150)
+    server, fifos = serve(tmp_path, fastqs)
+    env = dict(os.environ, BENCH_COST_MODEL=json.dumps({'java': {'fixed_s': 0, 's_per_gb': 0}}))
+    subprocess.run([os.path.join(STUBS_DIR, 'java'), '-jar', 'picard.jar', 'FastqToSam', 'FASTQ=%s' % fifos[0],
+                    'FASTQ2=%s' % fifos[1], 'READ_GROUP_NAME=rg1', 'SAMPLE_NAME=s1',
+                    'OUTPUT=%s' % (tmp_path / 'lane.bam')], env=env, check=True, timeout=60)
+    server.send_signal(signal.SIGUSR1)
+    assert server.wait(timeout=60) == 0, server.stderr.read()
+
+    with open(str(tmp_path / 'lane.bam'), 'rb') as f:
+        assert len([r for r in read_bam(f) if isinstance(r, tuple)]) == 6000
+    metrics = quality_yield_metrics.load_metrics(str(tmp_path / 'lane.metrics.txt'))
+    assert metrics == dict([(k, str(v)) for k, v in quality_yield_metrics.fastq_metrics(fastqs).items()])
+    assert metrics['PF_BASES'] == str(6000 * 150)
+    assert not [f for f in os.listdir(str(tmp_path)) if '.fastq' in f]
+
+
+def test_no_metrics_without_a_complete_pass(tmp_path):
+    fastqs = write_fastq_pair(str(tmp_path / 'rg1'), 3000, 150)
+    server, fifos = serve(tmp_path, fastqs)
+    with open(fifos[0], 'rb') as f:
+        f.read(2)
+    server.send_signal(signal.SIGUSR1)
+    assert server.wait(timeout=60) != 0
+    assert 'Not read to the end: %s and %s' % tuple(fastqs) in server.stderr.read()
+    assert not os.path.exists(str(tmp_path / 'lane.metrics.txt'))
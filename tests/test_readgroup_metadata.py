@@ -0,0 +1,85 @@
+import json
+import os
+import subprocess
+import sys
+import time
+import pytest
+import bam_reheader
+import readgroup_metadata
+import synthetic_data
+from conftest import TOOLS_DIR, STUBS_DIR
+
+READ_GROUPS = [
+    {'readGroupIdInFile': 'WTSI:1', 'readGroupId': 'WTSI:1', 'libraryName': 'lib1', 'sequencingPlatform': 'ILLUMINA',
+     'platformUnit': 'WTSI:1#1', 'sequencingCenter': 'WTSI', 'sequencingDate': '2014-12-12T10:11:12.345-05:00',
+     'insertSize': 400},
+    {'readGroupIdInFile': 'WTSI:2', 'readGroupId': 'WTSI:2', 'libraryName': 'lib1', 'sequencingPlatform': 'ILLUMINA',
+     'platformUnit': 'WTSI:2#1', 'sequencingDate': '2015-01-02', 'insertSize': 400}
+]
+
+
+@pytest.fixture
+def utc(monkeypatch):
+    monkeypatch.setenv('TZ', 'UTC')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_dt_as_add_or_replace_read_groups_writes_it(utc):
+    assert readgroup_metadata.rg_date('2015-01-02') == '2015-01-02T00:00:00+0000'
+    assert readgroup_metadata.rg_date('2014-12-12T10:11:12.345-05:00') == '2014-12-12T15:11:12+0000'
+    assert readgroup_metadata.rg_date('2014-12-12T10:11Z') == '2014-12-12T10:11:00+0000'
+    assert readgroup_metadata.rg_header_line({'ID': 'rg1', 'SM': 's1', 'DT': '2015-01-02', 'LB': 'lib1'}) == \
+        '@RG\tID:rg1\tLB:lib1\tSM:s1\tDT:2015-01-02T00:00:00+0000'
+    with pytest.raises(ValueError):
+        readgroup_metadata.rg_date('12/12/2014')
+
+
+def run_tool(tool, task_dir, inputs):
+    os.makedirs(task_dir)
+    env = dict(os.environ, PATH=os.pathsep.join([STUBS_DIR, os.environ.get('PATH', '')]), TZ='UTC',
+               BENCH_COST_MODEL=json.dumps({'java': {'fixed_s': 0, 's_per_gb': 0}}))
+    env.pop('TASK_CACHE_DIR', None)
+    subprocess.run([sys.executable, os.path.join(TOOLS_DIR, tool), json.dumps({'input': inputs})],
+                   cwd=task_dir, env=env, check=True, stdout=subprocess.PIPE, timeout=120)
+    with open(os.path.join(task_dir, 'output.json')) as f:
+        return json.load(f)
+
+
+def headers(bams):
+    result = {}
+    for bam in bams:
+        with open(bam, 'rb') as f:
+            result[os.path.basename(bam)] = bam_reheader.read_header(f)[0]
+    return result
+
+
+def test_fused_revert_writes_the_lane_bams_of_the_picard_chain(tmp_path):
+    bam = synthetic_data.write_bam(str(tmp_path / 'in.bam'), ['WTSI:1', 'WTSI:2'], 50, 100)
+    metadata = {'aliquotId': 'aliquot1', 'study': 'PACA-CA', 'donorSubmitterId': 'd1', 'specimenSubmitterId': 'sp1',
+                'sampleSubmitterId': 'sa1', 'specimenType': 'Normal - blood derived', 'libraryStrategy': 'WGS',
+                'useCntl': 'N/A', 'files': [{'path': 'file://' + bam, 'fileName': 'in.bam', 'readGroups': READ_GROUPS}]}
+    with open(str(tmp_path / 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+    common = {'metadata_json': str(tmp_path / 'metadata.json'), 'picard_jar': 'picard.jar', 'input_format': 'BAM'}
+
+    fused = run_tool('revert_bam.py', str(tmp_path / 'fused' / 'task.revert_bam'), dict(
+        common, fused=True, download_files=[{'path': 'file://' + bam, 'name': 'in.bam', 'local_path': bam}]))
+
+    # RevertSam by read group, AddOrReplaceReadGroups, AddCommentsToBam
+    by_rg = tmp_path / 'chain' / 'reverted'
+    os.makedirs(str(by_rg))
+    subprocess.run([os.path.join(STUBS_DIR, 'java'), '-jar', 'picard.jar', 'RevertSam', 'I=%s' % bam,
+                    'OUTPUT_BY_READGROUP=true', 'O=%s' % by_rg], check=True,
+                   env=dict(os.environ, BENCH_COST_MODEL=json.dumps({'java': {'fixed_s': 0, 's_per_gb': 0}})))
+    replaced = run_tool('replace_readgroup.py', str(tmp_path / 'chain' / 'task.replace_readgroup'),
+                        dict(common, unaligned_by_rg_dir=str(by_rg)))
+    chain = run_tool('add_comment.py', str(tmp_path / 'chain' / 'task.add_comment'),
+                     dict(common, unaligned_rg_replace_dir=replaced['unaligned_rg_replace_dir']))
+
+    assert [os.path.basename(b) for b in fused['bams']] == ['WTSI_1.lane.bam', 'WTSI_2.lane.bam']
+    assert [os.path.basename(b) for b in chain['bams']] == ['WTSI_1.lane.bam', 'WTSI_2.lane.bam']
+    assert headers(fused['bams']) == headers(chain['bams'])
+    assert '\tDT:2014-12-12T15:11:12+0000' in headers(fused['bams'])['WTSI_1.lane.bam']
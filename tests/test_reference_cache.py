@@ -0,0 +1,67 @@
+import os
+import reference_cache
+
+
+def write(path, data):
+    with open(str(path), 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def reference(job_dir, data=b'ACGT' * 1024 * 1024):
+    """ The reference as a job downloads it, a fresh copy in its own directory """
+    job_dir.mkdir()
+    return [write(job_dir / 'genome.fa.gz', data), write(job_dir / 'genome.fa.gz.fai', b'chr1\t4194304\n')]
+
+
+def test_fresh_copy_of_a_reference_is_not_hashed_again(tmp_path, monkeypatch):
+    cache = str(tmp_path / 'cache')
+    hashed = []
+    md5_file = reference_cache.md5_file
+    monkeypatch.setattr(reference_cache, 'md5_file', lambda path, *a: hashed.append(path) or md5_file(path, *a))
+
+    bundle1, lease1 = reference_cache.acquire_bundle(cache, reference(tmp_path / 'job1'))
+    assert len(hashed) == 2
+    bundle2, lease2 = reference_cache.acquire_bundle(cache, reference(tmp_path / 'job2'))
+    assert len(hashed) == 2
+    assert bundle1 == bundle2
+    assert sorted(os.listdir(bundle1)) == ['genome.fa.gz', 'genome.fa.gz.fai']
+    reference_cache.release(lease1)
+    reference_cache.release(lease2)
+
+
+def test_changed_content_is_another_object(tmp_path):
+    cache = str(tmp_path / 'cache')
+    bundle1, lease1 = reference_cache.acquire_bundle(cache, reference(tmp_path / 'job1'))
+    # same name and size, a sampled block differs
+    data = bytearray(b'ACGT' * 1024 * 1024)
+    data[-10:] = b'N' * 10
+    bundle2, lease2 = reference_cache.acquire_bundle(cache, reference(tmp_path / 'job2', bytes(data)))
+    assert bundle1 != bundle2
+    with open(os.path.join(bundle2, 'genome.fa.gz'), 'rb') as f:
+        assert f.read() == bytes(data)
+    assert len(os.listdir(os.path.join(cache, 'objects'))) == 3
+    reference_cache.release(lease1)
+    reference_cache.release(lease2)
+
+
+def test_eviction_while_a_bundle_is_assembled(tmp_path, monkeypatch):
+    cache = str(tmp_path / 'cache')
+    _, lease = reference_cache.acquire_bundle(cache, reference(tmp_path / 'job1'))
+    reference_cache.release(lease)
+
+    # another job evicts everything not in use right after each object was added or found
+    stage_object = reference_cache.stage_object
+
+    def stage_then_evict(*args):
+        digest = stage_object(*args)
+        reference_cache.evict(cache, 0)
+        return digest
+    monkeypatch.setattr(reference_cache, 'stage_object', stage_then_evict)
+
+    files = reference(tmp_path / 'job2')
+    bundle, lease = reference_cache.acquire_bundle(cache, files)
+    for f in files:
+        with open(f, 'rb') as source, open(os.path.join(bundle, os.path.basename(f)), 'rb') as cached:
+            assert source.read() == cached.read()
+    reference_cache.release(lease)
@@ -0,0 +1,75 @@
+import time
+import pytest
+import resource_scheduler
+
+
+@pytest.fixture
+def log(tmp_path, monkeypatch):
+    # resource_usage.json of the jobs goes to the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv('NODE_BUDGET_DIR', raising=False)
+    return tmp_path / 'jobs.log'
+
+
+def job(log, name, cpus, mem, seconds=0.2, exit_status=0, **fields):
+    return dict({'name': name, 'cpus': cpus, 'mem': mem,
+                 'cmd': ['sh', '-c', 'echo start %s >> %s; sleep %s; echo end %s >> %s; exit %s'
+                         % (name, log, seconds, name, log, exit_status)]}, **fields)
+
+
+def most_at_once(log):
+    running = most = 0
+    with open(str(log)) as f:
+        for line in f:
+            running += 1 if line.startswith('start') else -1
+            most = max(most, running)
+    return most
+
+
+def test_split_budget_by_size():
+    assert resource_scheduler.split_budget([], 8, 32) == []
+    # shares of the budget proportional to the sizes
+    assert resource_scheduler.split_budget([3, 1], 8, 32) == [(6, 24), (2, 8)]
+    # two of the largest side by side, the smaller lane gets a slice of what they leave
+    assert resource_scheduler.split_budget([4, 4, 1], 8, 32, max_parallel=2) == [(4, 16), (4, 16), (1, 4)]
+    # at least one cpu and one GB each, never more than the budget
+    assert resource_scheduler.split_budget([1000, 1], 4, 4) == [(3, 3), (1, 1)]
+    assert resource_scheduler.split_budget([0, 0], 4, 8) == [(2, 4), (2, 4)]
+    # no more side by side than the budget allows
+    assert resource_scheduler.split_budget([1, 1, 1, 1], 2, 64) == [(1, 32)] * 4
+
+
+def test_jobs_run_within_the_budget(log):
+    jobs = [job(log, 'lane%s' % n, 1, 2) for n in range(4)]
+    assert resource_scheduler.run_jobs(jobs, 2, 8, poll_interval=0.05) is None
+    assert most_at_once(log) == 2
+    assert [j['returncode'] for j in jobs] == [0] * 4
+
+
+def test_job_larger_than_the_budget_runs_alone(log):
+    jobs = [job(log, 'large', 4, 64), job(log, 'small', 1, 1)]
+    assert resource_scheduler.run_jobs(jobs, 2, 8, poll_interval=0.05) is None
+    assert most_at_once(log) == 1
+
+
+def test_first_failure_stops_the_others(log, tmp_path):
+    (tmp_path / 'lane.bam').write_bytes(b'bam')
+    (tmp_path / 'other.bam').write_bytes(b'bam')
+    jobs = [job(log, 'slow', 1, 1, seconds=30, cleanup=[str(tmp_path / 'lane.bam')]),
+            job(log, 'failing', 1, 1, exit_status=3, cleanup=[str(tmp_path / 'other.bam')]),
+            job(log, 'pending', 1, 1)]
+    started = time.time()
+    failed = resource_scheduler.run_jobs(jobs, 2, 8, poll_interval=0.05)
+    assert failed['name'] == 'failing' and failed['returncode'] == 3
+    assert time.time() - started < 10
+    jobs[0]['process'].wait(timeout=10)
+    assert 'process' not in jobs[2]
+    # the inputs of jobs that did not succeed are kept
+    assert (tmp_path / 'lane.bam').exists() and (tmp_path / 'other.bam').exists()
+
+
+def test_cleanup_once_the_job_succeeded(log, tmp_path):
+    (tmp_path / 'lane.bam').write_bytes(b'bam')
+    jobs = [job(log, 'lane', 1, 1, cleanup=[str(tmp_path / 'lane.bam')])]
+    assert resource_scheduler.run_jobs(jobs, 1, 1, poll_interval=0.05) is None
+    assert not (tmp_path / 'lane.bam').exists()
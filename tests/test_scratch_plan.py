@@ -0,0 +1,84 @@
+import os
+import pytest
+import scratch_plan
+
+GB = scratch_plan.GB
+
+
+def fastq_metadata(*rg_gb):
+    return {'readGroups': [{'readGroupId': 'rg%s' % n, 'files': [
+        {'fileName': 'rg%s_%s.fq.gz' % (n, mate), 'fileSize': int(gb * GB / 2), 'fileType': 'FASTQ'} for mate in (1, 2)]}
+        for n, gb in enumerate(rg_gb)]}
+
+
+def stages(plan):
+    return [(s['stage'], s['peak_gb'], s['after_gb']) for s in plan['stages']]
+
+
+@pytest.fixture
+def picard_level(monkeypatch):
+    # lane BAMs at Picard's default level, the factors of the plan apply as they are
+    monkeypatch.setenv('INTERMEDIATE_COMPRESSION', '5')
+
+
+def test_downloads_and_lane_bams_kept_until_the_end(picard_level):
+    plan = scratch_plan.predict(fastq_metadata(2, 1))
+    assert stages(plan) == [('download', 3, 3), ('lane_bams', 6, 3),
+                            ('bwa_mem_aligner', 6.9, 6.9), ('bam_merge_sort_markdup', 10.8, 10.8)]
+    assert plan['peak_gb'] == 10.8
+
+
+def test_eager_cleanup(picard_level):
+    plan = scratch_plan.predict(fastq_metadata(2, 1), eager=True)
+    # a read group's FASTQs go once its lane BAM is written, a lane BAM once it is aligned
+    assert stages(plan) == [('download', 3, 3), ('lane_bams', 5, 3),
+                            ('bwa_mem_aligner', 5.6, 3.9), ('bam_merge_sort_markdup', 7.8, 3.9)]
+    assert plan['peak_gb'] == 7.8
+
+
+def test_cram_written_next_to_the_merged_bam(picard_level):
+    plan = scratch_plan.predict(fastq_metadata(2, 1), eager=True, cram=True)
+    assert stages(plan)[-1] == ('bam_merge_sort_markdup', 9.75, 1.95)
+
+
+def test_bam_listed_under_each_read_group(picard_level):
+    bam = {'fileName': 'in.bam', 'fileSize': 2 * GB, 'fileType': 'BAM'}
+    metadata = {'readGroups': [{'readGroupId': 'rg1', 'files': [bam]}, {'readGroupId': 'rg2', 'files': [bam]}]}
+    assert scratch_plan.input_units(metadata) == [(2 * GB, [0.8 * GB, 0.8 * GB])]
+    # the reshaped metadata of validate_metadata.py, the BAM once with its read groups
+    reshaped = {'files': [dict(bam, readGroups=[{'readGroupId': 'rg1'}, {'readGroupId': 'rg2'}])]}
+    assert scratch_plan.predict(reshaped) == scratch_plan.predict(metadata)
+    assert stages(scratch_plan.predict(metadata))[1] == ('lane_bams', 3.6, 1.6)
+
+
+def test_intermediate_level_scales_the_lane_bams_only(monkeypatch):
+    monkeypatch.setenv('INTERMEDIATE_COMPRESSION', '0')
+    uncompressed = stages(scratch_plan.predict(fastq_metadata(2, 1)))
+    monkeypatch.setenv('INTERMEDIATE_COMPRESSION', '5')
+    default = stages(scratch_plan.predict(fastq_metadata(2, 1)))
+    assert uncompressed[1] == ('lane_bams', 12, 9)
+    # the aligned and merged BAMs come out of the images at their own level
+    assert uncompressed[2][1] - uncompressed[1][2] == default[2][1] - default[1][2]
+
+
+def test_free_space_within_the_quota(tmp_path):
+    job_dir = tmp_path / 'job'
+    (job_dir / 'task.download').mkdir(parents=True)
+    with open(str(job_dir / 'task.download' / 'in.bam'), 'wb') as f:
+        f.write(b'\1' * (1024 * 1024))
+    assert scratch_plan.usage_gb(str(job_dir)) >= 1024 * 1024 / GB
+    assert scratch_plan.free_gb(str(job_dir), 1) == pytest.approx(1 - scratch_plan.usage_gb(str(job_dir)))
+    assert scratch_plan.free_gb(str(job_dir)) > 0
+
+
+def test_only_intermediates_of_the_job_are_removed(tmp_path):
+    job_dir = tmp_path / 'job'
+    for task in ('task.download', 'task.revert_bam'):
+        (job_dir / task).mkdir(parents=True)
+    downloaded = job_dir / 'task.download' / 'in.bam'
+    elsewhere = tmp_path / 'in.bam'
+    for path in (downloaded, elsewhere):
+        path.write_bytes(b'bam')
+    scratch_plan.remove_intermediates([str(downloaded), str(elsewhere)], str(job_dir / 'task.revert_bam'))
+    assert not os.path.exists(str(downloaded))
+    assert os.path.exists(str(elsewhere))
@@ -0,0 +1,110 @@
+import json
+import socket
+import sys
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from conftest import STUBS_DIR
+import song_client
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    """ Answers with the next status of the server's script, 200 once it is used up """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_call(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with self.server.lock:
+            self.server.calls.append((self.command, self.path))
+            status = self.server.script.pop(0) if self.server.script else 200
+        if status is None:
+            # processed, the connection lost before the response
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        data = json.dumps({'status': status}).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = handle_call
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ScriptedHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.calls = []
+    server.script = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+def client(server):
+    return song_client.SongClient('http://127.0.0.1:%s' % server.server_port, token='t', retries=3, backoff=0.01)
+
+
+def test_get_retried_on_5xx(server):
+    server.script = [503, 502]
+    assert client(server).analysis('study', 'a1') == {'status': 200}
+    assert len(server.calls) == 3
+
+
+def test_post_not_retried_on_5xx(server):
+    server.script = [503]
+    with pytest.raises(song_client.SongError) as e:
+        client(server).upload('study', {})
+    assert e.value.status == 503
+    assert server.calls == [('POST', '/upload/study')]
+
+
+def test_post_not_retried_on_lost_response(server):
+    server.script = [None]
+    with pytest.raises(song_client.SongError):
+        client(server).save('study', 'u1')
+    assert len(server.calls) == 1
+
+
+def test_post_retried_on_429(server):
+    server.script = [429]
+    assert client(server).upload('study', {}) == {'status': 200}
+    assert len(server.calls) == 2
+
+
+def test_put_retried_on_lost_response(server):
+    server.script = [None]
+    assert client(server).publish('study', 'a1') == {'status': 200}
+    assert len(server.calls) == 2
+
+
+def test_post_retried_when_refused(capsys):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    refused = song_client.SongClient('http://127.0.0.1:%s' % port, token='t', retries=2, backoff=0.01)
+    with pytest.raises(song_client.SongError) as e:
+        refused.upload('study', {})
+    assert 'Connection refused' in str(e.value)
+    assert capsys.readouterr().err.count('retrying') == 2
+
+
+def test_submit_against_stub():
+    sys.path.insert(0, STUBS_DIR)
+    import song_server
+    stub = song_server.start(fail_rate=0.3)
+    try:
+        songs = song_client.SongClient('http://127.0.0.1:%s' % stub.server_port, token='t', retries=20, backoff=0.001)
+        for _ in range(10):
+            analysis_id = songs.submit('study', {'file': []})['analysisId']
+            songs.publish('study', analysis_id)
+        # a POST retried only when rejected unprocessed, no upload or analysis is made twice
+        assert len(stub.state.uploads) == 10 and len(stub.state.analyses) == 10
+    finally:
+        stub.shutdown()
@@ -0,0 +1,93 @@
+import json
+import os
+import pytest
+import task_cache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('TASK_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.delenv('TASK_CACHE_MAX_GB', raising=False)
+    monkeypatch.setattr(task_cache, '_task_key', None)
+    return tmp_path
+
+
+def job(tmp_path, name, fastq_data=b'@r\nACGT\n+\nIIII\n'):
+    """ A job with a downloaded FASTQ and the directory of the task under test """
+    download_dir = tmp_path / name / 'task.download'
+    download_dir.mkdir(parents=True)
+    (download_dir / 'a_1.fq').write_bytes(fastq_data)
+    task_dir = tmp_path / name / 'task.fastq_to_sam'
+    task_dir.mkdir()
+    return str(download_dir / 'a_1.fq'), task_dir
+
+
+def run_task(monkeypatch, task_dir, fastq):
+    """ Restores the task, or runs it: writes a stream spec naming the FASTQ and saves it """
+    monkeypatch.chdir(task_dir)
+    monkeypatch.setattr(task_cache, '_task_key', None)
+    task = {'input': {'download_files': [{'local_path': fastq}]}}
+    if task_cache.restore(task):
+        return True
+    spec = str(task_dir / 'rg1.lane.bam.stream.json')
+    with open(spec, 'w') as s:
+        s.write(json.dumps({'args': ['FastqToSam', 'FASTQ=%s' % fastq]}))
+    with open('output.json', 'w') as o:
+        o.write(json.dumps({'bams': [spec]}))
+    task_cache.save(task)
+    return False
+
+
+def test_restore_remaps_stream_spec(cache, monkeypatch):
+    fastq, task_dir = job(cache, 'job1')
+    assert not run_task(monkeypatch, task_dir, fastq)
+    fastq2, task_dir2 = job(cache, 'job2')
+    assert run_task(monkeypatch, task_dir2, fastq2)
+
+    with open(str(task_dir2 / 'output.json')) as o:
+        assert json.load(o) == {'bams': [str(task_dir2 / 'rg1.lane.bam.stream.json')]}
+    with open(str(task_dir2 / 'rg1.lane.bam.stream.json')) as s:
+        assert json.load(s)['args'] == ['FastqToSam', 'FASTQ=%s' % fastq2]
+
+
+def test_key_covers_the_whole_file(cache, monkeypatch):
+    data = bytearray(b'A' * (16 * 1024 * 1024))
+    fastq, task_dir = job(cache, 'job1', bytes(data))
+    assert not run_task(monkeypatch, task_dir, fastq)
+    data[5 * 1024 * 1024] = ord('C')
+    fastq2, task_dir2 = job(cache, 'job2', bytes(data))
+    assert not run_task(monkeypatch, task_dir2, fastq2)
+
+
+def test_remembered_md5(cache, monkeypatch):
+    fastq, _ = job(cache, 'job1')
+    task_cache.remember_md5(fastq, 'f' * 32)
+    assert task_cache.file_fingerprint(fastq) == '%s:%s' % (os.path.getsize(fastq), 'f' * 32)
+    # a rewritten file is hashed again
+    with open(fastq, 'ab') as f:
+        f.write(b'\n')
+    assert task_cache.file_fingerprint(fastq) != '%s:%s' % (os.path.getsize(fastq), 'f' * 32)
+
+
+def test_large_task_not_saved(cache, monkeypatch):
+    monkeypatch.setenv('TASK_CACHE_MAX_GB', str(100.0 / 1024 ** 3))
+    fastq, task_dir = job(cache, 'job1', b'A' * 200)
+    run_task(monkeypatch, task_dir, fastq)
+    assert task_cache.entries() == []
+
+
+def test_least_recently_used_evicted(cache, monkeypatch):
+    tasks = [job(cache, 'job%s' % i, ('@r%s\n' % i).encode()) for i in range(5)]
+    run_task(monkeypatch, tasks[0][1], tasks[0][0])
+    size = task_cache.entries()[0][1]
+    # room for four entries, the largest a task can take
+    monkeypatch.setenv('TASK_CACHE_MAX_GB', str(size * 4.5 / 1024 ** 3))
+    for fastq, task_dir in tasks[1:4]:
+        run_task(monkeypatch, task_dir, fastq)
+    oldest = task_cache.entries()[0][2]
+    # the oldest entry is used again, the second oldest goes
+    os.utime(os.path.join(oldest, 'meta.json'))
+    second = task_cache.entries()[0][2]
+    run_task(monkeypatch, tasks[4][1], tasks[4][0])
+    saved = [e[2] for e in task_cache.entries()]
+    assert len(saved) == 4 and oldest in saved and second not in saved
@@ -0,0 +1,77 @@
+import copy
+import json
+import os
+import subprocess
+import sys
+import validate_metadata
+from conftest import TOOLS_DIR
+
+
+def fastq(name, rg):
+    return {'fileName': name, 'fileSize': 1000, 'readGroupIdInFile': rg, 'fileMd5sum': 'a' * 32,
+            'path': 'file:///data/%s' % name, 'fileType': 'FASTQ'}
+
+
+METADATA = {
+    'study': 'PACA-CA', 'donorSubmitterId': 'd1', 'specimenSubmitterId': 'sp1', 'sampleSubmitterId': 'sa1',
+    'aliquotId': '8e27f2d2-8a35-4bd1-8f6c-ad0ec5a4b0f3', 'specimenType': 'Normal - blood derived',
+    'libraryStrategy': 'WGS', 'useCntl': 'N/A',
+    'readGroups': [{'readGroupId': 'rg%s' % n, 'sequencingPlatform': 'ILLUMINA', 'platformUnit': 'pu%s' % n,
+                    'libraryName': 'lib', 'files': [fastq('rg%s_1.fq.gz' % n, 'rg%s' % n),
+                                                    fastq('rg%s_2.fq.gz' % n, 'rg%s' % n)]} for n in (1, 2)]
+}
+
+
+def test_valid_metadata():
+    assert validate_metadata.metadata_errors(METADATA) == []
+    assert validate_metadata.check_metadata(METADATA) is None
+
+
+def test_all_errors_are_reported():
+    metadata = copy.deepcopy(METADATA)
+    del metadata['study']
+    metadata['aliquotId'] = 'aliquot1'
+    metadata['specimenType'] = 'Primary tumour'
+    del metadata['readGroups'][0]['platformUnit']
+    metadata['readGroups'][1]['files'][1]['fileSize'] = None
+    metadata['readGroups'][1]['files'].append('rg2_3.fq.gz')
+
+    errors = validate_metadata.metadata_errors(metadata)
+    assert [e['location'] for e in errors] == ['study', 'aliquotId', 'useCntl', 'readGroups[0].platformUnit',
+                                               'readGroups[1].files[1].fileSize', 'readGroups[1].files[2]']
+    assert errors[2]['message'] == 'Must specify useCntl for Tumor in metadata YAML file as UUID'
+    # the first error is the one the workflow task stops with
+    assert validate_metadata.check_metadata(metadata) == errors[0]['message']
+
+
+def test_format_checked_on_complete_metadata_only():
+    metadata = copy.deepcopy(METADATA)
+    metadata['readGroups'][1]['files'][0]['fileType'] = 'BAM'
+    assert [e['location'] for e in validate_metadata.metadata_errors(metadata)] == ['fileType']
+    metadata['readGroups'][1]['libraryName'] = ''
+    assert [e['location'] for e in validate_metadata.metadata_errors(metadata)] == ['readGroups[1].libraryName']
+    assert [e['location'] for e in validate_metadata.metadata_errors(['not', 'a', 'mapping'])] == ['']
+
+
+def test_bulk_validation_report(tmp_path):
+    invalid = copy.deepcopy(METADATA)
+    invalid['libraryStrategy'] = ''
+    yaml_dir = tmp_path / 'yamls'
+    yaml_dir.mkdir()
+    for name, metadata in (('a.yaml', METADATA), ('b.yaml', invalid)):
+        with open(str(yaml_dir / name), 'w') as f:
+            json.dump(metadata, f)
+    (yaml_dir / 'c.yml').write_text('readGroups: [unclosed\n')
+
+    result = subprocess.run([sys.executable, os.path.join(TOOLS_DIR, 'validate_metadata.py'), '--workers', '2',
+                             '--report', str(tmp_path / 'report.json'), str(yaml_dir)],
+                            stderr=subprocess.PIPE, universal_newlines=True, timeout=60)
+    assert result.returncode == 1
+    with open(str(tmp_path / 'report.json')) as f:
+        report = json.load(f)
+    assert (report['total'], report['valid'], report['invalid']) == (3, 1, 2)
+    a, b, c = report['files']
+    assert a['valid'] and a['input_bytes'] == 4000 and a['number_of_lanes'] == 2 and a['input_format'] == 'FASTQ'
+    assert [e['location'] for e in b['errors']] == ['libraryStrategy']
+    assert c['errors'][0]['message'].startswith('Cannot read the metadata YAML')
+    assert 'b.yaml: The metadata YAML must contain and specify field: libraryStrategy' in result.stderr
@@ -0,0 +1,62 @@
+import java.io.BufferedReader;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.util.Arrays;
+
+/**
+ * Runs many Picard command line programs in one JVM, used by picard_batch.py.
+ *
+ * Reads one invocation per line from stdin: "id<TAB>ToolName<TAB>ARG=VALUE<TAB>...",
+ * and reports "id<TAB>exit_status" on stdout once the tool finished. Anything the
+ * tools print themselves goes to stderr.
+ */
+public class PicardBatch {
+    private static final String[] PACKAGES = {
+        "picard.sam",
+        "picard.analysis",
+        "picard.analysis.artifacts",
+        "picard.sam.markduplicates",
+        "picard.util"
+    };
+
+    public static void main(String[] argv) throws Exception {
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+        PrintStream status = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+        System.setOut(System.err);
+
+        String line;
+        while ((line = in.readLine()) != null) {
+            if (line.isEmpty()) continue;
+            String[] fields = line.split("\t", -1);
+            int rc;
+            try {
+                rc = run(fields[1], Arrays.copyOfRange(fields, 2, fields.length));
+            } catch (InvocationTargetException e) {
+                e.getCause().printStackTrace();
+                rc = 1;
+            } catch (Throwable t) {
+                t.printStackTrace();
+                rc = 1;
+            }
+            status.println(fields[0] + "\t" + rc);
+        }
+    }
+
+    private static int run(String tool, String[] args) throws Exception {
+        for (String pkg : PACKAGES) {
+            Class<?> cls;
+            try {
+                cls = Class.forName(pkg + "." + tool);
+            } catch (ClassNotFoundException e) {
+                continue;
+            }
+            Object program = cls.getDeclaredConstructor().newInstance();
+            return (Integer) cls.getMethod("instanceMain", String[].class).invoke(program, (Object) args);
+        }
+        System.err.println("Unknown Picard tool: " + tool);
+        return 1;
+    }
+}
@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 import yaml
 import os
-import subprocess
 import sys
 import json
-import time
 import datetime
 import shutil
+import picard_batch
+import bam_reheader
+import intermediate_codec
+from readgroup_metadata import comments
 
 """
 Major steps:
 - Adds comments to the header of a BAM file
+- with eager_cleanup, each input BAM is deleted as soon as its copy with the comments is
+  written, the others at the end
 """
 
 task_dict = json.loads(sys.argv[1])
@@ -25,41 +29,48 @@ output = {
 with open(task_dict['input'].get('metadata_json'), 'r') as f:
     metadata = json.load(f)
 
-case_map = {
-    'study': 'dcc_project_code',
-    'donorSubmitterId': 'submitter_donor_id',
-    'specimenSubmitterId': 'submitter_specimen_id',
-    'sampleSubmitterId': 'submitter_sample_id',
-    'specimenType': 'dcc_specimen_type',
-    'libraryStrategy': 'library_strategy',
-    'useCntl': 'use_cntl'
-}
-
 # the inputs are BAM
 if input_format == 'BAM':
     picard = task_dict['input'].get('picard_jar')
     unaligned_rg_replace_dir = task_dict['input'].get('unaligned_rg_replace_dir')
+    picard_workers = int(task_dict['input'].get('picard_workers') or 1)
+    eager_cleanup = str(task_dict['input'].get('eager_cleanup')).lower() == 'true'
 
-    rg_args = []
-    for ct in ['study', 'donorSubmitterId', 'specimenSubmitterId', 'sampleSubmitterId', 'specimenType', 'libraryStrategy', 'useCntl']:
-        rg_args.append('C=%s:%s' % (case_map.get(ct), metadata.get(ct)))
+    rg_args = ['C=%s' % c for c in comments(metadata)]
 
     files = metadata.get('files')
     output_dir = os.path.join(cwd, 'lane_unaligned')
     if not os.path.isdir(output_dir): os.makedirs(output_dir)
 
+    invocations = []
     for _file in files:
         # add comments to lane-level bams
         for rg in _file.get('readGroups'):
+            input_bam = os.path.join(unaligned_rg_replace_dir, rg.get('readGroupId')+'.new.bam')
+            output_bam = os.path.join(output_dir, rg.get('readGroupId').replace(':', '_')+'.lane.bam')
+            output['bams'].append(output_bam)
+
+            # only the header changes, copy the compressed records over, Picard if that is not possible
             try:
-                subprocess.run(['java', '-jar', picard,
-                                'AddCommentsToBam',
-                                'I=%s' % os.path.join(unaligned_rg_replace_dir, rg.get('readGroupId')+'.new.bam'),
-                                'O=%s' % os.path.join(output_dir, rg.get('readGroupId').replace(':', '_')+'.lane.bam')] + rg_args, check=True)
+                bam_reheader.reheader(input_bam, output_bam, lambda text: bam_reheader.add_comments(text, comments(metadata)))
+                if eager_cleanup: os.remove(input_bam)
+                continue
+            except bam_reheader.NotBgzfError as e:
+                print('Header rewrite not possible for %s, using Picard: %s' % (input_bam, e), file=sys.stderr)
             except Exception as e:
-                sys.exit('\n%s: AddCommentsToBam failed: %s' %(e, os.path.join(unaligned_rg_replace_dir, rg.get('readGroupId')+'.new.bam')))
+                sys.exit('\n%s: AddCommentsToBam failed: %s' % (e, input_bam))
+
+            invocations.append(['AddCommentsToBam', 'I=%s' % input_bam, 'O=%s' % output_bam] + rg_args +
+                               intermediate_codec.picard_args())
+
+    def cleanup(index, result):
+        if result['returncode'] == 0: os.remove(result['args'][1][len('I='):])
 
-            output['bams'].append(os.path.join(output_dir, rg.get('readGroupId').replace(':', '_')+'.lane.bam'))
+    # all read groups go through the same few JVMs
+    for result in picard_batch.run_batch(picard, invocations, workers=picard_workers,
+                                         java_opts=intermediate_codec.JAVA_OPTS, on_result=cleanup if eager_cleanup else None):
+        if result['returncode'] != 0:
+            sys.exit('\nexit status %s: AddCommentsToBam failed: %s' % (result['returncode'], result['args'][1][len('I='):]))
 
     # delete the files at the very last moment
     if os.path.isdir(unaligned_rg_replace_dir): shutil.rmtree(unaligned_rg_replace_dir)
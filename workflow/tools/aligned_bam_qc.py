@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import os
+import subprocess
+import sys
+import json
+import hashlib
+import threading
+import time
+import task_cache
+import instrument
+import node_budget
+import picard_batch
+import oxog_metrics
+import file_checksum
+from bam_reheader import read_header
+
+"""
+Aligned BAM QC of the merged BAM:
+- CollectMultipleMetrics reads the BAM from a FIFO fed by tee
+- CollectOxoGMetrics, the slower of the two, runs as 'oxog_shards' JVMs side by side, each
+  one on whole chromosomes of about the same total length (INTERVALS=), reading its part of
+  the BAM through the index. The per-context counts of the shards are summed and the rates
+  and qualities derived from the sums, see oxog_metrics.py. This reads the BAM a second
+  time, with a single shard or without an index CollectOxoGMetrics reads from a second FIFO
+  of the same tee instead
+- BGZF decompression runs on a separate thread in each JVM (samjdk async IO)
+- the md5 of the BAM (or CRAM) is taken from what tee reads, and written with its size to the
+  <file>.checksum.json sidecar the SONG payload is made from, with the one of the small index.
+  The file is not read again for it
+- outputs keep their names, multiple_metrics.* and oxoG_metrics.txt, both in this task's directory
+- with cram_primary the merged CRAM is read instead, decoded with the uncompressed reference
+  it was written with, and CollectOxoGMetrics is not sharded
+"""
+
+# OxoG shards by default: the cores of the node less the ones of CollectMultipleMetrics and tee
+MAX_OXOG_SHARDS = 8
+
+task_dict = json.loads(sys.argv[1])
+
+if task_cache.restore(task_dict):
+    sys.exit()
+
+picard = task_dict['input'].get('picard_jar')
+aligned_bam = task_dict['input'].get('aligned_bam')
+oxog_shards = int(task_dict['input'].get('oxog_shards') or
+                  max(1, min(MAX_OXOG_SHARDS, node_budget.totals()[0] - 2)))
+reference_sequence = task_dict['input'].get('reference_sequence')
+is_cram = aligned_bam.endswith('.cram')
+aligned_bam_index = task_dict['input'].get('aligned_bam_index') or aligned_bam + ('.crai' if is_cram else '.bai')
+if is_cram:
+    reference_sequence = task_dict['input'].get('reference')
+
+cwd = os.getcwd()
+java_opts = ['-Dsamjdk.use_async_io_read_samtools=true']
+
+collectors = [
+    ('CollectMultipleMetrics', ['java', '-Xms5000m'] + java_opts + ['-jar', picard, 'CollectMultipleMetrics',
+        'O=multiple_metrics',
+        'R=%s' % reference_sequence,
+        'ASSUME_SORTED=true',
+        'PROGRAM=null',
+        'PROGRAM=CollectBaseDistributionByCycle',
+        'PROGRAM=CollectAlignmentSummaryMetrics',
+        'PROGRAM=CollectInsertSizeMetrics',
+        'PROGRAM=MeanQualityByCycle',
+        'PROGRAM=QualityScoreDistribution',
+        'PROGRAM=CollectSequencingArtifactMetrics',
+        'PROGRAM=CollectQualityYieldMetrics',
+        'METRIC_ACCUMULATION_LEVEL=null',
+        'METRIC_ACCUMULATION_LEVEL=ALL_READS',
+        'METRIC_ACCUMULATION_LEVEL=SAMPLE',
+        'METRIC_ACCUMULATION_LEVEL=LIBRARY',
+        'METRIC_ACCUMULATION_LEVEL=READ_GROUP']),
+]
+oxog_cmd = ['java'] + java_opts + ['-jar', picard, 'CollectOxoGMetrics', 'R=%s' % reference_sequence]
+
+intervals = []
+if oxog_shards > 1 and not is_cram and os.path.exists(aligned_bam_index):
+    with open(aligned_bam, 'rb') as bam:
+        header_text = read_header(bam)[0]
+    intervals = oxog_metrics.interval_lists(header_text, oxog_shards, os.path.join(cwd, 'oxoG_metrics'))
+shard_metrics = ['oxoG_metrics.%s.txt' % n for n in range(len(intervals))]
+if not intervals:
+    collectors.append(('CollectOxoGMetrics', oxog_cmd + ['O=oxoG_metrics.txt']))
+
+fifos = [os.path.join(cwd, '%s.%s' % (name, 'cram' if is_cram else 'bam')) for name, _ in collectors]
+for fifo in fifos:
+    if os.path.exists(fifo): os.remove(fifo)
+    os.mkfifo(fifo)
+
+procs = [(name, instrument.Popen(cmd + ['I=%s' % fifo], label=name)) for (name, cmd), fifo in zip(collectors, fifos)]
+heap = picard_batch.heap_opts(java_opts, len(intervals) + 1) if intervals else []
+for n, (interval_list, metrics) in enumerate(zip(intervals, shard_metrics)):
+    name = 'CollectOxoGMetrics.%s' % n
+    procs.append((name, instrument.Popen(oxog_cmd[:1] + heap + oxog_cmd[1:] + [
+        'I=%s' % aligned_bam, 'INTERVALS=%s' % interval_list, 'O=%s' % metrics], label=name)))
+# a sidecar of an earlier run must not survive a failed one
+for path in (aligned_bam, aligned_bam_index):
+    if os.path.isfile(path + file_checksum.SIDECAR_SUFFIX): os.remove(path + file_checksum.SIDECAR_SUFFIX)
+
+# tee opens the FIFOs itself, it can be killed if a collector dies before opening its end
+md5 = hashlib.md5()
+with open(aligned_bam, 'rb') as bam:
+    before = os.fstat(bam.fileno())
+    tee = subprocess.Popen(['tee'] + fifos, stdin=bam, stdout=subprocess.PIPE)
+hasher = threading.Thread(target=lambda: [md5.update(chunk) for chunk in
+                                          iter(lambda: tee.stdout.read(file_checksum.CHUNK_SIZE), b'')])
+hasher.start()
+
+failed = None
+while failed is None and any([p.poll() is None for _, p in procs]):
+    failed = next((name for name, p in procs if p.poll() not in (None, 0)), None)
+    time.sleep(1)
+failed = failed or next((name for name, p in procs if p.returncode != 0), None)
+
+if failed:
+    for p in [tee] + [p for _, p in procs]:
+        if p.poll() is None: p.kill()
+hasher.join()
+tee.wait()
+for fifo in fifos:
+    os.remove(fifo)
+
+if failed:
+    sys.exit('%s failed' % failed)
+if tee.returncode != 0:
+    sys.exit('Reading %s failed' % aligned_bam)
+
+if intervals:
+    oxog_metrics.merge(shard_metrics, 'oxoG_metrics.txt')
+    for f in intervals + shard_metrics:
+        os.remove(f)
+
+sidecars = []
+after = os.stat(aligned_bam)
+if (before.st_ino, before.st_size, before.st_mtime_ns) == (after.st_ino, after.st_size, after.st_mtime_ns):
+    file_checksum.write_sidecar(aligned_bam, md5.hexdigest(), after.st_size)
+    sidecars.append(aligned_bam + file_checksum.SIDECAR_SUFFIX)
+else:
+    print('No checksum sidecar for %s, it changed while it was read' % aligned_bam, file=sys.stderr)
+if os.path.isfile(aligned_bam_index):
+    result = file_checksum.checksum(aligned_bam_index)
+    if result:
+        file_checksum.write_sidecar(aligned_bam_index, *result)
+        sidecars.append(aligned_bam_index + file_checksum.SIDECAR_SUFFIX)
+
+with open("output.json", "w") as o:
+    o.write(json.dumps({'output_dir': cwd}))
+
+task_cache.save(task_dict, extra_files=sidecars)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import struct
+import zlib
+
+"""
+Header-only BAM rewrite:
+- the BGZF blocks holding the header are decompressed, the new header plus whatever
+  record bytes shared the last of these blocks are compressed into new blocks
+- every following BGZF block is copied byte for byte, with copy_file_range when available,
+  an in-kernel copy that saves the round trip through user space. The blocks start at
+  offsets that are not aligned to filesystem blocks, so it is a copy, never a reflink
+- NotBgzfError means the input is not a BGZF compressed BAM, callers fall back to Picard
+"""
+
+BGZF_MAX_BLOCK_DATA = 65280
+BGZF_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+
+
+class NotBgzfError(Exception):
+    pass
+
+
+def read_block(f):
+    """ Returns (raw block bytes, decompressed data) of the next BGZF block, (b'', b'') at EOF """
+    head = f.read(12)
+    if not head:
+        return b'', b''
+    if len(head) < 12 or head[:4] != b'\x1f\x8b\x08\x04':
+        raise NotBgzfError('not a BGZF block')
+    xlen = struct.unpack('<H', head[10:12])[0]
+    extra = f.read(xlen)
+    bsize = None
+    i = 0
+    while i + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+        if extra[i:i + 2] == b'BC' and slen == 2:
+            bsize = struct.unpack('<H', extra[i + 4:i + 6])[0]
+        i += 4 + slen
+    if bsize is None:
+        raise NotBgzfError('BGZF block without BC subfield')
+    rest = f.read(bsize - 11 - xlen)
+    data = zlib.decompressobj(-15).decompress(rest[:-8])
+    return head + extra + rest, data
+
+
+def write_blocks(f, data, level=6):
+    for i in range(0, len(data), BGZF_MAX_BLOCK_DATA):
+        chunk = data[i:i + BGZF_MAX_BLOCK_DATA]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(chunk) + compressor.flush()
+        f.write(BGZF_HEADER + struct.pack('<H', len(BGZF_HEADER) + 2 + len(cdata) + 8 - 1) + cdata +
+                struct.pack('<II', zlib.crc32(chunk) & 0xffffffff, len(chunk)))
+
+
+def read_header(f):
+    """
+    Reads the BAM header from the start of 'f'. Returns (text, refs, rest) where 'refs' is
+    the binary reference section (n_ref included) and 'rest' the record bytes sharing the
+    last header block. 'f' is left at the first block after the header.
+    """
+    data = b''
+
+    def need(n):
+        nonlocal data
+        while len(data) < n:
+            _, block = read_block(f)
+            if not block and f.tell() == os.fstat(f.fileno()).st_size:
+                raise NotBgzfError('truncated BAM header')
+            data += block
+
+    need(8)
+    if data[:4] != b'BAM\x01':
+        raise NotBgzfError('not a BAM file')
+    l_text = struct.unpack('<i', data[4:8])[0]
+    need(8 + l_text + 4)
+    text = data[8:8 + l_text].rstrip(b'\x00').decode()
+    pos = 8 + l_text
+    n_ref = struct.unpack('<i', data[pos:pos + 4])[0]
+    pos += 4
+    for _ in range(n_ref):
+        need(pos + 4)
+        l_name = struct.unpack('<i', data[pos:pos + 4])[0]
+        need(pos + 4 + l_name + 4)
+        pos += 4 + l_name + 4
+    return text, data[8 + l_text:pos], data[pos:]
+
+
+def reheader(input_bam, output_bam, transform):
+    """ Write 'output_bam' with the header text replaced by transform(old_text) """
+    with open(input_bam, 'rb') as i, open(output_bam, 'wb') as o:
+        text, refs, rest = read_header(i)
+        new_text = transform(text).encode()
+        write_blocks(o, b'BAM\x01' + struct.pack('<i', len(new_text)) + new_text + refs + rest)
+        o.flush()
+
+        # the remaining blocks, EOF marker included, are copied as they are
+        offset, end = i.tell(), os.fstat(i.fileno()).st_size
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while offset < end:
+                    copied = os.copy_file_range(i.fileno(), o.fileno(), end - offset, offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+            except OSError:
+                pass
+        i.seek(offset)
+        o.seek(0, os.SEEK_END)
+        shutil.copyfileobj(i, o, 16 * 1024 * 1024)
+
+
+def add_comments(text, comments):
+    return text + ''.join(['@CO\t%s\n' % c for c in comments])
+
+
+def replace_readgroups(text, rg_line):
+    """ Drop all @RG lines and put the single new one after @HD/@SQ, like AddOrReplaceReadGroups """
+    lines = [l for l in text.splitlines() if not l.startswith('@RG\t')]
+    at = len([l for l in lines if l.startswith('@HD') or l.startswith('@SQ')])
+    lines.insert(at, rg_line)
+    return '\n'.join(lines) + '\n'
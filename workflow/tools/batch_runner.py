@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+import yaml
+import local_runner
+import node_budget
+import scratch_plan
+from validate_metadata import load_metadata, validate_files
+
+"""
+Runs the workflow for many aliquots side by side on one node:
+- all metadata YAMLs are validated up front, a batch with an invalid one does not start
+  unless --skip-invalid is given
+- is_file inputs left at their URL default (picard.jar, the reference) are downloaded once
+  for the batch, and the jobs share one reference_cache_dir
+- the jobs take their CPU, memory and scratch space from one node budget (NODE_BUDGET_DIR,
+  see node_budget.py): an aliquot starts once the scratch space it is predicted to need at
+  its peak (scratch_plan.py) is free, its lane level steps then compete with the lanes of
+  the other aliquots, with the aliquot holding the fewest grants going first
+- writes batch_report.json with the outcome of every aliquot
+
+  batch_runner.py --batch-dir <dir> [--max-jobs N] [-i key=value ...] <metadata.yaml> ...
+"""
+
+def validate(metadata_files):
+    """ Returns the aliquots as dicts and the metadata files that are not valid with their errors """
+    aliquots, invalid = [], {}
+    for result in validate_files(metadata_files):
+        path = result['metadata_yaml']
+        if not result['valid']:
+            invalid[path] = '; '.join([e['message'].strip() for e in result['errors']])
+            continue
+        aliquots.append({'metadata_yaml': os.path.abspath(path), 'aliquot_id': result['aliquot_id'],
+                         'input_bytes': result['input_bytes']})
+    return aliquots, invalid
+
+
+def fetch_inputs(workflow, inputs, download_dir):
+    """ Downloads the is_file inputs that are still URLs, once for the whole batch """
+    for key, spec in workflow['workflow']['input'].items():
+        m = local_runner.URL_DEFAULT.match(str(inputs.get(key) or ''))
+        if not spec.get('is_file') or not m:
+            continue
+        local_file = os.path.join(download_dir, m.group(1))
+        if not os.path.isfile(local_file):
+            os.makedirs(download_dir, exist_ok=True)
+            print('Downloading %s' % m.group(2))
+            with urllib.request.urlopen(m.group(2)) as r, open(local_file + '.part', 'wb') as f:
+                shutil.copyfileobj(r, f, 16 * 1024 * 1024)
+            os.rename(local_file + '.part', local_file)
+        inputs[key] = local_file
+
+
+def run_aliquot(aliquot, workflow, inputs, batch_dir, env, budget):
+    job_id = str(uuid.uuid4())
+    job_dir = os.path.join(batch_dir, 'jobs', job_id)
+    plan = scratch_plan.predict(load_metadata(aliquot['metadata_yaml']),
+                                eager=str(inputs.get('eager_cleanup')).lower() == 'true',
+                                cram=str(inputs.get('cram_primary')).lower() == 'true')
+    aliquot.update({'job_dir': job_dir, 'scratch_gb': plan['peak_gb']})
+
+    # held for as long as the job runs, the lane steps of the job take their cpus and memory on top
+    grant = node_budget.acquire(budget, job_id, scratch=aliquot['scratch_gb'], label='aliquot %s' % aliquot['aliquot_id'])
+    aliquot['start_time'] = time.time()
+    try:
+        results = local_runner.run_job(workflow, dict(inputs, metadata_yaml=aliquot['metadata_yaml']), job_dir, env,
+                                       runner='batch_runner')
+    except Exception as e:
+        results = [{'task': None, 'returncode': None, 'error': str(e)}]
+    finally:
+        node_budget.release(budget, grant)
+    aliquot['seconds'] = round(time.time() - aliquot['start_time'], 3)
+    aliquot['tasks'] = results
+    failed = [r for r in results if r['returncode'] != 0]
+    aliquot['status'] = 'failed' if failed else 'succeeded'
+    if failed:
+        aliquot['error'] = '%s: %s' % (failed[0]['task'], failed[0].get('error', ''))
+    print('%s %s in %ss' % (aliquot['aliquot_id'], aliquot['status'], aliquot['seconds']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the workflow for many aliquots under one node-wide budget')
+    parser.add_argument('metadata_yaml', nargs='+')
+    parser.add_argument('--batch-dir', dest='batch_dir', required=True)
+    parser.add_argument('-i', '--input', dest='inputs', action='append', default=[], metavar='KEY=VALUE',
+                        help='workflow input for all the aliquots, e.g. -i min_coverage=30')
+    parser.add_argument('--max-jobs', dest='max_jobs', type=int, default=4, help='aliquots running at the same time')
+    parser.add_argument('--cpus', type=int, help='node budget, all cores by default')
+    parser.add_argument('--mem-gb', dest='mem', type=int, help='node budget, all memory by default')
+    parser.add_argument('--scratch-gb', dest='scratch', type=float, help='node budget, free space of the batch directory by default')
+    parser.add_argument('--skip-invalid', dest='skip_invalid', action='store_true',
+                        help='run the valid aliquots when some metadata YAMLs are invalid')
+    args = parser.parse_args()
+
+    aliquots, invalid = validate(args.metadata_yaml)
+    for path, error in invalid.items():
+        print('Invalid metadata %s: %s' % (path, error), file=sys.stderr)
+    if invalid and not args.skip_invalid:
+        sys.exit('%s of %s metadata YAMLs are invalid, nothing was run' % (len(invalid), len(args.metadata_yaml)))
+
+    batch_dir = os.path.abspath(args.batch_dir)
+    workflow = local_runner.load_workflow()
+    inputs = local_runner.default_inputs(workflow)
+    inputs['reference_cache_dir'] = os.path.join(batch_dir, 'reference_cache')
+    inputs.update(dict([(k, yaml.safe_load(v)) for k, v in [i.split('=', 1) for i in args.inputs]]))
+    fetch_inputs(workflow, inputs, os.path.join(batch_dir, 'inputs'))
+
+    budget = os.path.join(batch_dir, 'budget')
+    node_budget.configure(budget, args.cpus, args.mem, args.scratch)
+    env = dict(os.environ, NODE_BUDGET_DIR=budget)
+    local_runner.write_shims(os.path.join(batch_dir, 'shims'))
+    env['PATH'] = os.pathsep.join([os.path.join(batch_dir, 'shims'), env.get('PATH', '')])
+
+    # largest first, the small ones fill the gaps left next to them
+    todo = sorted(aliquots, key=lambda a: a['input_bytes'], reverse=True)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not todo:
+                    return
+                aliquot = todo.pop(0)
+            run_aliquot(aliquot, workflow, inputs, batch_dir, env, budget)
+
+    threads = [threading.Thread(target=worker) for _ in range(min(args.max_jobs, len(aliquots)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    report = {
+        'aliquots': aliquots,
+        'invalid': [{'metadata_yaml': p, 'error': e} for p, e in invalid.items()],
+        'budget': node_budget.update(budget, lambda s: s['total'])
+    }
+    with open(os.path.join(batch_dir, 'batch_report.json'), 'w') as f:
+        f.write(json.dumps(report, indent=2))
+
+    if invalid or [a for a in aliquots if a['status'] != 'succeeded']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,24 @@
 #!/usr/bin/env python3
 
 import os
-import subprocess
 import sys
 import json
+import shutil
+import resource_scheduler
+import node_budget
+import reference_cache
+import docker_image
+import task_cache
+import scratch_plan
+import lane_scatter
+import intermediate_codec
+import quality_yield_metrics
 
 task_dict = json.loads(sys.argv[1])
 
+if task_cache.restore(task_dict):
+    sys.exit()
+
 cwd = os.getcwd()
 
 bwa_mem_aligner_docker = task_dict['input'].get('bwa_mem_aligner_docker')
@@ -20,39 +32,209 @@ reference_gz_pac = task_dict['input'].get('reference_gz_pac')
 reference_gz_sa = task_dict['input'].get('reference_gz_sa')
 reference_gz_amb = task_dict['input'].get('reference_gz_amb')
 
-# pull docker image
-subprocess.run(['docker', 'pull', '%s' % bwa_mem_aligner_docker])
-
 aligned_lane_bam_prefix = 'grch38-aligned'
-output_bams = []
+stream_suffix = '.stream.json'
+
+# streamed lanes: FastqToSam reads the FASTQs from FIFOs fed by quality_yield_metrics.py, which
+# decompresses them once and writes the quality yield metrics of the lane as it feeds them, and
+# writes into the FIFO mounted as the lane BAM of the aligner container
+stream_script = """
+set -euo pipefail
+python="$1"; metrics_tool="$2"; picard="$3"; stream_dir="$4"; lane="$5"; metrics="$6"; fastq1="$7"; fastq2="$8"
+shift 8
+fastq_to_sam_args=()
+while [ "$1" != "--" ]; do fastq_to_sam_args+=("$1"); shift; done; shift
+lane_fifo="$stream_dir/$lane"
+rm -f "$lane_fifo" "$lane_fifo".[12].fastq*
+mkfifo "$lane_fifo"
+trap 'kill $(jobs -p) 2>/dev/null || true; rm -f "$lane_fifo" "$lane_fifo".[12].fastq*' EXIT
+trap 'exit 143' TERM
+"$python" "$metrics_tool" "$metrics" "$fastq1=$lane_fifo.1.fastq" "$fastq2=$lane_fifo.2.fastq" & metrics_pid=$!
+while [ ! -p "$lane_fifo.2.fastq" ]; do kill -0 $metrics_pid; sleep 0.1; done
+java -jar "$picard" "${fastq_to_sam_args[@]}" FASTQ="$lane_fifo.1.fastq" FASTQ2="$lane_fifo.2.fastq" \\
+  OUTPUT="$lane_fifo" & producer_pid=$!
+"$@"
+wait $producer_pid
+kill -USR1 $metrics_pid
+wait $metrics_pid
+"""
+
+
+def docker_align_cmd(container_name, lane_cpus, lane_mem, lane_bam, name):
+    return ['docker', 'run', '--rm',
+            '--name', container_name,
+            '--cpus', str(lane_cpus),
+            '--memory', '%sg' % lane_mem,
+            '--user', '1000:1000',
+            '--workdir', '/output',
+            '-v', '%s:/output:rw' % cwd,
+            '-v', '%s:/data/%s:ro' % (reference_gz, os.path.basename(reference_gz)),
+            '-v', '%s:/data/%s:ro' % (reference_gz_fai, os.path.basename(reference_gz_fai)),
+            '-v', '%s:/data/%s:ro' % (reference_gz_alt, os.path.basename(reference_gz_alt)),
+            '-v', '%s:/data/%s:ro' % (reference_gz_bwt, os.path.basename(reference_gz_bwt)),
+            '-v', '%s:/data/%s:ro' % (reference_gz_ann, os.path.basename(reference_gz_ann)),
+            '-v', '%s:/data/%s:ro' % (reference_gz_pac, os.path.basename(reference_gz_pac)),
+            '-v', '%s:/data/%s:ro' % (reference_gz_sa, os.path.basename(reference_gz_sa)),
+            '-v', '%s:/data/%s:ro' % (reference_gz_amb, os.path.basename(reference_gz_amb)),
+            '-v', '%s:/data/%s:ro' % (lane_bam, name),
+            '%s' % bwa_mem_aligner_docker,
+            'bwa-mem-aligner.py',
+            '-i', '/data/%s' % name,
+            '-o', '/output/%s.%s' % (aligned_lane_bam_prefix, name),
+            '-r', '/data/%s' % os.path.basename(reference_gz)
+            ]
+
+
+def lane_name(bam):
+    name = os.path.basename(bam)
+    return name[:-len(stream_suffix)] if name.endswith(stream_suffix) else name
+
+
+def lane_size(bam):
+    if not bam.endswith(stream_suffix):
+        return os.path.getsize(bam) if os.path.isfile(bam) else 0
+    with open(bam, 'r') as s:
+        spec = json.load(s)
+    fastqs = [arg.split('=', 1)[1] for arg in spec['args'] if arg.startswith('FASTQ')]
+    return sum([os.path.getsize(f) for f in fastqs if os.path.isfile(f)])
+
+
+# serve the reference from the node-local cache shared with concurrent jobs, optionally
+# warmed into memory so the lanes do not load the BWA index from cold storage
+reference_cache_dir = task_dict['input'].get('reference_cache_dir')
+reference_lease = None
+if reference_cache_dir:
+    reference_files = [reference_gz, reference_gz_fai, reference_gz_alt, reference_gz_bwt,
+                       reference_gz_ann, reference_gz_pac, reference_gz_sa, reference_gz_amb]
+    bundle_dir, reference_lease = reference_cache.acquire_bundle(reference_cache_dir, reference_files,
+                                                                 quota_gb=task_dict['input'].get('reference_cache_quota_gb'),
+                                                                 warm=task_dict['input'].get('reference_warm'))
+    reference_gz, reference_gz_fai, reference_gz_alt, reference_gz_bwt, \
+        reference_gz_ann, reference_gz_pac, reference_gz_sa, reference_gz_amb = \
+        [os.path.join(bundle_dir, os.path.basename(f)) for f in reference_files]
+
+# from here on the lease is released however the task ends, the scheduler kills and releases
+# the lanes it started
+try:
+    # pull docker image, unless already resolved on this node within the TTL
+    bwa_mem_aligner_docker = docker_image.resolve(bwa_mem_aligner_docker,
+                                                  ttl=task_dict['input'].get('docker_image_ttl') or docker_image.DEFAULT_TTL)
+
+    # the node budget when the node is shared, lanes sized for the hardware would not fit in it
+    total_cpus, total_mem = node_budget.totals()
+    cpus = int(task_dict['input'].get('cpus') or total_cpus)
+    mem = int(task_dict['input'].get('mem_gb') or total_mem)
+    max_parallel = int(task_dict['input'].get('max_parallel_lanes') or 0)
+    eager_cleanup = str(task_dict['input'].get('eager_cleanup')).lower() == 'true'
+
+    # lanes larger than scatter_lane_gb are split into chunks of read pairs, aligned as lanes of
+    # their own, streamed lanes have no lane BAM to split
+    scatter_lane_gb = task_dict['input'].get('scatter_lane_gb')
+    chunks = {}
+    if scatter_lane_gb:
+        oversized = [bam for bam in lane_bams if not bam.endswith(stream_suffix) and
+                     lane_size(bam) > float(scatter_lane_gb) * scratch_plan.GB]
+        chunks, error = lane_scatter.split(task_dict['input'].get('picard_jar'), oversized, os.path.join(cwd, 'chunks'),
+                                           task_dict['input'].get('scatter_read_pairs'), workers=cpus)
+        if error:
+            sys.exit('Scatter of the lanes failed: %s' % error)
+        if eager_cleanup:
+            scratch_plan.remove_intermediates([bam for bam in chunks if chunks[bam]], cwd)
+    # what gets aligned, the lanes in the order of the input with the scattered ones replaced by their chunks
+    units = []
+    for bam in lane_bams:
+        units.extend(chunks.get(bam) or [bam])
+
+    # split the cpu/memory budget across lanes by lane size, largest lanes get started first
+    lane_sizes = [lane_size(bam) for bam in units]
+    shares = resource_scheduler.split_budget(lane_sizes, cpus, mem, max_parallel=max_parallel)
+
+    stream_dir = os.path.join(cwd, 'streams')
+
+    # with eager cleanup, the lane BAM (or the FASTQs of a streamed lane) goes as soon as its lane
+    # is aligned, lane_bam_qc ran before. With a scratch quota, a lane is started only when the
+    # predicted size of its aligned BAM fits
+    scratch_quota_gb = task_dict['input'].get('scratch_quota_gb')
+    scratch_free = None
+    if scratch_quota_gb:
+        scratch_free = lambda: scratch_plan.free_gb(os.path.dirname(cwd), scratch_quota_gb)
+
+    jobs = []
+    streamed_metrics = []
+    for bam, size, (lane_cpus, lane_mem) in zip(units, lane_sizes, shares):
+        container_name = 'bwa-mem-%s-%s' % (os.getpid(), len(jobs))
+        job = {
+            'name': bam,
+            'cpus': lane_cpus,
+            'mem': lane_mem,
+            'size': size,
+            # the size of a streamed lane is the one of its FASTQs
+            'scratch': size * scratch_plan.ALIGNED_FACTOR / scratch_plan.GB /
+                       (1.0 if bam.endswith(stream_suffix) else intermediate_codec.size_factor()),
+            'kill_cmd': ['docker', 'kill', container_name],
+            'label': 'bwa-mem %s' % lane_name(bam),
+            'container': container_name
+        }
+
+        if bam.endswith(stream_suffix):
+            with open(bam, 'r') as s:
+                spec = json.load(s)
+            if not os.path.isdir(stream_dir): os.makedirs(stream_dir)
+            job['cmd'] = ['bash', '-c', stream_script, 'stream', sys.executable,
+                          os.path.join(os.path.dirname(os.path.abspath(__file__)), 'quality_yield_metrics.py'),
+                          spec['picard_jar'], stream_dir, lane_name(bam), spec['metrics']] + spec['fastqs'] + \
+                         spec['args'] + ['--'] + \
+                         docker_align_cmd(container_name, lane_cpus, lane_mem,
+                                          os.path.join(stream_dir, lane_name(bam)), lane_name(bam))
+            lane_inputs = spec['fastqs']
+            streamed_metrics.append(spec['metrics'])
+        else:
+            job['cmd'] = docker_align_cmd(container_name, lane_cpus, lane_mem, bam, lane_name(bam))
+            lane_inputs = [bam]
+
+        if eager_cleanup:
+            job['cleanup'] = [f for f in lane_inputs if scratch_plan.is_intermediate(f, cwd)]
+        if os.path.dirname(os.path.dirname(bam)) == os.path.join(cwd, 'chunks'):
+            job['cleanup'] = [bam]
+        jobs.append(job)
+
+    failed = resource_scheduler.run_jobs(sorted(jobs, key=lambda j: j['size'], reverse=True), cpus, mem,
+                                         scratch_free=scratch_free)
+finally:
+    if reference_lease is not None:
+        reference_cache.release(reference_lease)
+
+if failed:
+    sys.exit('BWA MEM failed, input: %s' % failed['name'])
+
+# the downloaded FASTQs of streamed lanes were kept by revert_bam.py until now
 for bam in lane_bams:
-    try:
-        subprocess.run(['docker', 'run', '--rm',
-                        '--user', '1000:1000',
-                        '--workdir', '/output',
-                        '-v', '%s:/output:rw' % cwd,
-                        '-v', '%s:/data/%s:ro' % (reference_gz, os.path.basename(reference_gz)),
-                        '-v', '%s:/data/%s:ro' % (reference_gz_fai, os.path.basename(reference_gz_fai)),
-                        '-v', '%s:/data/%s:ro' % (reference_gz_alt, os.path.basename(reference_gz_alt)),
-                        '-v', '%s:/data/%s:ro' % (reference_gz_bwt, os.path.basename(reference_gz_bwt)),
-                        '-v', '%s:/data/%s:ro' % (reference_gz_ann, os.path.basename(reference_gz_ann)),
-                        '-v', '%s:/data/%s:ro' % (reference_gz_pac, os.path.basename(reference_gz_pac)),
-                        '-v', '%s:/data/%s:ro' % (reference_gz_sa, os.path.basename(reference_gz_sa)),
-                        '-v', '%s:/data/%s:ro' % (reference_gz_amb, os.path.basename(reference_gz_amb)),
-                        '-v', '%s:/data/%s:ro' % (bam, os.path.basename(bam)),
-                        '%s' % bwa_mem_aligner_docker,
-                        'bwa-mem-aligner.py',
-                        '-i', '/data/%s' % os.path.basename(bam),
-                        '-o', '/output/%s.%s' % (aligned_lane_bam_prefix, os.path.basename(bam)),
-                        '-r', '/data/%s' % os.path.basename(reference_gz)
-                        ], check=True)
-    except Exception as e:
-        sys.exit('BWA MEM failed, input: %s' % bam)
-
-    output_bams.append('%s.%s' % (aligned_lane_bam_prefix, os.path.basename(bam)))
+    if not bam.endswith(stream_suffix):
+        continue
+    with open(bam, 'r') as s:
+        spec = json.load(s)
+    for fastq in spec['fastqs']:
+        # remove only when the file is downloaded into another task dir of the same job
+        if os.path.isfile(fastq) and fastq.split(os.sep)[:-2] == cwd.split(os.sep)[:-1]:
+            os.remove(fastq)
+
+# the coverage of streamed lanes is known once they went through FastqToSam, lane_bam_qc.py
+# checked the other lanes
+if streamed_metrics:
+    min_coverage = float(task_dict['input'].get('min_coverage') or 0)
+    coverage = sum([quality_yield_metrics.get_pf_bases(m) for m in streamed_metrics]) / quality_yield_metrics.GENOME_SIZE
+    if coverage < min_coverage:
+        sys.exit('Pass filter coverage lower than %s' % min_coverage)
+
+if os.path.isdir(os.path.join(cwd, 'chunks')): shutil.rmtree(os.path.join(cwd, 'chunks'))
+
+# keep the output in the same order as the input lane BAMs, a scattered lane has one per chunk
+output_bams = ['%s.%s' % (aligned_lane_bam_prefix, lane_name(bam)) for bam in units]
 
 with open("output.json", "w") as o:
   json.dump({
     'output_dir': cwd,
     'aligned_lane_bam_names': output_bams
   }, o)
+
+task_cache.save(task_dict, extra_files=streamed_metrics)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import struct
+import subprocess
+import sys
+import urllib.request
+import zlib
+import quality_yield_metrics
+import task_cache
+
+"""
+Estimate of the coverage of a sample before its files are downloaded, so a sample that is
+not going to pass the min_coverage check of lane_bam_qc is turned down in minutes:
+- the first sample_mb of each file are fetched, with an HTTP range request on the URL
+  score-client resolves for the object, or read from the local file
+- the sample is cut into segments (the BGZF blocks of a BAM, 64 KB of compressed FASTQ), the
+  pass filter bases per compressed byte of each segment give the mean and its standard error.
+  Secondary/supplementary alignments and vendor failed reads (QC fail flag of a BAM, the
+  'Y' filter field of Casava 1.8 FASTQ read names) are left out
+- fileSize times the rate gives the PF bases of the file, with a bound of Z standard errors,
+  widened by BIAS_MARGIN as the head of a file is not a random sample of it. The bounds of
+  the files are added up, the same as if their errors went the same way
+- the job fails when the upper bound of the coverage is below min_coverage. A file that
+  cannot be sampled leaves the coverage open, the check in lane_bam_qc then decides
+"""
+
+SEGMENT_BYTES = 64 * 1024
+Z = 3.0
+BIAS_MARGIN = 0.15
+BAM_MAGIC = b'BAM\x01'
+
+mapping = {
+    'collaboratory': 'collab',
+    'amazon': 'aws'
+}
+
+
+def object_url(storage_site, object_id):
+    """ Presigned URL of the object, the last URL score-client prints """
+    out = subprocess.run(['score-client', '--profile', mapping.get(storage_site), 'url', '--object-id', object_id],
+                         stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    urls = [l.strip() for l in out.splitlines() if l.strip().split('://', 1)[0] in ('http', 'https', 'file')]
+    if not urls:
+        raise Exception('score-client did not resolve a URL for %s' % object_id)
+    return urls[-1]
+
+
+def fetch_head(url, nbytes):
+    if url.startswith('file://'):
+        with open(url[len('file://'):], 'rb') as f:
+            return f.read(nbytes)
+    request = urllib.request.Request(url, headers={'Range': 'bytes=0-%s' % (nbytes - 1)})
+    with urllib.request.urlopen(request, timeout=60) as r:
+        # a server ignoring the range sends the whole object, only the head is read
+        return r.read(nbytes)
+
+
+def local_url(file_path, file_name):
+    file_path_dir = os.path.dirname(file_path.replace('file://', ''))
+    return 'file://' + os.path.abspath(os.path.join(file_path_dir, file_name))
+
+
+def fastq_segments(data):
+    """ (compressed bytes, PF bases) of each segment of the head of a gzipped FASTQ """
+    segments = []
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    text = b''
+    for start in range(0, len(data), SEGMENT_BYTES):
+        chunk = data[start:start + SEGMENT_BYTES]
+        out = b''
+        while chunk:
+            out += decompressor.decompress(chunk)
+            chunk = decompressor.unused_data
+            if decompressor.eof:
+                # bgzip and concatenated files have several gzip members
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                break
+        text += out
+        lines = text.split(b'\n')
+        complete = (len(lines) - 1) // 4 * 4
+        bases = 0
+        for i in range(0, complete, 4):
+            fields = lines[i].split()
+            if len(fields) > 1 and fields[1][1:3] == b':Y':
+                continue
+            bases += len(lines[i + 1].strip())
+        text = b'\n'.join(lines[complete:])
+        if start + SEGMENT_BYTES <= len(data):
+            segments.append((SEGMENT_BYTES, bases))
+    return segments
+
+
+def bgzf_blocks(data):
+    """ (compressed size, data) of the complete BGZF blocks in 'data' """
+    pos = 0
+    while pos + 18 <= len(data):
+        if data[pos:pos + 4] != b'\x1f\x8b\x08\x04':
+            raise Exception('not a BGZF block at %s' % pos)
+        xlen = struct.unpack('<H', data[pos + 10:pos + 12])[0]
+        extra, bsize, i = data[pos + 12:pos + 12 + xlen], None, 0
+        while i + 4 <= len(extra):
+            slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == b'BC' and slen == 2:
+                bsize = struct.unpack('<H', extra[i + 4:i + 6])[0]
+            i += 4 + slen
+        if bsize is None or pos + bsize + 1 > len(data):
+            return
+        yield bsize + 1, zlib.decompressobj(-15).decompress(data[pos + 12 + xlen:pos + bsize + 1 - 8])
+        pos += bsize + 1
+
+
+def bam_segments(data):
+    """ (compressed bytes, PF bases) of each BGZF block after the header, and the compressed size of the header """
+    segments, buf, header_bytes, in_header = [], b'', 0, True
+    for size, block in bgzf_blocks(data):
+        buf += block
+        if in_header:
+            header_bytes += size
+            if len(buf) < 12 or buf[:4] != BAM_MAGIC:
+                continue
+            l_text = struct.unpack('<i', buf[4:8])[0]
+            pos = 8 + l_text
+            if len(buf) < pos + 4:
+                continue
+            n_ref, pos = struct.unpack('<i', buf[pos:pos + 4])[0], pos + 4
+            for _ in range(n_ref):
+                if len(buf) < pos + 4 or len(buf) < pos + 8 + struct.unpack('<i', buf[pos:pos + 4])[0]:
+                    break
+                pos += 8 + struct.unpack('<i', buf[pos:pos + 4])[0]
+            else:
+                in_header = False
+                buf = buf[pos:]
+            continue
+
+        bases, pos = 0, 0
+        while pos + 4 <= len(buf):
+            block_size = struct.unpack('<i', buf[pos:pos + 4])[0]
+            if pos + 4 + block_size > len(buf):
+                break
+            flag, l_seq = struct.unpack('<H', buf[pos + 18:pos + 20])[0], struct.unpack('<i', buf[pos + 20:pos + 24])[0]
+            if not flag & (0x100 | 0x800 | 0x200):
+                bases += l_seq
+            pos += 4 + block_size
+        buf = buf[pos:]
+        segments.append((size, bases))
+    if in_header:
+        raise Exception('the sample does not reach past the BAM header')
+    return segments, header_bytes
+
+
+def estimate_file(segments, file_size):
+    """ (estimate, low, high) of the PF bases of a file of 'file_size' compressed bytes """
+    segments = [s for s in segments if s[0]]
+    if len(segments) < 2:
+        raise Exception('too few segments in the sample: %s' % len(segments))
+    rate = sum([b for _, b in segments]) / sum([c for c, _ in segments])
+    rates = [b / c for c, b in segments]
+    variance = sum([(r - rate) ** 2 for r in rates]) / (len(rates) - 1)
+    stderr = (variance / len(rates)) ** 0.5
+    return (file_size * rate,
+            file_size * max(0.0, rate - Z * stderr) * (1 - BIAS_MARGIN),
+            file_size * (rate + Z * stderr) * (1 + BIAS_MARGIN))
+
+
+def main():
+    task_dict = json.loads(sys.argv[1])
+
+    if task_cache.restore(task_dict):
+        sys.exit()
+
+    with open(task_dict['input'].get('metadata_json'), 'r') as f:
+        metadata = json.load(f)
+    input_format = task_dict['input'].get('input_format')
+    min_coverage = task_dict['input'].get('min_coverage')
+    sample_bytes = int(float(task_dict['input'].get('sample_mb') or 8) * 1024 * 1024)
+
+    if input_format == 'BAM':
+        files = metadata.get('files')
+    else:
+        files = [f for rg in metadata.get('readGroups') for f in rg.get('files')]
+
+    output = {'files': [], 'coverage': None, 'coverage_low': None, 'coverage_high': None}
+    totals = [0.0, 0.0, 0.0]
+    for _file in files:
+        file_path, file_size = _file.get('path'), int(_file.get('fileSize'))
+        result = {'fileName': _file.get('fileName')}
+        try:
+            if file_path.startswith('song://'):
+                storage_site, analysis_id, object_id = file_path.replace('song://', '').split('/')
+                url = object_url(storage_site, object_id)
+            else:
+                url = local_url(file_path, _file.get('fileName'))
+            data = fetch_head(url, sample_bytes)
+            if input_format == 'BAM':
+                segments, header_bytes = bam_segments(data)
+                file_size -= header_bytes
+            else:
+                segments = fastq_segments(data)
+            estimate = estimate_file(segments, file_size)
+        except Exception as e:
+            result['error'] = str(e)
+            totals = None
+            print('Coverage of %s not estimated: %s' % (_file.get('fileName'), e), file=sys.stderr)
+        else:
+            result.update({'pf_bases': int(estimate[0]), 'pf_bases_low': int(estimate[1]),
+                           'pf_bases_high': int(estimate[2]), 'sample_bytes': len(data)})
+            if totals is not None:
+                totals = [t + e for t, e in zip(totals, estimate)]
+        output['files'].append(result)
+
+    if totals is not None:
+        output['coverage'], output['coverage_low'], output['coverage_high'] = \
+            [round(t / quality_yield_metrics.GENOME_SIZE, 2) for t in totals]
+        print('Estimated coverage %s (%s - %s)' % (output['coverage'], output['coverage_low'], output['coverage_high']))
+
+    with open('output.json', 'w') as o:
+        o.write(json.dumps(output))
+
+    if totals is not None and min_coverage is not None and output['coverage_high'] < float(min_coverage):
+        sys.exit('Estimated coverage %s (at most %s) lower than %s, the files are not downloaded' %
+                 (output['coverage'], output['coverage_high'], min_coverage))
+
+    task_cache.save(task_dict)
+
+
+if __name__ == "__main__":
+    main()
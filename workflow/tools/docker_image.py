@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import instrument
+
+"""
+Resolves docker image tags to digests, so 'docker pull' runs at most once per job, or once
+per TTL on a node:
+- the digest a tag resolved to is recorded in a state file shared by the tasks of the user
+  on the node (DOCKER_IMAGE_STATE_DIR, or a directory of the user under /tmp), within the
+  TTL, and for the rest of the job that first resolved it, the pinned digest is used as long
+  as the image is present locally
+- an image is pulled under a lock of its own, concurrent tasks wait for one pull of the same
+  image instead of pulling in parallel, pulls of different images do not wait for each other.
+  The state file is only locked while read and updated
+
+Used as a module by the python tools, and from the shell commands as
+  IMAGE=$(docker_image.py ${util_dckr} --job-id ${_job_id} --ttl ${docker_image_ttl})
+"""
+
+DEFAULT_TTL = 3600
+STATE_FILE = 'docker_image_cache.json'
+# job pins older than this are dropped from the state file
+JOB_PIN_MAX_AGE = 7 * 24 * 3600
+
+
+def state_dir():
+    """ DOCKER_IMAGE_STATE_DIR, or a directory only the user can write to """
+    directory = os.environ.get('DOCKER_IMAGE_STATE_DIR')
+    if directory:
+        if not os.path.isdir(directory): os.makedirs(directory, exist_ok=True)
+        return directory
+    directory = os.path.join(tempfile.gettempdir(), 'docker_image-%s' % os.getuid())
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        sys.exit('%s is not a private directory of this user, set DOCKER_IMAGE_STATE_DIR' % directory)
+    return directory
+
+
+def local_ref(image):
+    """ Digest reference (repo@sha256:...) of a local image, its image ID if it has no digest, None if absent """
+    p = subprocess.run(['docker', 'image', 'inspect', '--format', '{{json .RepoDigests}} {{.Id}}', image],
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    if p.returncode != 0 or not p.stdout.strip():
+        return None
+    repo_digests, image_id = p.stdout.strip().rsplit(' ', 1)
+    repo = image.split('@')[0]
+    if ':' in repo.rsplit('/', 1)[-1]:
+        repo = repo.rsplit(':', 1)[0]
+    for ref in json.loads(repo_digests) or []:
+        if ref.split('@')[0] == repo:
+            return ref
+    return image_id
+
+
+def update(state_file, change):
+    """ Calls change(state) with the locked state, saves and returns what it returned """
+    with open(state_file, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            state = json.loads(f.read() or '{}')
+        except ValueError:
+            state = {}
+        state.setdefault('tags', {})
+        state.setdefault('jobs', {})
+
+        result = change(state)
+
+        now = time.time()
+        state['jobs'] = {j: v for j, v in state['jobs'].items() if now - v['started_at'] < JOB_PIN_MAX_AGE}
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(state))
+    return result
+
+
+def known_ref(state, image, job_id, ttl):
+    """ The reference 'image' was resolved to for the job, or within the TTL, if still present locally """
+    pinned = state['jobs'].get(job_id, {}).get('images', {}).get(image) if job_id else None
+    if pinned and local_ref(pinned):
+        return pinned
+    tag = state['tags'].get(image)
+    if tag and time.time() - tag['resolved_at'] < float(ttl) and local_ref(tag['ref']):
+        return tag['ref']
+    return None
+
+
+def record(state, image, job_id, ref, pulled=False):
+    now = time.time()
+    if pulled:
+        state['tags'][image] = {'ref': ref, 'resolved_at': now}
+    if job_id:
+        state['jobs'].setdefault(job_id, {'started_at': now, 'images': {}})['images'][image] = ref
+
+
+def resolve(image, job_id=None, ttl=DEFAULT_TTL, state_file=None):
+    """ Returns a reference to run 'image' by, pulling it only when no fresh resolution is known """
+    if '@sha256:' in image and local_ref(image):
+        return image
+    directory = os.path.dirname(state_file) if state_file else state_dir()
+    state_file = state_file or os.path.join(directory, STATE_FILE)
+
+    def lookup(state):
+        ref = known_ref(state, image, job_id, ttl)
+        if ref:
+            record(state, image, job_id, ref)
+        return ref
+
+    ref = update(state_file, lookup)
+    if ref:
+        return ref
+
+    lock_file = os.path.join(directory, 'pull-%s.lock' % hashlib.md5(image.encode()).hexdigest())
+    with open(lock_file, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # pulled by another task while this one waited
+        ref = update(state_file, lookup)
+        if ref:
+            return ref
+
+        pull = instrument.run(['docker', 'pull', image], label='docker pull', stdout=sys.stderr)
+        ref = local_ref(image)
+        if ref is None:
+            sys.exit('docker pull %s failed with %s and no local copy exists' % (image, pull.returncode))
+        if pull.returncode != 0:
+            print('docker pull %s failed, using local copy %s' % (image, ref), file=sys.stderr)
+        update(state_file, lambda state: record(state, image, job_id, ref, pulled=pull.returncode == 0))
+    return ref
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resolve a docker image to a local digest reference, pulling only when needed')
+    parser.add_argument('image')
+    parser.add_argument('--job-id', default=None)
+    parser.add_argument('--ttl', type=float, default=DEFAULT_TTL, help='seconds a resolved tag is reused by other jobs')
+    parser.add_argument('--state-file', help='state file, %s in DOCKER_IMAGE_STATE_DIR or a directory of the user by default' % STATE_FILE)
+    args = parser.parse_args()
+
+    print(resolve(args.image, job_id=args.job_id, ttl=args.ttl, state_file=args.state_file))
+
+
+if __name__ == "__main__":
+    main()
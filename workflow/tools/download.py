@@ -1,20 +1,41 @@
 #!/usr/bin/env python3
 import yaml
 import os
-import subprocess
 import sys
 import json
 import re
+import collections
+import hashlib
+import http.client
+import subprocess
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import task_cache
+import instrument
+import scratch_plan
 
 """
 Major steps:
 - identify all input files and their associated read group(s), pairing of paired-end FASTQ
   files must be properly recorded
-- download the files
+- download the files, several objects at a time, each one is verified against fileSize and
+  fileMd5sum from the metadata. score-client resolves the URL of an object, its parts are then
+  fetched with HTTP range requests, PART_WORKERS side by side, and written and hashed in order
+  as they come in, so the md5 is known once the last part is written, the file is not read
+  again. At most 2 * PART_WORKERS parts of an object are held in memory
+- the first failed download stops the others, the pending ones are not started
+- before anything is downloaded, the scratch space of the job is predicted from the fileSize
+  of the input files (scratch_plan.py), a job that would not fit in its scratch quota fails
+  here instead of when the disk is full
 """
 
 task_dict = json.loads(sys.argv[1])
 
+if task_cache.restore(task_dict):
+    sys.exit()
+
 cwd = os.getcwd()
 
 # read the json file
@@ -27,99 +48,212 @@ mapping = {
 }
 
 input_format = task_dict['input'].get('input_format')
+download_workers = int(task_dict['input'].get('download_workers') or 4)
 
 output = {
     'download_files': []
 }
 
+plan = scratch_plan.predict(metadata, eager=str(task_dict['input'].get('eager_cleanup')).lower() == 'true',
+                            cram=str(task_dict['input'].get('cram_primary')).lower() == 'true')
+with open('scratch_plan.json', 'w') as f:
+    f.write(json.dumps(plan, indent=2))
+scratch_quota_gb = task_dict['input'].get('scratch_quota_gb')
+if scratch_quota_gb and plan['peak_gb'] > float(scratch_quota_gb):
+    sys.exit('\nThe job is predicted to need %s GB of scratch space at its peak (%s), more than the quota of %s GB' %
+             (plan['peak_gb'], ', '.join(['%s: %s GB' % (s['stage'], s['peak_gb']) for s in plan['stages']]),
+              scratch_quota_gb))
+free = scratch_plan.free_gb(cwd)
+if plan['peak_gb'] > free:
+    print('The job is predicted to need %s GB of scratch space at its peak, %s GB are free' %
+          (plan['peak_gb'], round(free, 3)), file=sys.stderr)
+
+PART_SIZE = 16 * 1024 * 1024
+PART_WORKERS = 4
+PART_RETRIES = 3
+
+running = set()
+running_lock = threading.Lock()
+stopped = threading.Event()
+
+
+def object_url(storage_site, object_id):
+    """ Presigned URL of the object, the last URL score-client prints """
+    p = instrument.Popen(['score-client',
+                          '--profile', mapping.get(storage_site),
+                          'url',
+                          '--object-id', object_id], label='score-client url',
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    with running_lock:
+        # started while the downloads were being stopped
+        if stopped.is_set(): p.terminate()
+        running.add(p)
+    try:
+        out = p.communicate()[0]
+    finally:
+        with running_lock:
+            running.discard(p)
+
+    if p.returncode != 0:
+        raise Exception('score-client exited with code %s' % p.returncode)
+    urls = [l.strip() for l in out.splitlines() if l.strip().split('://', 1)[0] in ('http', 'https', 'file')]
+    if not urls:
+        raise Exception('score-client did not resolve a URL for %s' % object_id)
+    return urls[-1]
+
+
+def fetch_range(url, start, end, length):
+    """ Bytes 'start' to 'end' (included) of the object at 'url', 'length' of them expected """
+    if url.startswith('file://'):
+        with open(url[len('file://'):], 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start + 1)
+    else:
+        request = urllib.request.Request(url, headers={'Range': 'bytes=%s-%s' % (start, end)})
+        with urllib.request.urlopen(request, timeout=60) as r:
+            data = r.read()
+    # also a server ignoring the range
+    if len(data) != length:
+        raise ValueError('got %s bytes for the range %s-%s, expected %s' % (len(data), start, end, length))
+    return data
+
+
+def fetch_part(url, start, end, length):
+    for attempt in range(PART_RETRIES + 1):
+        if stopped.is_set():
+            raise Exception('stopped, another download failed')
+        try:
+            return fetch_range(url, start, end, length)
+        except (OSError, http.client.HTTPException):
+            if attempt == PART_RETRIES:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def fetch_object(url, path, size):
+    """ Writes the object at 'url', of 'size' bytes, to 'path', returns its md5 """
+    md5 = hashlib.md5()
+    pending = collections.deque()
+
+    def write_next():
+        data = pending.popleft().result()
+        md5.update(data)
+        f.write(data)
+
+    with ThreadPoolExecutor(max_workers=PART_WORKERS) as parts, open(path, 'wb') as f:
+        try:
+            for start in range(0, size, PART_SIZE):
+                end = min(start + PART_SIZE, size) - 1
+                # the last part asks for one byte more, an object larger than its fileSize does not pass
+                pending.append(parts.submit(fetch_part, url, start, end + (end == size - 1), end - start + 1))
+                if len(pending) == 2 * PART_WORKERS:
+                    write_next()
+            while pending:
+                write_next()
+        finally:
+            for part in pending: part.cancel()
+    return md5.hexdigest()
+
+
+def download_object(storage_site, object_id, file_name, file_size, file_md5sum):
+    file_with_path = os.path.join(cwd, file_name)
+    # start clean, a stale file from an earlier attempt must not pass for the download
+    if os.path.isfile(file_with_path): os.remove(file_with_path)
+
+    if not file_size:
+        raise Exception('no fileSize for %s, the parts of the object cannot be fetched' % file_name)
+    md5sum = fetch_object(object_url(storage_site, object_id), file_with_path, int(file_size))
+
+    if stopped.is_set():
+        raise Exception('stopped, another download failed')
+    if file_md5sum and md5sum != file_md5sum:
+        raise Exception('md5sum mismatch for %s: expected %s' % (file_name, file_md5sum))
+    if file_md5sum:
+        # the task keys of the tasks reading it need not hash it again
+        task_cache.remember_md5(file_with_path, file_md5sum)
+
+    return file_with_path
+
+
+def local_file(file_path, file_name, file_size):
+    # file_path provides file_name not only the path information
+    file_path_dir = os.path.dirname(file_path.replace('file://', ''))
+    if file_path_dir.startswith('/'):
+        file_with_path = os.path.join(file_path_dir, file_name)
+    else:
+        file_with_path = os.path.join(cwd, file_path_dir, file_name)
+
+    if not os.path.isfile(file_with_path):
+        sys.exit('\nLocal file not found: %s' % file_with_path)
+    if file_size and os.path.getsize(file_with_path) != int(file_size):
+        sys.exit('\nSize mismatch for local file %s: expected %s, got %s' %
+                 (file_with_path, file_size, os.path.getsize(file_with_path)))
+
+    return file_with_path
+
 
 if input_format == 'BAM':
-    # download the file
     files = metadata.get('files')
-    for _file in files:
-        file_path = _file.get('path')
-        file_name = _file.get('fileName')
-
-        if file_path.startswith('song://'):
-            storage_site, analysis_id, object_id = file_path.replace('song://', '').split('/')
-
-            try:
-                subprocess.run(['score-client',
-                                         '--profile', mapping.get(storage_site),
-                                         'download',
-                                         '--object-id', object_id,
-                                         '--output-dir', cwd,
-                                         '--index', 'false',
-                                         '--force'], check=True)
-            except Exception as e:
-                sys.exit('\n%s: Download object failed: %s' % (e, object_id))
-
-            file_with_path = os.path.join(cwd, file_name)
-
-        elif file_path.startswith('file://'): # file_path provides file_name not only the path information
-            file_path_dir = os.path.dirname(file_path.replace('file://', ''))
-            if file_path_dir.startswith('/'):
-                file_with_path = os.path.join(file_path_dir, file_name)
-            else:
-                file_with_path = os.path.join(cwd, file_path_dir, file_name)
-
-        else:
-            sys.exit('\n Unrecognized file path!')
-
-        file_info = {
-            'name': file_name,
-            'path': file_path,
-            'local_path': file_with_path
-        }
-        output['download_files'].append(file_info)
-
 
 elif input_format == 'FASTQ':
-    readGroups = metadata.get('readGroups')
-    for rg in readGroups:
-        readGroupId = rg.get('readGroupId')
-        files = rg.get('files')
-        for _file in files:
-            file_path = _file.get('path')
-            file_name = _file.get('fileName')
-
-            if file_path.startswith('song://'):
-                storage_site, analysis_id, object_id = file_path.replace('song://', '').split('/')
-
-                try:
-                    subprocess.run(['score-client',
-                                    '--profile', mapping.get(storage_site),
-                                    'download',
-                                    '--object-id', object_id,
-                                    '--output-dir', cwd,
-                                    '--index', 'false',
-                                    '--force'], check=True)
-                except Exception as e:
-                    sys.exit('\n%s: Download object failed: %s' % (e, object_id))
-
-                file_with_path = os.path.join(cwd, _file.get('name'))
-
-            elif file_path.startswith('file://'):
-                file_path = os.path.dirname(file_path.replace('file://', ''))
-                if file_path.startswith('/'):
-                    file_with_path = os.path.join(file_path, _file.get('name'))
-                else:
-                    file_with_path = os.path.join(cwd, file_path, _file.get('name'))
-
-            else:
-                sys.exit('\n Unrecognized file path!')
-
-            file_info = {
-                'name': file_name,
-                'path': file_path,
-                'local_path': file_with_path
-            }
-            output['download_files'].append(file_info)
+    files = []
+    for rg in metadata.get('readGroups'):
+        files.extend(rg.get('files'))
 
     output['output_dir'] = os.getcwd()
 
 else:
     sys.exit('\n%s: Input files format are not FASTQ or BAM')
 
+
+# collect the files, song objects are downloaded concurrently below
+to_download = {}
+for _file in files:
+    file_path = _file.get('path')
+    file_name = _file.get('fileName')
+
+    if file_path.startswith('song://'):
+        storage_site, analysis_id, object_id = file_path.replace('song://', '').split('/')
+        file_with_path = os.path.join(cwd, file_name)
+        to_download[object_id] = (storage_site, object_id, file_name, _file.get('fileSize'), _file.get('fileMd5sum'))
+
+    elif file_path.startswith('file://'):
+        file_with_path = local_file(file_path, file_name, _file.get('fileSize'))
+
+    else:
+        sys.exit('\n Unrecognized file path!')
+
+    file_info = {
+        'name': file_name,
+        'path': file_path,
+        'local_path': file_with_path
+    }
+    output['download_files'].append(file_info)
+
+
+executor = ThreadPoolExecutor(max_workers=download_workers)
+futures = {executor.submit(download_object, *args): object_id for object_id, args in to_download.items()}
+failed = None
+for future in as_completed(futures):
+    try:
+        future.result()
+    except Exception as e:
+        failed = (e, futures[future])
+        break
+
+if failed:
+    # fail fast, the pending downloads are dropped and the running ones stopped, without
+    # waiting for them
+    for f in futures: f.cancel()
+    with running_lock:
+        stopped.set()
+        for p in running: p.terminate()
+    executor.shutdown(wait=False)
+    sys.exit('\n%s: Download object failed: %s' % failed)
+executor.shutdown()
+
+
 with open("output.json", "w") as o:
     o.write(json.dumps(output))
+
+task_cache.save(task_dict)
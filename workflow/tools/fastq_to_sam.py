@@ -1,23 +1,44 @@
 #!/usr/bin/env python3
 
 import os
-import subprocess
 import sys
 import json
 import re
+import picard_batch
+import intermediate_codec
+import quality_yield_metrics
+from concurrent.futures import ProcessPoolExecutor
+from readgroup_metadata import comments
+import task_cache
+import scratch_plan
 
 """
 Major steps:
 - convert FASTQ to unaligned BAM for each read group
+- in streaming mode no BAM is written, instead a <rg>.lane.bam.stream.json spec holding the
+  FastqToSam command is produced, bwa_mem_aligner_wrapper.py runs it and pipes its output
+  straight into the alignment. The quality yield metrics of streamed lanes are computed from
+  the FASTQ bytes fed to that FastqToSam, their coverage is checked once they are aligned
+- with native_qc, the quality yield metrics of each read group are computed from the FASTQs
+  alongside FastqToSam, lane_bam_qc.py then does not need its own pass over the lane BAMs
+- with eager_cleanup, the downloaded FASTQs of a read group are deleted as soon as its lane
+  BAM (and metrics) are written, the FASTQs of streamed lanes are needed during the alignment
 """
 
 task_dict = json.loads(sys.argv[1])
 
+if task_cache.restore(task_dict):
+    sys.exit()
+
 cwd = os.getcwd()
 
 picard = task_dict['input'].get('picard_jar')
 input_format = task_dict['input'].get('input_format')
 download_files = task_dict['input'].get('download_files')
+picard_workers = int(task_dict['input'].get('picard_workers') or 1)
+streaming = str(task_dict['input'].get('streaming')).lower() == 'true'
+native_qc = str(task_dict['input'].get('native_qc')).lower() == 'true'
+eager_cleanup = str(task_dict['input'].get('eager_cleanup')).lower() == 'true'
 
 with open(task_dict['input'].get('metadata_json'), 'r') as f:
     metadata = json.load(f)
@@ -26,17 +47,9 @@ output = {
     'bams': []
 }
 
-case_map = {
-    'study': 'dcc_project_code',
-    'donorSubmitterId': 'submitter_donor_id',
-    'specimenSubmitterId': 'submitter_specimen_id',
-    'sampleSubmitterId': 'submitter_sample_id',
-    'specimenType': 'dcc_specimen_type',
-    'libraryStrategy': 'library_strategy',
-    'useCntl': 'use_cntl'
-}
-
 if input_format == 'FASTQ':
+    invocations = []
+    qc_fastqs = {}
     readGroups = metadata.get('readGroups')
     for rg in readGroups:
         readGroupId = rg.get('readGroupId')
@@ -71,22 +84,66 @@ if input_format == 'FASTQ':
         if rg.get('platformModel') and str(rg.get('platformModel')) != '':
             rg_args.append('PLATFORM_MODEL=%s' % rg.get('platformModel'))
 
-        for ct in ['study', 'donorSubmitterId', 'specimenSubmitterId', 'sampleSubmitterId', 'specimenType', 'libraryStrategy', 'useCntl']:
-            rg_args.append('COMMENT=%s:%s' % (case_map.get(ct), metadata.get(ct)))
+        rg_args.extend(['COMMENT=%s' % c for c in comments(metadata)])
 
 
         # convert pair end fastq to unaligned and lane level bam sorted by query name
         # convert readGroupId to filename friendly
         rg_fname = "".join([ c if re.match(r"[a-zA-Z0-9\-_]", c) else "_" for c in readGroupId ])
-        try:
-            subprocess.run(['java', '-jar', picard,
-                            'FastqToSam', 'FASTQ=%s' % file_with_path[0],
-                            'FASTQ2=%s' % file_with_path[1],
-                            'OUTPUT=%s' % os.path.join(cwd, rg_fname + '.lane.bam')] + rg_args, check=True)
-        except Exception as e:
-            sys.exit('\n%s: FastqToSam failed: %s and %s' % (e, file_with_path[0], file_with_path[1]))
-
+        if streaming:
+            # the FASTQs are given to FastqToSam when the lane is aligned
+            stream_spec = os.path.join(cwd, rg_fname + '.lane.bam.stream.json')
+            with open(stream_spec, 'w') as s:
+                s.write(json.dumps({
+                    'picard_jar': picard,
+                    'args': ['FastqToSam'] + rg_args + intermediate_codec.picard_args(piped=True),
+                    'fastqs': file_with_path,
+                    'metrics': os.path.join(cwd, rg_fname + '.lane.bam.quality_yield_metrics.txt')
+                }))
+            output['bams'].append(stream_spec)
+            continue
+
+        fastq_to_sam_args = ['FastqToSam', 'FASTQ=%s' % file_with_path[0],
+                             'FASTQ2=%s' % file_with_path[1]] + rg_args + \
+                            intermediate_codec.picard_args()
+        invocations.append(fastq_to_sam_args + ['OUTPUT=%s' % os.path.join(cwd, rg_fname + '.lane.bam')])
         output['bams'].append(os.path.join(cwd, rg_fname + '.lane.bam'))
+        qc_fastqs[os.path.join(cwd, rg_fname + '.lane.bam.quality_yield_metrics.txt')] = file_with_path
+
+    with ProcessPoolExecutor(max_workers=max(1, min(len(qc_fastqs), os.cpu_count() or 1))) as executor:
+        # the metrics are computed while the JVMs read the same FASTQs
+        qc_futures = {}
+        if native_qc:
+            qc_futures = {executor.submit(quality_yield_metrics.fastq_metrics, fastqs): metrics_file
+                          for metrics_file, fastqs in qc_fastqs.items()}
+
+        # the FASTQs of a read group are read by its FastqToSam and by its metrics computation
+        metrics_futures = dict([(m, f) for f, m in qc_futures.items()])
+        converted = []
+
+        def cleanup(index=None, result=None):
+            if result is not None and result['returncode'] == 0:
+                converted.append(list(qc_fastqs)[index])
+            for metrics_file in list(converted):
+                if metrics_file not in metrics_futures or metrics_futures[metrics_file].done():
+                    scratch_plan.remove_intermediates(qc_fastqs[metrics_file], cwd)
+                    converted.remove(metrics_file)
+
+        # all read groups go through the same few JVMs
+        for result in picard_batch.run_batch(picard, invocations, workers=picard_workers,
+                                             java_opts=intermediate_codec.JAVA_OPTS,
+                                             on_result=cleanup if eager_cleanup else None):
+            if result['returncode'] != 0:
+                sys.exit('\nexit status %s: FastqToSam failed: %s' % (result['returncode'], ' and '.join(result['args'][1:3])))
+
+        for future, metrics_file in qc_futures.items():
+            fastqs = qc_fastqs[metrics_file]
+            try:
+                quality_yield_metrics.write_metrics(future.result(), metrics_file, ' '.join(fastqs))
+            except Exception as e:
+                sys.exit('\n%s: Quality yield metrics failed: %s' % (e, ' and '.join(fastqs)))
+        if eager_cleanup:
+            cleanup()
 
 # the inputs are BAM
 elif input_format == 'BAM':
@@ -98,3 +155,4 @@ else:
 with open("output.json", "w") as o:
     o.write(json.dumps(output))
 
+task_cache.save(task_dict)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+md5/size helpers shared by the tools:
+- md5_file: plain chunked md5 of a file
+- sidecars: <file>.checksum.json holding the md5 and size of a published file, read by the
+  SONG payload step and the upload manifest instead of the file. aligned_bam_qc.py writes the
+  ones of the merged BAM or CRAM from the read its collectors need anyway, and of the index;
+    file_checksum.py --output <file> [--output <file> ...] -- <command writing the files>
+  runs a command and hashes its outputs in full once it succeeded, for small files only (the
+  QC tarball): it reads the files again
+"""
+
+CHUNK_SIZE = 8 * 1024 * 1024
+SIDECAR_SUFFIX = '.checksum.json'
+
+
+def md5_file(path, chunk_size=CHUNK_SIZE):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def checksum(path):
+    """ (md5, size) of the file at 'path', None if it changed while it was read """
+    before = os.stat(path)
+    md5sum = md5_file(path)
+    after = os.stat(path)
+    if (before.st_ino, before.st_size, before.st_mtime_ns) != (after.st_ino, after.st_size, after.st_mtime_ns):
+        return None
+    return md5sum, after.st_size
+
+
+def write_sidecar(path, md5sum, size):
+    with open(path + SIDECAR_SUFFIX, 'w') as s:
+        s.write(json.dumps({
+            'fileName': os.path.basename(path),
+            'fileSize': size,
+            'fileMd5sum': md5sum,
+            'mtime_ns': os.stat(path).st_mtime_ns
+        }))
+
+
+def read_sidecar(path):
+    """ (md5, size) from the sidecar of 'path', None if there is none or the file changed since """
+    try:
+        with open(path + SIDECAR_SUFFIX, 'r') as s:
+            sidecar = json.load(s)
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if st.st_size != sidecar.get('fileSize') or st.st_mtime_ns != sidecar.get('mtime_ns'):
+        return None
+    return sidecar['fileMd5sum'], sidecar['fileSize']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a command, writing md5/size sidecars of the files it wrote')
+    parser.add_argument('--output', action='append', default=[], help='output file of the command')
+    parser.add_argument('cmd', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    cmd = args.cmd[1:] if args.cmd and args.cmd[0] == '--' else args.cmd
+
+    paths = [os.path.abspath(p) for p in args.output]
+    for path in paths:
+        # a stale sidecar must not survive a failed run
+        if os.path.isfile(path + SIDECAR_SUFFIX): os.remove(path + SIDECAR_SUFFIX)
+
+    returncode = subprocess.call(cmd)
+    if returncode != 0:
+        sys.exit(returncode)
+
+    # outputs the command did not write (the BAM or the CRAM) have no sidecar
+    paths = [p for p in paths if os.path.isfile(p)]
+    with ThreadPoolExecutor(max_workers=max(1, len(paths))) as executor:
+        for path, result in zip(paths, executor.map(checksum, paths)):
+            if result:
+                write_sidecar(path, *result)
+            else:
+                print('No checksum sidecar for %s, it changed while it was read' % path, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import re
+import subprocess
+import sys
+from readgroup_metadata import rg_header_line
+import instrument
+import intermediate_codec
+
+"""
+One pass replacement for the RevertSam -> AddOrReplaceReadGroups -> AddCommentsToBam chain:
+- RevertSam writes the reverted, queryname sorted reads as SAM text to stdout
+- records are routed by their RG tag, the tag is set to the new read group ID and the
+  header gets the new @RG line and the @CO comments, like the three Picard steps would do
+- one SamFormatConverter per read group compresses its records into the final lane BAM
+- the records are routed by one Python thread, which can be slower than the Picard chain on
+  a large BAM, fused_revert stays off by default. benchmark/fused_revert_bench.py measures
+  the routing throughput and, given a picard.jar, compares both paths
+"""
+
+RG_TAG = re.compile(rb'\tRG:Z:([^\t\n]*)')
+
+
+def run(picard, revert_args, rg_replace, comments, outputs):
+    """
+    revert_args: RevertSam arguments without output
+    rg_replace: readGroupIdInFile -> new @RG fields, see readgroup_metadata.readgroup_replacements
+    outputs: readGroupIdInFile -> output lane BAM
+    Returns None on success, otherwise an error message.
+    """
+    try:
+        rg_lines = dict([(rg_old, rg_header_line(rg_new)) for rg_old, rg_new in rg_replace.items()])
+    except ValueError as e:
+        return str(e)
+
+    revert = instrument.Popen(['java'] + intermediate_codec.JAVA_OPTS + ['-jar', picard, 'RevertSam'] +
+                              revert_args + ['O=/dev/stdout'],
+                              label='RevertSam', stdout=subprocess.PIPE, bufsize=1024 * 1024)
+
+    # header, up to the first record
+    header = []
+    line = revert.stdout.readline()
+    while line.startswith(b'@'):
+        if not line.startswith(b'@RG\t'):
+            header.append(line)
+        line = revert.stdout.readline()
+
+    writers = {}
+    new_ids = {}
+    headers = {}
+    for rg_old, rg_new in rg_replace.items():
+        writers[rg_old.encode()] = instrument.Popen(['java'] + intermediate_codec.JAVA_OPTS +
+                                                    ['-jar', picard, 'SamFormatConverter',
+                                                     'VALIDATION_STRINGENCY=LENIENT',
+                                                     'I=/dev/stdin',
+                                                     'O=%s' % outputs[rg_old]] +
+                                                    intermediate_codec.picard_args(),
+                                                    label='SamFormatConverter', stdin=subprocess.PIPE, bufsize=1024 * 1024)
+        new_ids[rg_old.encode()] = ('\tRG:Z:%s' % rg_new.get('ID')).encode()
+        headers[rg_old.encode()] = b''.join(header) + (rg_lines[rg_old] + '\n').encode() + \
+            b''.join([('@CO\t%s\n' % c).encode() for c in comments])
+
+    broken = False
+    try:
+        for rg_old, w in writers.items():
+            w.stdin.write(headers[rg_old])
+        dropped = route(revert.stdout, line, dict([(rg, w.stdin) for rg, w in writers.items()]), new_ids)
+        if dropped:
+            print('%s records from read groups not in the metadata were dropped' % dropped, file=sys.stderr)
+    except BrokenPipeError:
+        # a writer is gone, RevertSam is stopped and the failure of the writer is reported
+        broken = True
+        revert.kill()
+
+    for w in writers.values():
+        try:
+            w.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    error = None
+    for rg_old, w in writers.items():
+        if w.wait() != 0 and error is None:
+            error = 'SamFormatConverter exited with %s for read group %s' % (w.returncode, rg_old.decode())
+    if broken and error is None:
+        error = 'a SamFormatConverter stopped reading its records'
+    if revert.wait() != 0 and error is None:
+        error = 'RevertSam exited with %s' % revert.returncode
+    return error
+
+
+def route(reader, line, sinks, new_ids):
+    """
+    Write the SAM records from 'line' on, and the rest of 'reader', to the sink of their read
+    group with the RG tag set to its new ID. Returns the number of records dropped, records of
+    read groups not listed in the metadata are dropped, as in the three step chain.
+    """
+    dropped = 0
+    while line:
+        m = RG_TAG.search(line)
+        rg_old = m.group(1) if m else None
+        if rg_old not in sinks:
+            dropped += 1
+        else:
+            sinks[rg_old].write(line[:m.start()] + new_ids[rg_old] + line[m.end():])
+        line = reader.readline()
+    return dropped
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import argparse
+import ctypes
+import fcntl
+import glob
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+"""
+Resource usage of the commands run by the tools:
+- run() and Popen() start the command under this script, which waits for it with wait4 and
+  records wall time, user/system CPU time, peak RSS and bytes read/written from block devices,
+  the usage of the command's own waited-for children included
+- for docker runs the container's cgroup is sampled as well, the docker client's usage says
+  nothing about the container
+- records go to resource_usage.json in the task directory, with a per task summary, the SONG
+  payload collects the summaries of all tasks of the job
+"""
+
+USAGE_FILE = 'resource_usage.json'
+CONTAINER_SAMPLE_INTERVAL = 5
+PR_SET_PDEATHSIG = 1
+
+
+def wrap(cmd, label=None, container=None):
+    wrapped = [sys.executable, os.path.abspath(__file__), '--usage-file', os.path.abspath(USAGE_FILE)]
+    if label:
+        wrapped += ['--label', label]
+    if container:
+        wrapped += ['--container', container]
+    return wrapped + ['--'] + list(cmd)
+
+
+def run(cmd, label=None, container=None, **kwargs):
+    return subprocess.run(wrap(cmd, label, container), **kwargs)
+
+
+def Popen(cmd, label=None, container=None, **kwargs):
+    return subprocess.Popen(wrap(cmd, label, container), **kwargs)
+
+
+def summarize(invocations):
+    return {
+        'invocations': len(invocations),
+        'wall_time_s': round(max([i['end_time'] for i in invocations]) - min([i['start_time'] for i in invocations]), 3),
+        'cpu_time_s': round(sum([i['user_time_s'] + i['system_time_s'] +
+                                 i.get('container', {}).get('cpu_time_s', 0) for i in invocations]), 3),
+        'max_rss_bytes': max([max(i['max_rss_bytes'], i.get('container', {}).get('max_memory_bytes', 0)) for i in invocations]),
+        'read_bytes': sum([i['read_bytes'] + i.get('container', {}).get('read_bytes', 0) for i in invocations]),
+        'write_bytes': sum([i['write_bytes'] + i.get('container', {}).get('write_bytes', 0) for i in invocations]),
+        'failed': len([i for i in invocations if i['returncode'] != 0])
+    }
+
+
+def add_record(usage_file, record):
+    with open(usage_file, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            usage = json.loads(f.read() or '{}')
+        except ValueError:
+            usage = {}
+        usage.setdefault('task', os.path.basename(os.path.dirname(usage_file)))
+        usage.setdefault('invocations', []).append(record)
+        usage['summary'] = summarize(usage['invocations'])
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(usage, indent=2))
+
+
+def cgroup_dir(container):
+    p = subprocess.run(['docker', 'inspect', '--format', '{{.Id}}', container],
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    container_id = p.stdout.strip()
+    if p.returncode != 0 or not container_id:
+        return None
+    for pattern in ['/sys/fs/cgroup/system.slice/docker-%s.scope', '/sys/fs/cgroup/docker/%s',
+                    '/sys/fs/cgroup/memory/docker/%s', '/sys/fs/cgroup/*/docker-%s.scope']:
+        found = glob.glob(pattern % container_id)
+        if found:
+            return found[0]
+    return None
+
+
+def read_cgroup(path):
+    """ Cumulative usage of a cgroup, v2 layout or the v1 memory/cpuacct/blkio controllers """
+    def read(name, root=path):
+        with open(os.path.join(root, name), 'r') as f:
+            return f.read()
+
+    usage = {}
+    if os.path.isfile(os.path.join(path, 'cpu.stat')):
+        stat = dict([l.split() for l in read('cpu.stat').splitlines()])
+        usage['cpu_time_s'] = int(stat['usage_usec']) / 1e6
+        usage['max_memory_bytes'] = int((read('memory.peak') if os.path.isfile(os.path.join(path, 'memory.peak'))
+                                         else read('memory.current')).strip())
+        usage['read_bytes'] = usage['write_bytes'] = 0
+        for line in read('io.stat').splitlines():
+            for field in line.split()[1:]:
+                k, v = field.split('=')
+                if k in ('rbytes', 'wbytes'):
+                    usage['read_bytes' if k == 'rbytes' else 'write_bytes'] += int(v)
+    else:
+        v1 = lambda controller: path.replace('/memory/', '/%s/' % controller)
+        usage['max_memory_bytes'] = int(read('memory.max_usage_in_bytes').strip())
+        usage['cpu_time_s'] = int(read('cpuacct.usage', v1('cpuacct')).strip()) / 1e9
+        usage['read_bytes'] = usage['write_bytes'] = 0
+        for line in read('blkio.throttle.io_service_bytes', v1('blkio')).splitlines():
+            fields = line.split()
+            if len(fields) == 3 and fields[1] in ('Read', 'Write'):
+                usage['read_bytes' if fields[1] == 'Read' else 'write_bytes'] += int(fields[2])
+    return usage
+
+
+def sample_container(container, result, done):
+    path = None
+    while not done.is_set():
+        try:
+            path = path or cgroup_dir(container)
+            if path:
+                sample = read_cgroup(path)
+                sample['max_memory_bytes'] = max(sample['max_memory_bytes'], result.get('max_memory_bytes', 0))
+                result.update(sample)
+        except (OSError, ValueError, KeyError):
+            pass
+        done.wait(CONTAINER_SAMPLE_INTERVAL)
+
+
+def die_with_parent():
+    try:
+        ctypes.CDLL(None).prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+    except (OSError, AttributeError):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a command and record its resource usage')
+    parser.add_argument('--usage-file', default=USAGE_FILE)
+    parser.add_argument('--label', default=None)
+    parser.add_argument('--container', default=None)
+    parser.add_argument('cmd', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    cmd = args.cmd[1:] if args.cmd and args.cmd[0] == '--' else args.cmd
+
+    start_time = time.time()
+    child = subprocess.Popen(cmd, preexec_fn=die_with_parent)
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(sig, lambda signum, frame: child.send_signal(signum))
+
+    container, done = {}, threading.Event()
+    if args.container:
+        threading.Thread(target=sample_container, args=(args.container, container, done), daemon=True).start()
+
+    while True:
+        try:
+            _, status, rusage = os.wait4(child.pid, 0)
+            break
+        except InterruptedError:
+            continue
+    end_time = time.time()
+    done.set()
+    returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+    record = {
+        'label': args.label or os.path.basename(cmd[0]),
+        'cmd': cmd,
+        'start_time': start_time,
+        'end_time': end_time,
+        'wall_time_s': round(end_time - start_time, 3),
+        'user_time_s': rusage.ru_utime,
+        'system_time_s': rusage.ru_stime,
+        'max_rss_bytes': rusage.ru_maxrss * 1024,
+        # block device I/O, reads served from the page cache are not counted
+        'read_bytes': rusage.ru_inblock * 512,
+        'write_bytes': rusage.ru_oublock * 512,
+        'returncode': returncode
+    }
+    if container:
+        record['container'] = container
+    try:
+        add_record(args.usage_file, record)
+    except OSError as e:
+        print('Could not record resource usage: %s' % e, file=sys.stderr)
+
+    if returncode < 0:
+        signal.signal(-returncode, signal.SIG_DFL)
+        os.kill(os.getpid(), -returncode)
+    sys.exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
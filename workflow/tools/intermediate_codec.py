@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+import os
+
+"""
+Compression of the intermediate BAMs, the lane BAMs and the per read group BAMs before them,
+each one written by a step, read by the next one or two and deleted:
+- they are written at BGZF level LEVEL instead of Picard's default of 5, level 0 writes
+  stored blocks, an uncompressed BAM. The merged BAM and the CRAM come out of the merge
+  image and keep their compression
+- what goes through a pipe (the FastqToSam of a streamed lane) never hits the disk, it is
+  written at level 0
+- the JVMs read and write through the asynchronous I/O of htsjdk, the blocks are compressed
+  in a thread of its own next to the one producing the records
+- INTERMEDIATE_COMPRESSION sets another level for the node, e.g. a higher one where the
+  scratch disk is slow or small, benchmark/codec_bench.py measures the trade-off
+"""
+
+LEVEL = 1
+PIPE_LEVEL = 0
+DEFAULT_PICARD_LEVEL = 5
+JAVA_OPTS = ['-Dsamjdk.use_async_io_read_samtools=true', '-Dsamjdk.use_async_io_write_samtools=true']
+# size of a BAM relative to one written at Picard's default level, for the scratch space
+SIZE_FACTOR = {0: 3.0, 1: 1.15, 2: 1.1, 3: 1.05, 4: 1.02}
+
+
+def level():
+    return int(os.environ.get('INTERMEDIATE_COMPRESSION', LEVEL))
+
+
+def picard_args(piped=False):
+    """ Picard arguments of a step writing an intermediate BAM """
+    return ['COMPRESSION_LEVEL=%s' % (PIPE_LEVEL if piped else level())]
+
+
+def size_factor():
+    return SIZE_FACTOR.get(level(), 1.0)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import picard_batch
+import quality_yield_metrics
+import task_cache
+
+"""
+Major steps:
+- collect quality yield metrics for the lane BAMs in parallel, largest lanes first, lanes
+  whose metrics were already computed during FASTQ ingest are not read again. Streamed lanes
+  have no lane BAM, their metrics are written while they are aligned
+- check the pass filter coverage of all lanes together against min_coverage, with streamed
+  lanes bwa_mem_aligner_wrapper.py checks it once their bases are counted
+- early_gate_slack, off by default: rejects the sample before all lanes are done when the
+  lanes left can not bring it above min_coverage, assuming they yield at most this many times
+  the PF bases per BAM byte of the best lane seen so far. The PF bases of a lane BAM are not
+  bounded by its size (compression depends on read length, quality binning and duplication),
+  so this is a guess a sample can fail by, only for inputs whose lanes compress alike
+"""
+
+task_dict = json.loads(sys.argv[1])
+
+if task_cache.restore(task_dict):
+    sys.exit()
+
+picard = task_dict['input'].get('picard_jar')
+lane_bams = task_dict['input'].get('lane_bams')
+min_coverage = float(task_dict['input'].get('min_coverage'))
+early_gate_slack = task_dict['input'].get('early_gate_slack')
+early_gate_slack = float(early_gate_slack) if early_gate_slack else None
+
+metrics = []
+precomputed = []
+streamed = []
+lanes = []
+lane_bam_qc_dir = None
+for bam in lane_bams:
+    lane_bam_qc_dir = os.path.dirname(os.path.abspath(bam))
+    if bam.endswith('.stream.json'):
+        streamed.append(bam)
+        continue
+    metrics_file = '%s.quality_yield_metrics.txt' % bam
+    metrics.append(metrics_file)
+    # already computed during FASTQ ingest
+    if os.path.isfile(metrics_file):
+        precomputed.append(metrics_file)
+        continue
+    lanes.append((os.path.getsize(bam) if os.path.isfile(bam) else 0, bam, metrics_file))
+
+lanes.sort(key=lambda l: l[0], reverse=True)
+picard_workers = int(task_dict['input'].get('picard_workers') or min(len(lanes), os.cpu_count() or 1) or 1)
+
+pf_bases = sum([quality_yield_metrics.get_pf_bases(m) for m in precomputed])
+done = set()
+best_bases_per_byte = 0
+coverage_upper_bound = None
+failed = None
+
+
+def on_result(i, result):
+    global pf_bases, best_bases_per_byte, coverage_upper_bound, failed
+    size, bam, metrics_file = lanes[i]
+    if result['returncode'] != 0:
+        failed = result
+        return True
+
+    lane_pf_bases = quality_yield_metrics.get_pf_bases(metrics_file)
+    pf_bases += lane_pf_bases
+    done.add(i)
+    if not size or early_gate_slack is None:
+        return False
+
+    # early coverage gate
+    best_bases_per_byte = max(best_bases_per_byte, float(lane_pf_bases) / size)
+    bytes_left = sum([lanes[j][0] for j in range(len(lanes)) if j not in done])
+    coverage_upper_bound = (pf_bases + bytes_left * best_bases_per_byte * early_gate_slack) / quality_yield_metrics.GENOME_SIZE
+    return coverage_upper_bound < min_coverage
+
+
+picard_batch.run_batch(picard, [['CollectQualityYieldMetrics', 'I=%s' % bam, 'O=%s' % m] for _, bam, m in lanes],
+                       workers=picard_workers, on_result=on_result)
+
+if failed:
+    sys.exit('\nexit status %s: CollectQualityYieldMetrics failed: %s' % (failed['returncode'], failed['args'][1][len('I='):]))
+
+coverage = pf_bases / quality_yield_metrics.GENOME_SIZE
+pass_cov = False if coverage < min_coverage and not streamed else True
+
+output = {
+    'metrics': metrics,
+    'lane_bam_qc_dir': lane_bam_qc_dir,
+    'coverage': coverage,
+    'pass_cov': pass_cov
+}
+
+if len(done) < len(lanes):
+    finished = set(precomputed + [lanes[i][2] for i in done])
+    output['metrics'] = [m for m in metrics if m in finished]
+    output['coverage_upper_bound'] = coverage_upper_bound
+
+with open("output.json", "w") as o:
+    o.write(json.dumps(output))
+
+if len(done) < len(lanes):
+    sys.exit('Pass filter coverage can not reach %s, at most %.2f with %s of %s lanes done' %
+             (min_coverage, coverage_upper_bound, len(done), len(lanes)))
+
+if not pass_cov:
+    sys.exit('Pass filter coverage lower than %s' % min_coverage)
+
+task_cache.save(task_dict, extra_files=metrics)
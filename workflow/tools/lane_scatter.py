@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import glob
+import os
+import shutil
+import resource_scheduler
+import intermediate_codec
+
+"""
+Scatter of oversized lanes ahead of the alignment, so one deep lane does not hold up the job:
+- a lane BAM is split into chunks of a fixed number of read pairs by Picard
+  SplitSamByNumberOfReads. The lane BAMs are queryname sorted, the reads of a pair stay in the
+  same chunk
+- the chunks keep the header of the lane, its @RG line and the comments, each one is aligned
+  as a lane of its own. The aligned chunks go to bam_merge_sort_markdup with the other aligned
+  lanes, it merges the read groups and programs of the same ID, there is no gather pass
+- the chunks are written at the level of the intermediate BAMs (intermediate_codec.py), they
+  are read once and deleted
+"""
+
+# read pairs per chunk, about 3 GB of lane BAM for 2x150 reads
+CHUNK_READ_PAIRS = 20000000
+SPLIT_MEM_GB = 2
+
+
+def chunk_prefix(lane_bam):
+    name = os.path.basename(lane_bam)
+    return (name[:-len('.lane.bam')] if name.endswith('.lane.bam') else name[:-len('.bam')]) + '.chunk'
+
+
+def split(picard, lane_bams, out_dir, chunk_read_pairs=None, workers=1):
+    """
+    Returns ({lane BAM: [chunk BAMs]}, None) on success, otherwise (None, error message). A lane
+    that fits in one chunk is not split, its list is empty.
+    """
+    chunk_read_pairs = int(chunk_read_pairs or CHUNK_READ_PAIRS)
+    jobs = []
+    for lane_bam in lane_bams:
+        chunk_dir = os.path.join(out_dir, chunk_prefix(lane_bam))
+        if os.path.isdir(chunk_dir): shutil.rmtree(chunk_dir)
+        os.makedirs(chunk_dir)
+        jobs.append({
+            'name': lane_bam,
+            'chunk_dir': chunk_dir,
+            'cmd': ['java', '-Xmx%sg' % SPLIT_MEM_GB] + intermediate_codec.JAVA_OPTS +
+                   ['-jar', picard, 'SplitSamByNumberOfReads',
+                    'I=%s' % lane_bam, 'OUTPUT=%s' % chunk_dir, 'OUT_PREFIX=%s' % chunk_prefix(lane_bam),
+                    'SPLIT_TO_N_READS=%s' % (2 * chunk_read_pairs),
+                    'VALIDATION_STRINGENCY=LENIENT'] + intermediate_codec.picard_args(),
+            'cpus': 1,
+            'mem': SPLIT_MEM_GB,
+            'label': 'SplitSamByNumberOfReads %s' % os.path.basename(lane_bam)
+        })
+
+    failed = resource_scheduler.run_jobs(jobs, workers, max(SPLIT_MEM_GB, workers * SPLIT_MEM_GB), poll_interval=1)
+    if failed:
+        return None, 'splitting %s failed with %s' % (os.path.basename(failed['name']), failed['returncode'])
+
+    chunks = {}
+    for job in jobs:
+        chunks[job['name']] = sorted(glob.glob(os.path.join(job['chunk_dir'], '*.bam')))
+        if len(chunks[job['name']]) < 2:
+            shutil.rmtree(job['chunk_dir'])
+            chunks[job['name']] = []
+    return chunks, None
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import yaml
+
+"""
+Runs the tasks of workflow/main.jt on the local node without JTracker, for the benchmark
+and the batch mode:
+- the tasks run one after the other, in dependency order, in a job directory laid out as
+  JTracker does (<job dir>/task.<name>)
+- python tools get the task JSON as their argument, shell commands get their ${...}
+  placeholders filled in and call the tools by name from the PATH (see write_shims)
+- a task's output.json feeds the inputs of the tasks downstream, the first failing task
+  ends the job
+"""
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKFLOW = os.path.join(TOOLS_DIR, '..', 'main.jt')
+PLACEHOLDER = re.compile(r"\$\{(?:sep='([^']*)'\s+)?(\w+)\}")
+# default of an is_file input that JTracker downloads: [file name]url
+URL_DEFAULT = re.compile(r'^\[([^\]]+)\](\w+://.+)$')
+
+
+def load_workflow(path=WORKFLOW):
+    with open(path, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def default_inputs(workflow):
+    return {k: v.get('default') for k, v in workflow['workflow']['input'].items()}
+
+
+def task_order(tasks):
+    """ Task names in an order where every task comes after the tasks it takes input from or depends on """
+    def upstream(task):
+        refs = [str(v).split('@', 1)[1] for v in (task.get('input') or {}).values() if '@' in str(v)]
+        return set(refs + [d.split('@', 1)[1] for d in task.get('depends_on') or []])
+
+    order, todo = [], dict(tasks)
+    while todo:
+        ready = [name for name, task in todo.items() if upstream(task) <= set(order)]
+        if not ready:
+            sys.exit('Circular or missing task dependencies: %s' % ', '.join(todo))
+        for name in ready:
+            order.append(name)
+            del todo[name]
+    return order
+
+
+def render(command, values):
+    def value(m):
+        v = values.get(m.group(2))
+        if isinstance(v, list):
+            return (m.group(1) if m.group(1) is not None else ' ').join([str(i) for i in v])
+        return '' if v is None else str(v)
+    return PLACEHOLDER.sub(value, command)
+
+
+def write_shims(shim_dir):
+    """ The shell commands call the tools by name, as JTracker puts them on the PATH """
+    os.makedirs(shim_dir, exist_ok=True)
+    for tool in os.listdir(TOOLS_DIR):
+        if tool.endswith('.py'):
+            shim = os.path.join(shim_dir, tool)
+            with open(shim, 'w') as f:
+                f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, os.path.join(TOOLS_DIR, tool)))
+            os.chmod(shim, 0o755)
+
+
+def run_job(workflow, inputs, job_dir, env, outputs=None, runner='local_runner'):
+    """
+    Runs the tasks of the workflow, returns a list of per task results, up to the first failure.
+    The output.json of each task that succeeded is put in 'outputs' under the task name.
+    """
+    wf = workflow['workflow']
+    builtins = {'_job_id': os.path.basename(job_dir), '_wf_name': wf['name'],
+                '_wf_version': wf['version'], '_jt_exec_version': runner}
+    outputs = {} if outputs is None else outputs
+    results = []
+    for name in task_order(wf['tasks']):
+        task = wf['tasks'][name]
+        tool = workflow['tools'][task['tool']]
+        task_input = {}
+        for key, ref in (task.get('input') or {}).items():
+            if '@' in str(ref):
+                output_key, upstream = ref.split('@', 1)
+                task_input[key] = outputs[upstream].get(output_key)
+            else:
+                task_input[key] = inputs.get(ref)
+
+        task_dir = os.path.join(job_dir, 'task.%s' % name)
+        os.makedirs(task_dir)
+        command = tool['command'].strip()
+        if re.match(r'^[\w.-]+\.py$', command):
+            cmd = [sys.executable, os.path.join(TOOLS_DIR, command), json.dumps({'input': task_input})]
+        else:
+            cmd = ['bash', '-c', render(command, dict(task_input, **builtins))]
+
+        start = time.time()
+        with open(os.path.join(task_dir, 'stdout.log'), 'w') as out, open(os.path.join(task_dir, 'stderr.log'), 'w') as err:
+            returncode = subprocess.call(cmd, cwd=task_dir, env=env, stdout=out, stderr=err)
+        result = {'task': name, 'seconds': round(time.time() - start, 3), 'returncode': returncode}
+
+        usage_file = os.path.join(task_dir, 'resource_usage.json')
+        if os.path.isfile(usage_file):
+            with open(usage_file, 'r') as f:
+                result['cpu_time_s'] = json.load(f)['summary']['cpu_time_s']
+        results.append(result)
+        if returncode != 0 or not os.path.isfile(os.path.join(task_dir, 'output.json')):
+            with open(os.path.join(task_dir, 'stderr.log'), 'r') as f:
+                result['error'] = f.read()[-2000:]
+            break
+        with open(os.path.join(task_dir, 'output.json'), 'r') as f:
+            outputs[name] = json.load(f)
+    return results
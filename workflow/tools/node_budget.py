@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+import resource_scheduler
+
+"""
+Node-wide CPU/RAM/scratch budget shared by the jobs running side by side on a node. Enabled
+by the NODE_BUDGET_DIR environment variable:
+- the budget and the grants are kept in <NODE_BUDGET_DIR>/budget.json, locked while read and
+  updated, grants of processes that are gone are reclaimed
+- a job asking for more than is free waits, as does a job holding more grants than another
+  waiting job whose request would fit, so lane level work of different jobs gets interleaved
+  instead of the first job taking the whole node. A request larger than the budget is cut
+  down to it
+resource_scheduler.run_jobs takes its grants from here, batch_runner.py holds the predicted
+scratch space of each aliquot for as long as its job runs.
+"""
+
+STATE_FILE = 'budget.json'
+# a waiting job that has not asked again within this many seconds no longer holds back others
+WAIT_EXPIRY = 60
+
+
+def budget_dir():
+    return os.environ.get('NODE_BUDGET_DIR')
+
+
+def job_id():
+    """ The job a task belongs to, its directory is <job dir>/task.<name> """
+    return os.path.basename(os.path.dirname(os.getcwd()))
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def update(directory, change):
+    """ Calls change(state) with the locked state, saves and returns what it returned """
+    if not os.path.isdir(directory): os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, STATE_FILE), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            state = json.loads(f.read() or '{}')
+        except ValueError:
+            state = {}
+        if 'total' not in state:
+            state['total'] = {'cpus': resource_scheduler.total_cpus(), 'mem': resource_scheduler.total_mem_gb(),
+                              'scratch': shutil.disk_usage(directory).free / 1024 ** 3}
+        state.setdefault('grants', {})
+        state.setdefault('waiting', {})
+        state['grants'] = {g: v for g, v in state['grants'].items() if pid_alive(v['pid'])}
+        now = time.time()
+        state['waiting'] = {j: v for j, v in state['waiting'].items() if now - v['time'] < WAIT_EXPIRY}
+
+        result = change(state)
+
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(state, indent=2))
+    return result
+
+
+def configure(directory, cpus=None, mem=None, scratch=None):
+    def change(state):
+        for key, value in (('cpus', cpus), ('mem', mem), ('scratch', scratch)):
+            if value is not None:
+                state['total'][key] = value
+        return state['total']
+    return update(directory, change)
+
+
+def free(state):
+    used = {k: sum([g[k] for g in state['grants'].values()]) for k in ('cpus', 'mem', 'scratch')}
+    return {k: state['total'][k] - used[k] for k in used}
+
+
+def try_acquire(directory, job, cpus=0, mem=0, scratch=0, pid=None, label=None):
+    """ Returns a grant id, or None when the request has to wait """
+    def change(state):
+        # a request larger than the whole node gets the whole node, once it is free
+        request = {'cpus': min(cpus, state['total']['cpus']), 'mem': min(mem, state['total']['mem']),
+                   'scratch': min(scratch, state['total']['scratch'])}
+        available = free(state)
+        held = lambda j: len([g for g in state['grants'].values() if g['job'] == j])
+        fits = lambda r: all([r[k] <= available[k] for k in request])
+        behind = [j for j, w in state['waiting'].items() if j != job and held(j) < held(job) and fits(w['request'])]
+        if not fits(request) or behind:
+            state['waiting'].setdefault(job, {'since': time.time()}).update({'time': time.time(), 'request': request})
+            return None
+        state['waiting'].pop(job, None)
+        grant = str(uuid.uuid4())
+        state['grants'][grant] = dict(request, job=job, pid=pid or os.getpid(), label=label, time=time.time())
+        return grant
+    return update(directory, change)
+
+
+def totals():
+    """ The cpus and memory (GB) a task sizes its jobs for: those of the node budget, or of the node """
+    directory = budget_dir()
+    if not directory:
+        return resource_scheduler.total_cpus(), resource_scheduler.total_mem_gb()
+    total = update(directory, lambda state: dict(state['total']))
+    return max(1, int(total['cpus'])), max(1, int(total['mem']))
+
+
+def task_mem_gb():
+    """
+    Memory a task can give to processes it starts without grants of their own: the memory of
+    the node budget not granted to jobs, or the memory of the node not in use
+    """
+    directory = budget_dir()
+    if not directory:
+        return resource_scheduler.available_mem_gb()
+    return max(1, int(update(directory, lambda state: free(state)['mem'])))
+
+
+def acquire(directory, job, cpus=0, mem=0, scratch=0, pid=None, label=None, poll_interval=5):
+    while True:
+        grant = try_acquire(directory, job, cpus, mem, scratch, pid, label)
+        if grant:
+            return grant
+        time.sleep(poll_interval)
+
+
+def release(directory, grant):
+    def change(state):
+        state['grants'].pop(grant, None)
+    update(directory, change)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show or set the node-wide budget')
+    parser.add_argument('budget_dir', nargs='?', default=budget_dir())
+    parser.add_argument('--cpus', type=int)
+    parser.add_argument('--mem-gb', dest='mem', type=int)
+    parser.add_argument('--scratch-gb', dest='scratch', type=float)
+    args = parser.parse_args()
+    if not args.budget_dir:
+        sys.exit('No budget directory given and NODE_BUDGET_DIR is not set')
+
+    configure(args.budget_dir, args.cpus, args.mem, args.scratch)
+    state = update(args.budget_dir, lambda s: s)
+    print('%-10s %10s %10s' % ('', 'total', 'free'))
+    for k, v in free(state).items():
+        print('%-10s %10s %10s' % (k, round(state['total'][k], 1), round(v, 1)))
+    for g in state['grants'].values():
+        print('%s %s: %s cpus, %s GB memory, %s GB scratch' % (g['job'], g['label'] or '', g['cpus'], g['mem'], g['scratch']))
+
+
+if __name__ == "__main__":
+    main()
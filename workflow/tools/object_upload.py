@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from song_client import JsonClient, RequestError, SongClient
+
+"""
+Multipart upload of the result files to the object store, split in two steps so the
+transfer does not have to wait for the SONG analysis:
+- stage: as soon as the merged BAM and its index exist, their parts are uploaded, several
+  at a time, while the QC steps run. The upload is left open, the object id is not known yet
+- commit: once the SONG analysis is saved, every file of it is completed under the object id
+  SONG gave it, the object store checks the md5 of the whole object against the one in SONG.
+  Files that were not staged (the QC tar) are uploaded here
+- the parts that were uploaded are recorded in <file>.<url hash>.upload.json, a stage or commit run
+  again after a failure lists the parts the object store has, and only sends the missing ones
+
+The object store is reached through the multipart API of its upload gateway:
+  POST   /uploads                   {fileName, fileSize, partSize} -> {uploadId}
+  GET    /uploads/<id>                                              -> {parts: [{partNumber, etag, size}]}
+  PUT    /uploads/<id>/parts/<n>    <part data>                     -> {etag}  (md5 of the part)
+  POST   /uploads/<id>/complete     {objectId, fileMd5sum, parts}   -> {objectId}
+  DELETE /uploads/<id>
+benchmark/stubs/object_store.py stands in for it. score has no such API, its uploads are
+initiated for an object id, which SONG only assigns once the analysis is saved, so main.jt
+has no tasks using this until the object store offers one; the uploads go through
+score-client.
+"""
+
+PART_SIZE = 64 * 1024 * 1024
+MAX_PARTS = 10000
+WORKERS = 4
+STATE_SUFFIX = '.upload.json'
+
+
+class ObjectStoreClient(JsonClient):
+    def __init__(self, url, token=None, **kwargs):
+        token = token if token is not None else os.environ.get('ACCESSTOKEN', os.environ.get('SCORE_TOKEN'))
+        super(ObjectStoreClient, self).__init__(url, token, **kwargs)
+
+    def initiate(self, file_name, file_size, part_size):
+        return self.request('POST', '/uploads', {'fileName': file_name, 'fileSize': file_size, 'partSize': part_size})['uploadId']
+
+    def parts(self, upload_id):
+        return self.request('GET', '/uploads/%s' % upload_id)['parts']
+
+    def put_part(self, upload_id, part_number, data):
+        return self.request('PUT', '/uploads/%s/parts/%s' % (upload_id, part_number), data,
+                            content_type='application/octet-stream')['etag']
+
+    def complete(self, upload_id, object_id, md5sum, parts):
+        return self.request('POST', '/uploads/%s/complete' % upload_id,
+                            {'objectId': object_id, 'fileMd5sum': md5sum, 'parts': parts})
+
+    def abort(self, upload_id):
+        return self.request('DELETE', '/uploads/%s' % upload_id)
+
+
+def part_size_for(file_size):
+    return max(PART_SIZE, -(-file_size // MAX_PARTS))
+
+
+def state_file(path, url):
+    """ One per object store, the uploads to collab and aws run at the same time """
+    return '%s.%s%s' % (path, hashlib.md5(url.encode()).hexdigest()[:8], STATE_SUFFIX)
+
+
+def load_state(path, url):
+    try:
+        with open(state_file(path, url), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(path, url, upload):
+    with open(state_file(path, url) + '.tmp', 'w') as f:
+        f.write(json.dumps(upload, indent=2))
+    os.replace(state_file(path, url) + '.tmp', state_file(path, url))
+
+
+def stage(client, path, workers=WORKERS):
+    """ Uploads the parts of 'path' the object store does not have yet, returns the upload record """
+    st = os.stat(path)
+    upload = load_state(path, client.url)
+    if upload and (upload['fileSize'], upload['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+        try:
+            # a part counts as uploaded if the object store has it with the md5 we sent
+            upload['parts'] = {str(p['partNumber']): p['etag'] for p in client.parts(upload['uploadId'])
+                               if upload['parts'].get(str(p['partNumber'])) == p['etag']}
+        except RequestError as e:
+            if e.status != 404:
+                raise
+            upload = None
+    elif upload:
+        # the file changed since it was staged, what was sent is of no use
+        try:
+            client.abort(upload['uploadId'])
+        except RequestError:
+            pass
+        upload = None
+
+    if not upload:
+        part_size = part_size_for(st.st_size)
+        upload = {'uploadId': client.initiate(os.path.basename(path), st.st_size, part_size), 'partSize': part_size,
+                  'fileSize': st.st_size, 'mtime_ns': st.st_mtime_ns, 'parts': {}}
+    save_state(path, client.url, upload)
+
+    part_size = upload['partSize']
+    todo = [n for n in range(1, max(1, -(-st.st_size // part_size)) + 1) if str(n) not in upload['parts']]
+    lock = threading.Lock()
+    fd = os.open(path, os.O_RDONLY)
+
+    def send(n):
+        data = os.pread(fd, part_size, (n - 1) * part_size)
+        md5sum = hashlib.md5(data).hexdigest()
+        etag = client.put_part(upload['uploadId'], n, data)
+        if etag != md5sum:
+            raise RequestError('Part %s of %s was corrupted on the way, md5 %s, object store got %s' % (n, path, md5sum, etag))
+        with lock:
+            upload['parts'][str(n)] = etag
+            save_state(path, client.url, upload)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(send, todo))
+    finally:
+        os.close(fd)
+    print('%s: %s parts sent, %s already uploaded' % (os.path.basename(path), len(todo), len(upload['parts']) - len(todo)))
+    return upload
+
+
+def commit(client, path, object_id, md5sum, workers=WORKERS):
+    """ Completes the upload of 'path' as 'object_id', staging what is still missing first """
+    upload = stage(client, path, workers)
+    parts = [{'partNumber': int(n), 'etag': e} for n, e in sorted(upload['parts'].items(), key=lambda p: int(p[0]))]
+    client.complete(upload['uploadId'], object_id, md5sum, parts)
+    os.remove(state_file(path, client.url))
+
+
+def write_output(output):
+    with open('output.json', 'w') as o:
+        o.write(json.dumps(output))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Staged multipart upload of result files to the object store')
+    parser.add_argument('command', choices=['stage', 'commit'])
+    parser.add_argument('--url', required=True, help='object store upload gateway')
+    parser.add_argument('--is-allowed', dest='is_allowed', default='True', help='"True" unless the step is skipped')
+    parser.add_argument('--file', dest='files', action='append', default=[], help='file to stage')
+    parser.add_argument('--song-url', dest='song_url', help='SONG server of the analysis, for commit')
+    parser.add_argument('--study')
+    parser.add_argument('--analysis-id', dest='analysis_id')
+    parser.add_argument('--input-dir', dest='input_dir', help='where the files of the analysis are, for commit')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='parts uploaded at the same time')
+    args = parser.parse_args()
+
+    if args.is_allowed != 'True':
+        write_output({'task_skipped': True})
+        return
+
+    client = ObjectStoreClient(args.url)
+    try:
+        if args.command == 'stage':
+            for path in args.files:
+                stage(client, path, args.workers)
+            write_output({'task_skipped': False, 'staged': args.files})
+        else:
+            song = SongClient(args.song_url)
+            try:
+                analysis = song.analysis(args.study, args.analysis_id)
+            finally:
+                song.close()
+            for f in analysis['file']:
+                commit(client, os.path.join(args.input_dir, f['fileName']), f['objectId'], f['fileMd5sum'], args.workers)
+                print('%s committed as %s' % (f['fileName'], f['objectId']))
+            write_output({'task_skipped': False})
+    except RequestError as e:
+        sys.exit('Object store %s failed: %s' % (args.command, e))
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
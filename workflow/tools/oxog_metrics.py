@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import math
+
+"""
+Helpers for Picard CollectOxoGMetrics run on shards of the genome:
+- interval_lists splits the reference sequences of a BAM header into interval_list files
+  of about the same total length, one per CollectOxoGMetrics invocation (INTERVALS=)
+- merge adds up the per-context counts of the shard outputs and derives the error rates
+  and qualities from the sums, the way CollectOxoGMetrics does for a single run
+"""
+
+METRICS_CLASS = 'picard.analysis.CollectOxoGMetrics$CpcgMetrics'
+KEY_COLUMNS = ['SAMPLE_ALIAS', 'LIBRARY', 'CONTEXT']
+COUNT_COLUMNS = ['TOTAL_SITES', 'TOTAL_BASES', 'REF_NONOXO_BASES', 'REF_OXO_BASES', 'REF_TOTAL_BASES',
+                 'ALT_NONOXO_BASES', 'ALT_OXO_BASES', 'C_REF_REF_BASES', 'G_REF_REF_BASES',
+                 'C_REF_ALT_BASES', 'G_REF_ALT_BASES']
+METRICS_COLUMNS = KEY_COLUMNS + ['TOTAL_SITES', 'TOTAL_BASES', 'REF_NONOXO_BASES', 'REF_OXO_BASES',
+                                 'REF_TOTAL_BASES', 'ALT_NONOXO_BASES', 'ALT_OXO_BASES',
+                                 'OXIDATION_ERROR_RATE', 'OXIDATION_Q', 'C_REF_REF_BASES', 'G_REF_REF_BASES',
+                                 'C_REF_ALT_BASES', 'G_REF_ALT_BASES', 'C_REF_OXO_ERROR_RATE', 'C_REF_OXO_Q',
+                                 'G_REF_OXO_ERROR_RATE', 'G_REF_OXO_Q']
+MIN_ERROR_RATE = 1e-10
+
+
+def sequences(header_text):
+    """ (name, length) of the @SQ lines of a SAM header """
+    seqs = []
+    for line in header_text.splitlines():
+        if not line.startswith('@SQ\t'):
+            continue
+        tags = dict([t.split(':', 1) for t in line.split('\t')[1:] if ':' in t])
+        seqs.append((tags['SN'], int(tags['LN'])))
+    return seqs
+
+
+def interval_lists(header_text, shards, prefix):
+    """
+    Writes up to 'shards' interval_list files '<prefix>.<n>.interval_list' covering whole
+    reference sequences, the longest sequences placed first on the shard with the least
+    length so far. Returns the file names, none when the header has no @SQ line.
+    """
+    seqs = sequences(header_text)
+    bins = [[] for _ in range(min(shards, len(seqs)))]
+    lengths = [0] * len(bins)
+    for index, (_, length) in sorted(enumerate(seqs), key=lambda s: -s[1][1]):
+        n = lengths.index(min(lengths))
+        bins[n].append(index)
+        lengths[n] += length
+
+    # the sequence dictionary of the BAM, Picard checks the intervals against it
+    dictionary = ''.join([line + '\n' for line in header_text.splitlines() if line.startswith(('@HD\t', '@SQ\t'))])
+    files = []
+    for n, indexes in enumerate(bins):
+        path = '%s.%s.interval_list' % (prefix, n)
+        with open(path, 'w') as f:
+            f.write(dictionary)
+            for index in sorted(indexes):
+                name, length = seqs[index]
+                f.write('%s\t1\t%s\t+\t%s\n' % (name, length, name))
+        files.append(path)
+    return files
+
+
+def load_metrics(metrics_file):
+    """ Returns (header lines, columns, rows) of a CollectOxoGMetrics output """
+    header, columns, rows = [], None, []
+    with open(metrics_file, 'r') as m:
+        for line in m:
+            line = line.rstrip('\n')
+            if columns is None:
+                if line.startswith('#') or not line:
+                    header.append(line)
+                    continue
+                columns = line.split('\t')
+            elif line:
+                rows.append(dict(zip(columns, line.split('\t'))))
+            else:
+                break
+    return header, columns, rows
+
+
+def ratio(a, b):
+    if b:
+        return a / float(b)
+    return math.copysign(float('inf'), a) if a else float('nan')
+
+
+def phred(error_rate):
+    return -10 * math.log10(error_rate) if error_rate > 0 else float('inf')
+
+
+def derive(row):
+    """ The rates and qualities CollectOxoGMetrics computes from the counts of 'row' """
+    c = dict([(k, int(row[k])) for k in COUNT_COLUMNS])
+    oxidation = ratio(max(c['ALT_OXO_BASES'] - c['ALT_NONOXO_BASES'], 1), c['TOTAL_BASES'])
+    c_ref = ratio(c['C_REF_ALT_BASES'], c['C_REF_ALT_BASES'] + c['C_REF_REF_BASES'])
+    g_ref = ratio(c['G_REF_ALT_BASES'], c['G_REF_ALT_BASES'] + c['G_REF_REF_BASES'])
+    # Java's Math.max, NaN when either value is
+    c_ref_oxo = c_ref - g_ref if math.isnan(c_ref - g_ref) else max(c_ref - g_ref, MIN_ERROR_RATE)
+    g_ref_oxo = g_ref - c_ref if math.isnan(g_ref - c_ref) else max(g_ref - c_ref, MIN_ERROR_RATE)
+    return {
+        'OXIDATION_ERROR_RATE': oxidation,
+        'OXIDATION_Q': phred(oxidation),
+        'C_REF_OXO_ERROR_RATE': c_ref_oxo,
+        'C_REF_OXO_Q': phred(c_ref_oxo),
+        'G_REF_OXO_ERROR_RATE': g_ref_oxo,
+        'G_REF_OXO_Q': phred(g_ref_oxo)
+    }
+
+
+def format_value(value):
+    """ A metrics value the way htsjdk's FormatUtil prints it, doubles with up to 6 decimals """
+    if not isinstance(value, float):
+        return str(value)
+    if math.isnan(value):
+        return '?'
+    if math.isinf(value):
+        return '∞' if value > 0 else '-∞'
+    text = ('%.6f' % value).rstrip('0').rstrip('.')
+    return '0' if text == '-0' else text
+
+
+def write_metrics(rows, metrics_file, header=None):
+    """ Writes 'rows' (dicts with the counts and key columns) with the derived columns filled in """
+    with open(metrics_file, 'w') as m:
+        for line in header or ['## htsjdk.samtools.metrics.StringHeader', '# oxog_metrics.py', '']:
+            m.write(line + '\n')
+        if not header:
+            m.write('## METRICS CLASS\t%s\n' % METRICS_CLASS)
+        m.write('\t'.join(METRICS_COLUMNS) + '\n')
+        for row in rows:
+            values = dict(row, **derive(row))
+            m.write('\t'.join([format_value(values[c]) for c in METRICS_COLUMNS]) + '\n')
+        m.write('\n\n')
+
+
+def merge(metrics_files, output):
+    """
+    Merges the outputs of CollectOxoGMetrics run on disjoint intervals into 'output': the
+    counts of each (SAMPLE_ALIAS, LIBRARY, CONTEXT) are summed, rows in the order of the
+    first file, and the header lines of the first file are kept.
+    """
+    header, merged, order = None, {}, []
+    for metrics_file in metrics_files:
+        lines, _, rows = load_metrics(metrics_file)
+        header = lines if header is None else header
+        for row in rows:
+            key = tuple([row[k] for k in KEY_COLUMNS])
+            if key not in merged:
+                merged[key] = dict([(k, row[k]) for k in KEY_COLUMNS] + [(k, 0) for k in COUNT_COLUMNS])
+                order.append(key)
+            for k in COUNT_COLUMNS:
+                merged[key][k] += int(row[k])
+    write_metrics([merged[key] for key in order], output, header)
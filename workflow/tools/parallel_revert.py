@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import shutil
+import instrument
+import intermediate_codec
+import node_budget
+import resource_scheduler
+
+"""
+Revert with the queryname sort spread over the read groups, in place of the one RevertSam
+sorting the whole BAM:
+- one streaming pass reverts the reads and splits them by read group, unsorted, each
+  partition is read once more and deleted as soon as its sort succeeded
+- each partition is sanitized and queryname sorted by its own RevertSam, several at a time
+  under the cpu/memory budget (resource_scheduler.py), by default the memory the node budget
+  has not granted, or that is not in use (node_budget.task_mem_gb). A sort keeps
+  MAX_RECORDS_IN_RAM records in its heap and spills the rest to its directory under the
+  scratch directory
+- read groups never share reads or mates, so the lane BAMs hold the same reads in the same
+  order as the ones of the single RevertSam
+"""
+
+# records per GB of heap a sort keeps in memory before spilling, Picard's default is 500000 for ~2 GB
+RECORDS_PER_GB = 250000
+# most heap a sort is given, beyond that the spill files are few and large enough anyway
+MAX_SORT_MEM_GB = 8
+
+
+def rg_file_name(rg_id):
+    # convert readGroupId to filename friendly
+    return "".join([c if re.match(r"[a-zA-Z0-9\-_]", c) else "_" for c in rg_id])
+
+
+def run(picard, bam, revert_args, out_dir, workers, mem=None, scratch_dir=None):
+    """
+    bam: the input BAM
+    revert_args: RevertSam arguments of the single pass, its input, sanitize and sort options are replaced
+    Returns (lane BAMs, None) on success, otherwise (None, error message). The lane BAMs are
+    <out_dir>/<read group>.lane.bam, in the order of the read group IDs.
+    """
+    revert_args = [a for a in revert_args if a.split('=', 1)[0] not in ('I', 'INPUT', 'SANITIZE', 'SORT_ORDER')] + \
+        intermediate_codec.picard_args()
+    scratch_dir = scratch_dir or os.path.join(out_dir, 'revert_scratch')
+    split_dir = os.path.join(scratch_dir, 'split')
+    if os.path.isdir(scratch_dir): shutil.rmtree(scratch_dir)
+    os.makedirs(split_dir)
+
+    split = instrument.run(['java'] + intermediate_codec.JAVA_OPTS + ['-jar', picard, 'RevertSam', 'I=%s' % bam] +
+                           revert_args + ['SANITIZE=false', 'SORT_ORDER=unsorted',
+                                          'OUTPUT_BY_READGROUP=true', 'O=%s' % split_dir], label='RevertSam split')
+    if split.returncode != 0:
+        return None, 'splitting by read group failed with %s' % split.returncode
+
+    partitions = sorted([f for f in os.listdir(split_dir) if f.endswith('.bam')])
+    sizes = [os.path.getsize(os.path.join(split_dir, f)) for f in partitions]
+    mem = mem or node_budget.task_mem_gb()
+    shares = resource_scheduler.split_budget(sizes, workers, mem, max_parallel=workers)
+
+    jobs = []
+    for partition, size, (_, sort_mem) in zip(partitions, sizes, shares):
+        sort_mem = min(sort_mem, MAX_SORT_MEM_GB)
+        tmp_dir = os.path.join(scratch_dir, partition[:-len('.bam')])
+        os.makedirs(tmp_dir)
+        lane_bam = os.path.join(out_dir, rg_file_name(partition[:-len('.bam')]) + '.lane.bam')
+        jobs.append({
+            'name': lane_bam,
+            'cmd': ['java', '-Xmx%sg' % sort_mem] + intermediate_codec.JAVA_OPTS + ['-jar', picard, 'RevertSam',
+                    'I=%s' % os.path.join(split_dir, partition)] + revert_args +
+                   ['SANITIZE=true', 'SORT_ORDER=queryname',
+                    'MAX_RECORDS_IN_RAM=%s' % (sort_mem * RECORDS_PER_GB),
+                    'TMP_DIR=%s' % tmp_dir, 'O=%s' % lane_bam],
+            'cpus': 1,
+            'mem': sort_mem,
+            'size': size,
+            'cleanup': [os.path.join(split_dir, partition)],
+            'label': 'RevertSam sort %s' % partition
+        })
+
+    # largest read groups first, the small ones fill in next to them
+    failed = resource_scheduler.run_jobs(sorted(jobs, key=lambda j: j['size'], reverse=True), workers, mem,
+                                         poll_interval=1)
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    if failed:
+        return None, 'queryname sort of %s failed with %s' % (os.path.basename(failed['name']), failed['returncode'])
+    return [j['name'] for j in jobs], None
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import queue
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import instrument
+import node_budget
+
+"""
+Run the per read group Picard invocations of a step in a few long-lived JVMs:
+- PicardBatch.java is compiled once per node and user, into a directory only the user can
+  write to (or run as a Java 11 source file when there is no javac, or that directory is not
+  safe to use), and fed one invocation at a time over stdin
+- the JVMs of a batch share the memory the node budget leaves to the task
+  (node_budget.task_mem_gb), each one gets an explicit heap of its share
+- a JVM that dies, or can not be started, is replaced by plain 'java -jar' calls
+- results come back in the order of the invocations, with the exit status and the
+  output files (O=/OUTPUT=/METRICS_FILE=) each invocation produced
+"""
+
+LAUNCHER_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PicardBatch.java')
+OUTPUT_ARGS = ('O', 'OUTPUT', 'METRICS_FILE', 'M')
+# share of a JVM's memory given to its heap, the rest is left to the JVM itself
+HEAP_FRACTION = 0.75
+# the per read group tools stream their records, more heap does not make them faster
+MAX_HEAP_GB = 4
+
+
+def user_dir():
+    """ Directory of the compiled launcher of this user, None if it is not safe to load classes from """
+    path = os.path.join(tempfile.gettempdir(), 'picard_batch-%s' % os.getuid())
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return None
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        print('Not loading the Picard batch launcher from %s, it is not a private directory of this user' % path,
+              file=sys.stderr)
+        return None
+    return path
+
+
+def launcher_cmd(picard_jar, java_opts):
+    """ Command starting a PicardBatch JVM, compiles the launcher on first use """
+    base_dir = user_dir()
+    if base_dir is None:
+        return ['java'] + java_opts + ['-cp', picard_jar, LAUNCHER_SOURCE]
+    with open(LAUNCHER_SOURCE, 'rb') as f:
+        digest = hashlib.md5(f.read()).hexdigest()
+    class_dir = os.path.join(base_dir, digest)
+
+    if not os.path.isfile(os.path.join(class_dir, 'PicardBatch.class')) and shutil.which('javac'):
+        tmp_dir = tempfile.mkdtemp(dir=base_dir)
+        if subprocess.run(['javac', '-d', tmp_dir, LAUNCHER_SOURCE]).returncode == 0:
+            try:
+                os.rename(tmp_dir, class_dir)
+            except OSError:  # compiled concurrently by another job
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if os.path.isfile(os.path.join(class_dir, 'PicardBatch.class')):
+        return ['java'] + java_opts + ['-cp', os.pathsep.join([class_dir, picard_jar]), 'PicardBatch']
+    return ['java'] + java_opts + ['-cp', picard_jar, LAUNCHER_SOURCE]
+
+
+def heap_opts(java_opts, jvms, mem_gb=None):
+    """ -Xmx of each of 'jvms' JVMs sharing 'mem_gb', unless the caller set a heap """
+    if any([o.startswith('-Xmx') for o in java_opts]):
+        return []
+    mem_gb = mem_gb or node_budget.task_mem_gb()
+    heap_mb = int(min(MAX_HEAP_GB, mem_gb * HEAP_FRACTION / jvms) * 1024)
+    return ['-Xmx%sm' % max(256, heap_mb)]
+
+
+def output_files(args):
+    outputs = []
+    for arg in args[1:]:
+        key, _, value = arg.partition('=')
+        if key in OUTPUT_ARGS and os.path.exists(value):
+            outputs.append(value)
+    return outputs
+
+
+def run_batch(picard_jar, invocations, workers=1, java_opts=None, on_result=None, mem_gb=None):
+    """
+    Run a list of Picard invocations, each one a list like ['FastqToSam', 'FASTQ=...', ...].
+    Returns a list of dicts with 'args', 'returncode' and 'outputs'.
+    mem_gb: memory shared by the JVMs, by default what the node budget leaves to the task
+    'on_result(index, result)' is called, one at a time, as each invocation finishes, when it returns True
+    the batch is aborted: running invocations are killed and their results stay None.
+    """
+    if not invocations:
+        return []
+    workers = max(1, min(workers, len(invocations)))
+    java_opts = list(java_opts or [])
+    java_opts = heap_opts(java_opts, workers, mem_gb) + java_opts
+    results = [None] * len(invocations)
+    todo = queue.Queue()
+    for i, args in enumerate(invocations):
+        todo.put(i)
+    abort = threading.Event()
+    lock = threading.Lock()
+    jvms = []  # also holds the plain 'java -jar' fallbacks, so an abort can kill them
+
+    def worker():
+        jvm = None
+        try:
+            jvm = instrument.Popen(launcher_cmd(picard_jar, java_opts), label='PicardBatch',
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   universal_newlines=True, bufsize=1)
+            with lock:
+                jvms.append(jvm)
+        except OSError as e:
+            print('Could not start Picard batch JVM, falling back to java -jar: %s' % e, file=sys.stderr)
+
+        while not abort.is_set():
+            try:
+                i = todo.get_nowait()
+            except queue.Empty:
+                break
+            args = invocations[i]
+            returncode = None
+            if jvm is not None and jvm.poll() is None:
+                try:
+                    jvm.stdin.write('\t'.join([str(i)] + list(args)) + '\n')
+                    jvm.stdin.flush()
+                    reply = jvm.stdout.readline().rstrip('\n').split('\t')
+                    if len(reply) == 2 and reply[0] == str(i):
+                        returncode = int(reply[1])
+                except (OSError, ValueError):
+                    pass
+                if returncode is None:
+                    if abort.is_set():
+                        break
+                    print('Picard batch JVM died, falling back to java -jar', file=sys.stderr)
+                    jvm.kill()
+                    jvm = None
+            if returncode is None:
+                single = instrument.Popen(['java'] + java_opts + ['-jar', picard_jar] + args, label=args[0])
+                with lock:
+                    jvms.append(single)
+                returncode = single.wait()
+            if abort.is_set():
+                break
+            with lock:
+                results[i] = {'args': args, 'returncode': returncode, 'outputs': output_files(args)}
+                if on_result is not None and on_result(i, results[i]):
+                    abort.set()
+                    for other in jvms:
+                        if other.poll() is None:
+                            other.kill()
+
+        if jvm is not None:
+            try:
+                jvm.stdin.close()
+            except OSError:
+                pass
+            jvm.wait()
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
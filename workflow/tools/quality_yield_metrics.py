@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import gzip
+import itertools
+import os
+import signal
+import sys
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Helpers for Picard CollectQualityYieldMetrics output files, and a native calculator
+producing the same metrics straight from paired FASTQ files:
+- the quality lines are read in batches and turned into one histogram of quality
+  values per batch (numpy.bincount, or bytes.count when NumPy is not installed)
+- all metrics are derived from the read/base counts and the histogram
+- run as a script, it feeds the FASTQs of a streamed lane to FastqToSam through named pipes
+  and writes the metrics of the bytes it fed, the FASTQs are decompressed once for both
+"""
+
+GENOME_SIZE = 3000000000.0
+BATCH_READS = 200000
+METRICS_COLUMNS = ['TOTAL_READS', 'PF_READS', 'READ_LENGTH', 'TOTAL_BASES', 'PF_BASES',
+                   'Q20_BASES', 'PF_Q20_BASES', 'Q30_BASES', 'PF_Q30_BASES',
+                   'Q20_EQUIVALENT_YIELD', 'PF_Q20_EQUIVALENT_YIELD']
+
+
+def load_metrics(metrics_file):
+    lines = []
+    with open(metrics_file, 'r') as m:
+        for row in m:
+            col = row.strip().split('\t')
+            if col[0].startswith('#') or len(col) == 1:
+                continue
+            lines.append(col)
+            if len(lines) == 2:
+                break
+    return dict(zip(lines[0], lines[1]))
+
+
+def get_pf_bases(metrics_file):
+    return int(load_metrics(metrics_file)['PF_BASES'])
+
+
+def quality_histogram(quals):
+    """ Count of each phred+33 byte value in 'quals' """
+    if np is not None:
+        return np.bincount(np.frombuffer(quals, dtype=np.uint8), minlength=256).tolist()
+    return [quals.count(bytes([c])) if 33 <= c < 127 else 0 for c in range(256)]
+
+
+def fastq_counts(fastq, batch_reads=BATCH_READS, out=None):
+    """
+    Returns (reads, bases, histogram of quality bytes) of a plain or gzipped FASTQ, its
+    decompressed lines are written to 'out' when given
+    """
+    with open(fastq, 'rb') as f:
+        opener = gzip.open if f.read(2) == b'\x1f\x8b' else open
+    reads = bases = 0
+    hist = [0] * 256
+    with opener(fastq, 'rb') as f:
+        while True:
+            batch = list(itertools.islice(f, 4 * batch_reads))
+            if not batch:
+                break
+            if out is not None:
+                out.write(b''.join(batch))
+            quals = b''.join([l.rstrip(b'\r\n') for l in batch[3::4]])
+            reads += len(batch) // 4
+            bases += len(quals)
+            for q, n in enumerate(quality_histogram(quals)):
+                hist[q] += n
+    return reads, bases, hist
+
+
+def fastq_metrics(fastqs):
+    """
+    CollectQualityYieldMetrics values for the reads in 'fastqs'. FastqToSam does not set
+    the vendor failed flag, so all reads pass filter.
+    """
+    return counts_metrics([fastq_counts(fastq) for fastq in fastqs])
+
+
+def counts_metrics(counts):
+    """ CollectQualityYieldMetrics values from the fastq_counts of the FASTQs of a lane """
+    reads = bases = 0
+    hist = [0] * 256
+    for r, b, h in counts:
+        reads += r
+        bases += b
+        hist = [x + y for x, y in zip(hist, h)]
+
+    q20 = sum(hist[33 + 20:])
+    q30 = sum(hist[33 + 30:])
+    q20_equivalent = sum([n * (c - 33) for c, n in enumerate(hist) if c >= 33]) // 20
+    return {
+        'TOTAL_READS': reads,
+        'PF_READS': reads,
+        'READ_LENGTH': bases // reads if reads else 0,
+        'TOTAL_BASES': bases,
+        'PF_BASES': bases,
+        'Q20_BASES': q20,
+        'PF_Q20_BASES': q20,
+        'Q30_BASES': q30,
+        'PF_Q30_BASES': q30,
+        'Q20_EQUIVALENT_YIELD': q20_equivalent,
+        'PF_Q20_EQUIVALENT_YIELD': q20_equivalent
+    }
+
+
+def write_metrics(metrics, metrics_file, source):
+    with open(metrics_file, 'w') as m:
+        m.write('## htsjdk.samtools.metrics.StringHeader\n')
+        m.write('# quality_yield_metrics.py %s\n' % source)
+        m.write('\n')
+        m.write('## METRICS CLASS\tpicard.analysis.CollectQualityYieldMetrics$QualityYieldMetrics\n')
+        m.write('\t'.join(METRICS_COLUMNS) + '\n')
+        m.write('\t'.join([str(metrics[c]) for c in METRICS_COLUMNS]) + '\n')
+        m.write('\n\n')
+
+
+def new_pipe(path, n):
+    """ Points the symlink 'path' to a new named pipe '<path>.<n>' """
+    fifo = '%s.%s' % (path, n)
+    os.mkfifo(fifo)
+    os.symlink(os.path.basename(fifo), fifo + '.link')
+    os.replace(fifo + '.link', path)
+    return fifo
+
+
+def serve_fastq(fastq, path, passes, idle):
+    """
+    Writes the decompressed 'fastq' to each reader opening 'path'. FastqToSam opens its inputs
+    twice, the first reader stops after guessing the quality encoding: each reader gets a pipe
+    of its own, 'path' points to the next one before anything is written, so what a reader left
+    unread never reaches the next. The counts of each pass read to the end are put in 'passes',
+    'idle' is set while waiting for a reader.
+    """
+    fifo = new_pipe(path, 0)
+    for n in itertools.count(1):
+        idle.set()
+        try:
+            with open(fifo, 'wb') as out:
+                idle.clear()
+                os.remove(fifo)
+                fifo = new_pipe(path, n)
+                counts = fastq_counts(fastq, out=out)
+        except BrokenPipeError:
+            continue
+        passes.append(counts)
+
+
+def main():
+    """
+    quality_yield_metrics.py <metrics file> <fastq>=<path>...: serves each FASTQ on its path
+    until SIGUSR1, sent once the reader exited, then writes the metrics of the last complete
+    pass over every FASTQ
+    """
+    metrics_file, pairs = sys.argv[1], [a.split('=', 1) for a in sys.argv[2:]]
+    # the serving threads inherit the mask, the signal is only taken by sigwait below
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGUSR1})
+    served = []
+    for fastq, path in pairs:
+        if os.path.lexists(path): os.remove(path)
+        passes, idle = [], threading.Event()
+        threading.Thread(target=serve_fastq, args=(fastq, path, passes, idle), daemon=True).start()
+        served.append((fastq, path, passes, idle))
+    signal.sigwait({signal.SIGUSR1})
+
+    # a pass that was read to the end is counted before its thread waits for the next reader
+    for _, _, _, idle in served:
+        idle.wait()
+    for _, path, _, _ in served:
+        os.remove(os.path.realpath(path))
+        os.remove(path)
+    if not all([passes for _, _, passes, _ in served]):
+        sys.exit('Not read to the end: %s' % ' and '.join([fastq for fastq, _, passes, _ in served if not passes]))
+    write_metrics(counts_metrics([passes[-1] for _, _, passes, _ in served]), metrics_file,
+                  ' '.join([fastq for fastq, _, _, _ in served]))
+
+
+if __name__ == "__main__":
+    main()
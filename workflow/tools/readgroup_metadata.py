@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import datetime
+import re
+
+"""
+Read group and header comment values derived from the metadata, shared by
+replace_readgroup.py, add_comment.py, fastq_to_sam.py and the fused revert in revert_bam.py.
+The header rewrites that stand in for AddOrReplaceReadGroups write the @RG line with
+rg_header_line, which formats DT the way Picard does.
+"""
+
+RG_map = { 'ID': 'readGroupId',
+           'LB': 'libraryName',
+           'PL': 'sequencingPlatform',
+           'PU': 'platformUnit',
+           'SM': 'aliquotId',
+           'PM': 'platformModel',
+           'CN': 'sequencingCenter',
+           'PI': 'insertSize',
+           'DT': 'sequencingDate'}
+
+case_map = {
+    'study': 'dcc_project_code',
+    'donorSubmitterId': 'submitter_donor_id',
+    'specimenSubmitterId': 'submitter_specimen_id',
+    'sampleSubmitterId': 'submitter_sample_id',
+    'specimenType': 'dcc_specimen_type',
+    'libraryStrategy': 'library_strategy',
+    'useCntl': 'use_cntl'
+}
+
+# the order AddOrReplaceReadGroups sets the @RG fields in
+RG_header_order = ['ID', 'LB', 'PL', 'SM', 'PU', 'CN', 'DT', 'PI', 'PM']
+
+
+def readgroup_replacements(metadata, _file):
+    """ Map each readGroupIdInFile of a reshaped BAM file entry to its new @RG fields """
+    rg_replace = {}
+    for rg in _file.get('readGroups'):
+        rg_replace[rg.get('readGroupIdInFile')] = {}
+        for key, value in RG_map.items():
+            to_update = {}
+            if key == 'SM' and metadata.get(value):
+                to_update = {key: metadata.get(value)}
+            if key in ['ID', 'LB', 'PL', 'PU', 'PM', 'CN', 'DT'] and rg.get(value) or key == 'PI' and isinstance(rg.get(value), int):
+                to_update = {key: rg.get(value)}
+            # if key == 'DT' and re.match('^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}$', str(rg.get(value))):
+            #     to_update = {key: rg.get(value)}
+            if to_update:
+                rg_replace[rg.get('readGroupIdInFile')].update(to_update)
+    return rg_replace
+
+
+def comments(metadata):
+    return ['%s:%s' % (case_map.get(ct), metadata.get(ct)) for ct in
+            ['study', 'donorSubmitterId', 'specimenSubmitterId', 'sampleSubmitterId', 'specimenType', 'libraryStrategy', 'useCntl']]
+
+
+ISO8601 = re.compile(r'^(\d{4})(?:-(\d{2})(?:-(\d{2})(?:T(\d{2}):(\d{2})(?::(\d{2})(?:\.\d+)?)?'
+                     r'(Z|[+-]\d{2}:?\d{2})?)?)?)?$')
+
+
+def rg_date(value):
+    """
+    RGDT as AddOrReplaceReadGroups writes it (htsjdk Iso8601Date): the value is read as an ISO
+    8601 date or date and time, UTC when it has no offset, and printed to the second in the
+    local time zone, like '2019-03-01T00:00:00+0000'. ValueError when it is not a date,
+    Picard fails on those too.
+    """
+    match = ISO8601.match(str(value).strip())
+    if not match:
+        raise ValueError('sequencingDate %s is not an ISO 8601 date' % value)
+    year, month, day, hour, minute, second, offset = match.groups()
+    tz = datetime.timezone.utc
+    if offset and offset != 'Z':
+        minutes = int(offset[1:3]) * 60 + int(offset[-2:])
+        tz = datetime.timezone(datetime.timedelta(minutes=minutes if offset[0] == '+' else -minutes))
+    date = datetime.datetime(int(year), int(month or 1), int(day or 1), int(hour or 0), int(minute or 0),
+                             int(second or 0), tzinfo=tz)
+    return date.astimezone().strftime('%Y-%m-%dT%H:%M:%S%z')
+
+
+def rg_header_line(rg_new):
+    """ The @RG line AddOrReplaceReadGroups writes for the fields 'rg_new' """
+    fields = dict(rg_new, DT=rg_date(rg_new['DT'])) if 'DT' in rg_new else rg_new
+    return '@RG\t' + '\t'.join(['%s:%s' % (key, fields[key]) for key in RG_header_order if key in fields])
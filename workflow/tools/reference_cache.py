@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+from file_checksum import md5_file
+
+"""
+Node-local, content-addressed cache of reference bundles, shared by concurrent jobs:
+- each file is hashed once per reference release: later jobs find the hash in the index by
+  the file's name, size and the md5 of SAMPLE_BLOCKS blocks spread over it, so the copy each
+  job downloads is not hashed again. Reference releases do not change in place, a different
+  release differs in its size or in the sampled blocks. A file is copied into
+  <cache_dir>/objects/<md5> only when no object of the same content is there
+- the objects of a bundle are linked into its directory under the cache lock as soon as they
+  are found or added, so eviction (which drops objects with no link left) never takes an
+  object a job is about to use
+- a bundle is a directory of hard links to the objects under the original file names,
+  addressed by the hash of its content, so docker can mount it as is
+- jobs hold a shared lock on the bundle while using it, eviction takes least recently used
+  bundles and their objects, never the ones in use, until the cache fits the quota
+- optionally the bundle is pre-warmed into the page cache, or copied to /dev/shm, so each
+  lane alignment loads the BWA index from memory. The /dev/shm copy is memory, it is not
+  counted against the quota, it is dropped when the last lease of the bundle is released
+"""
+
+CHUNK_SIZE = 16 * 1024 * 1024
+SAMPLE_BLOCKS = 16
+SAMPLE_BYTES = 1024 * 1024
+SHM_DIR = '/dev/shm'
+
+
+def locked(cache_dir):
+    """ Exclusive lock on the whole cache, for index updates and eviction """
+    fd = os.open(os.path.join(cache_dir, '.lock'), os.O_CREAT | os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+
+def unlock(fd):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+def source_key(path):
+    """ Name, size and md5 of SAMPLE_BLOCKS blocks of SAMPLE_BYTES spread over the file """
+    size = os.path.getsize(path)
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for n in range(SAMPLE_BLOCKS):
+            f.seek(max(0, size - SAMPLE_BYTES) * n // (SAMPLE_BLOCKS - 1))
+            md5.update(f.read(SAMPLE_BYTES))
+    return '%s:%s:%s' % (os.path.basename(path), size, md5.hexdigest())
+
+
+def load_index(cache_dir):
+    index_file = os.path.join(cache_dir, 'index.json')
+    if not os.path.isfile(index_file):
+        return {}
+    with open(index_file, 'r') as f:
+        return json.load(f)
+
+
+def save_index(cache_dir, index):
+    tmp = os.path.join(cache_dir, 'index.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.rename(tmp, os.path.join(cache_dir, 'index.json'))
+
+
+def link_object(cache_dir, digest, staged):
+    """ Links the object 'digest' at 'staged', False when there is no such object. Under the cache lock """
+    obj = os.path.join(cache_dir, 'objects', digest)
+    if not os.path.isfile(obj):
+        return False
+    if os.path.lexists(staged): os.remove(staged)
+    os.link(obj, staged)
+    return True
+
+
+def stage_object(cache_dir, path, staged):
+    """
+    Hard link at 'staged' to the object with the content of 'path', the file is copied into
+    the object store unless an object of the same content is there. Returns its md5.
+    """
+    key = source_key(path)
+    fd = locked(cache_dir)
+    try:
+        digest = load_index(cache_dir).get(key)
+        if digest and link_object(cache_dir, digest, staged):
+            return digest
+    finally:
+        unlock(fd)
+
+    # hashed and copied outside the lock, other jobs may add other files meanwhile
+    digest = md5_file(path, CHUNK_SIZE)
+    fd = locked(cache_dir)
+    try:
+        found = link_object(cache_dir, digest, staged)
+    finally:
+        unlock(fd)
+    if not found:
+        shutil.copyfile(path, staged)
+        os.chmod(staged, 0o444)
+
+    fd = locked(cache_dir)
+    try:
+        # an object added meanwhile by another job has the same content
+        if not found and not link_object(cache_dir, digest, staged):
+            os.link(staged, os.path.join(cache_dir, 'objects', digest))
+        index = load_index(cache_dir)
+        index[key] = digest
+        save_index(cache_dir, index)
+    finally:
+        unlock(fd)
+    return digest
+
+
+def warm_page_cache(paths):
+    for path in paths:
+        with open(path, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            while f.read(CHUNK_SIZE):
+                pass
+
+
+def shm_dir(bundle_id):
+    return os.path.join(SHM_DIR, 'reference-bundle-%s' % bundle_id)
+
+
+def shm_copy(bundle_dir, bundle_id):
+    """ Copy of the bundle on /dev/shm, None if it does not fit """
+    shm_bundle = shm_dir(bundle_id)
+    if os.path.isdir(shm_bundle):
+        return shm_bundle
+    size = sum([os.path.getsize(os.path.join(bundle_dir, f)) for f in os.listdir(bundle_dir)])
+    st = os.statvfs(SHM_DIR)
+    if st.f_bavail * st.f_frsize < size:
+        print('Not enough space on %s for the reference bundle, using the page cache' % SHM_DIR, file=sys.stderr)
+        return None
+    tmp = tempfile.mkdtemp(dir=SHM_DIR)
+    for f in os.listdir(bundle_dir):
+        shutil.copyfile(os.path.join(bundle_dir, f), os.path.join(tmp, f))
+    try:
+        os.rename(tmp, shm_bundle)
+    except OSError:  # copied concurrently by another job
+        shutil.rmtree(tmp, ignore_errors=True)
+    return shm_bundle
+
+
+def acquire_bundle(cache_dir, files, quota_gb=None, warm=None):
+    """
+    Put 'files' into the cache as one bundle. Returns (bundle_dir, lease), the bundle holds
+    the files under their base names and stays until release(lease) is called.
+    warm: None, 'none', 'pagecache' or 'shm'
+    """
+    for d in ['objects', 'bundles', 'tmp']:
+        if not os.path.isdir(os.path.join(cache_dir, d)): os.makedirs(os.path.join(cache_dir, d), exist_ok=True)
+
+    staging = tempfile.mkdtemp(dir=os.path.join(cache_dir, 'tmp'))
+    digests = {os.path.basename(f): stage_object(cache_dir, f, os.path.join(staging, os.path.basename(f)))
+               for f in files}
+    bundle_id = hashlib.md5(json.dumps(sorted(digests.items())).encode()).hexdigest()
+    bundle_dir = os.path.join(cache_dir, 'bundles', bundle_id)
+
+    fd = locked(cache_dir)
+    try:
+        if os.path.isdir(bundle_dir):
+            shutil.rmtree(staging)
+        else:
+            os.rename(staging, bundle_dir)
+        # take the lease before anyone can evict the bundle
+        lease = {'fd': os.open(bundle_dir + '.lease', os.O_CREAT | os.O_RDWR), 'bundle_id': bundle_id}
+        fcntl.flock(lease['fd'], fcntl.LOCK_SH)
+        os.utime(bundle_dir + '.lease')
+    finally:
+        unlock(fd)
+
+    if quota_gb:
+        evict(cache_dir, float(quota_gb) * 1024 ** 3)
+
+    if warm == 'shm':
+        shm_bundle = shm_copy(bundle_dir, bundle_id)
+        if shm_bundle:
+            return shm_bundle, lease
+    if warm in ('pagecache', 'shm'):
+        warm_page_cache([os.path.join(bundle_dir, f) for f in sorted(os.listdir(bundle_dir))])
+    return bundle_dir, lease
+
+
+def release(lease):
+    """ Ends the lease, the last one of a bundle drops its /dev/shm copy """
+    try:
+        # only succeeds when no other job holds a lease on the bundle, a job taking one
+        # meanwhile waits until the copy is gone and makes its own
+        fcntl.flock(lease['fd'], fcntl.LOCK_EX | fcntl.LOCK_NB)
+        shutil.rmtree(shm_dir(lease['bundle_id']), ignore_errors=True)
+    except OSError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+    finally:
+        fcntl.flock(lease['fd'], fcntl.LOCK_UN)
+        os.close(lease['fd'])
+
+
+def cache_size(cache_dir):
+    objects = os.path.join(cache_dir, 'objects')
+    return sum([os.path.getsize(os.path.join(objects, o)) for o in os.listdir(objects)])
+
+
+def evict(cache_dir, quota_bytes):
+    """ Drop least recently used bundles not in use, and objects no bundle links to, until under quota """
+    fd = locked(cache_dir)
+    try:
+        bundles_dir = os.path.join(cache_dir, 'bundles')
+        bundles = sorted([b for b in os.listdir(bundles_dir) if not b.endswith('.lease')],
+                         key=lambda b: os.path.getmtime(os.path.join(bundles_dir, b + '.lease'))
+                         if os.path.isfile(os.path.join(bundles_dir, b + '.lease')) else 0)
+        for bundle_id in bundles:
+            if cache_size(cache_dir) <= quota_bytes:
+                break
+            lease_file = os.path.join(bundles_dir, bundle_id + '.lease')
+            lease = os.open(lease_file, os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                os.close(lease)
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    continue  # in use
+                raise
+            shutil.rmtree(os.path.join(bundles_dir, bundle_id), ignore_errors=True)
+            shutil.rmtree(shm_dir(bundle_id), ignore_errors=True)
+            os.remove(lease_file)
+            os.close(lease)
+
+            # objects are only referenced by bundles, a single link left means unused
+            objects = os.path.join(cache_dir, 'objects')
+            for o in os.listdir(objects):
+                if os.stat(os.path.join(objects, o)).st_nlink == 1:
+                    os.remove(os.path.join(objects, o))
+            index = load_index(cache_dir)
+            save_index(cache_dir, {k: v for k, v in index.items() if os.path.isfile(os.path.join(objects, v))})
+    finally:
+        unlock(fd)
@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 import os
-import subprocess
 import sys
 import json
-import time
 import glob
+import picard_batch
+import bam_reheader
+import intermediate_codec
+from readgroup_metadata import readgroup_replacements, rg_header_line
 
 """
 Major steps:
 - Assigns all the reads in a file to a single new read-group
+- with eager_cleanup, each input BAM is deleted as soon as its read group is replaced, the
+  others at the end
 """
 
 task_dict = json.loads(sys.argv[1])
@@ -18,6 +22,8 @@ cwd = os.getcwd()
 picard = task_dict['input'].get('picard_jar')
 input_format = task_dict['input'].get('input_format')
 unaligned_by_rg_dir = task_dict['input'].get('unaligned_by_rg_dir')
+picard_workers = int(task_dict['input'].get('picard_workers') or 1)
+eager_cleanup = str(task_dict['input'].get('eager_cleanup')).lower() == 'true'
 
 with open(task_dict['input'].get('metadata_json'), 'r') as f:
     metadata = json.load(f)
@@ -26,16 +32,6 @@ output = {
     'unaligned_rg_replace_dir': None
 }
 
-RG_map = { 'ID': 'readGroupId',
-           'LB': 'libraryName',
-           'PL': 'sequencingPlatform',
-           'PU': 'platformUnit',
-           'SM': 'aliquotId',
-           'PM': 'platformModel',
-           'CN': 'sequencingCenter',
-           'PI': 'insertSize',
-           'DT': 'sequencingDate'}
-
 
 # the inputs are BAM
 if input_format == 'BAM':
@@ -43,43 +39,51 @@ if input_format == 'BAM':
     output_dir = os.path.join(cwd, 'unaligned_rg_replace')
     if not os.path.isdir(output_dir): os.makedirs(output_dir)
     output['unaligned_rg_replace_dir'] = output_dir
+    invocations = []
 
     for _file in files:
         file_path = _file.get('path')
         file_name = _file.get('fileName')
 
         # get all the rg for the _file
-        rg_yaml = set()
-        rg_replace = {}
-        for rg in _file.get('readGroups'):
-            rg_yaml.add(rg.get('readGroupIdInFile'))
-            rg_replace[rg.get('readGroupIdInFile')] = {}
-            for key, value in RG_map.items():
-                to_update = {}
-                if key == 'SM' and metadata.get(value):
-                    to_update = {key: metadata.get(value)}
-                if key in ['ID', 'LB', 'PL', 'PU', 'PM', 'CN', 'DT'] and rg.get(value) or key == 'PI' and isinstance(rg.get(value), int):
-                    to_update = {key: rg.get(value)}
-                # if key == 'DT' and re.match('^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}$', str(rg.get(value))):
-                #     to_update = {key: rg.get(value)}
-                if to_update:
-                    rg_replace[rg.get('readGroupIdInFile')].update(to_update)
+        rg_replace = readgroup_replacements(metadata, _file)
 
         # do the replacement for all readGroups
         for rg_old, rg_new in rg_replace.items():
+            input_bam = os.path.join(unaligned_by_rg_dir, rg_old+'.bam')
+            output_bam = os.path.join(output_dir, rg_new.get('ID')+'.new.bam')
+
+            # the reads keep their RG tag when the ID does not change, only the header needs a rewrite,
+            # rg_header_line writes DT as AddOrReplaceReadGroups does
+            if rg_old == rg_new.get('ID'):
+                try:
+                    bam_reheader.reheader(input_bam, output_bam,
+                                          lambda text: bam_reheader.replace_readgroups(text, rg_header_line(rg_new)))
+                    if eager_cleanup: os.remove(input_bam)
+                    continue
+                except bam_reheader.NotBgzfError as e:
+                    print('Header rewrite not possible for %s, using Picard: %s' % (input_bam, e), file=sys.stderr)
+                except Exception as e:
+                    sys.exit('\n%s: ReplaceReadGroups failed: %s' % (e, input_bam))
+
             rg_args = []
             for key, value in rg_new.items():
                 rg_args.append('RG%s=%s' % (key, value))
 
-            try:
-                subprocess.run(['java', '-jar', picard,
-                                'AddOrReplaceReadGroups',
+            invocations.append(['AddOrReplaceReadGroups',
                                 'VALIDATION_STRINGENCY=LENIENT',
-                                'I=%s' % os.path.join(unaligned_by_rg_dir, rg_old+'.bam'),
-                                'O=%s' % os.path.join(output_dir, rg_new.get('ID')+'.new.bam')] + \
-                                rg_args, check=True)
-            except Exception as e:
-                sys.exit('\n%s: ReplaceReadGroups failed: %s' % (e, os.path.join(unaligned_by_rg_dir, rg_old+'.bam')))
+                                'I=%s' % input_bam,
+                                'O=%s' % output_bam] + \
+                                rg_args + intermediate_codec.picard_args())
+
+    def cleanup(index, result):
+        if result['returncode'] == 0: os.remove(result['args'][2][len('I='):])
+
+    # all read groups go through the same few JVMs
+    for result in picard_batch.run_batch(picard, invocations, workers=picard_workers,
+                                         java_opts=intermediate_codec.JAVA_OPTS, on_result=cleanup if eager_cleanup else None):
+        if result['returncode'] != 0:
+            sys.exit('\nexit status %s: ReplaceReadGroups failed: %s' % (result['returncode'], result['args'][2][len('I='):]))
 
     # delete input bam files at the very last moment
     if os.path.isdir(unaligned_by_rg_dir):
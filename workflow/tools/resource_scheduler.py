@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import os
+import subprocess
+import time
+import instrument
+import node_budget
+
+"""
+Run a set of independent commands concurrently under a CPU/RAM budget:
+- each job is a dict with 'name', 'cmd', 'cpus', 'mem' and optionally 'kill_cmd', 'scratch'
+  (GB it writes) and 'cleanup' (files deleted as soon as it succeeded)
+- jobs are started in the given order as soon as their share of the budget is free
+- the first failing job stops the scheduling, running jobs get killed (fail fast)
+- with NODE_BUDGET_DIR set, the budget is the one of the node, shared with the other
+  jobs on it (see node_budget.py), instead of the one given
+- with a scratch_free callable, a job is started only when its scratch fits in the space
+  it returns next to the scratch of the running jobs
+- when the scheduler itself is interrupted, the running jobs are killed and their grants
+  released
+"""
+
+
+def total_cpus():
+    return os.cpu_count() or 1
+
+
+def total_mem_gb():
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3)
+    except (ValueError, OSError):
+        return 8
+
+
+def available_mem_gb():
+    """ Memory not in use by other processes, MemAvailable of /proc/meminfo """
+    try:
+        with open('/proc/meminfo', 'r') as m:
+            for line in m:
+                if line.startswith('MemAvailable:'):
+                    return max(1, int(int(line.split()[1]) / 1024 ** 2))
+    except (OSError, ValueError, IndexError):
+        pass
+    return total_mem_gb()
+
+
+def split_budget(sizes, cpus, mem, max_parallel=None, min_cpus=1, min_mem=1):
+    """
+    Split the cpus/mem budget across jobs proportionally to their sizes. Shares are
+    computed against the largest 'max_parallel' jobs, so that this many of them can
+    run side by side, smaller jobs get a smaller slice and pack into the gaps.
+    Returns a list of (cpus, mem) in the order of 'sizes'.
+    """
+    if not sizes:
+        return []
+    if not max_parallel or max_parallel < 1:
+        max_parallel = len(sizes)
+    max_parallel = max(1, min(max_parallel, len(sizes), cpus // min_cpus, mem // min_mem))
+
+    window = sum(sorted(sizes, reverse=True)[:max_parallel]) or 1
+    shares = []
+    for size in sizes:
+        fraction = (size or 1) / window if sum(sizes) else 1.0 / max_parallel
+        shares.append((min(cpus, max(min_cpus, int(cpus * fraction))),
+                       min(mem, max(min_mem, int(mem * fraction)))))
+    return shares
+
+
+def run_jobs(jobs, cpus, mem, poll_interval=5, scratch_free=None):
+    """
+    Run the jobs, returns None when all of them succeeded, otherwise the first failed
+    job dict with its 'returncode' set. Jobs asking for more than the budget are run
+    alone.
+    scratch_free: returns the GB that can still be written, what the running jobs wrote so
+    far is counted twice, on disk and in their 'scratch', which errs on the safe side
+    """
+    pending = list(jobs)
+    running = []
+    free_cpus, free_mem = cpus, mem
+    shared = node_budget.budget_dir()
+
+    try:
+        while pending or running:
+            # start as many pending jobs as the free budget allows, in order
+            for job in list(pending):
+                if scratch_free and running and \
+                        job.get('scratch', 0) + sum([r.get('scratch', 0) for r in running]) > scratch_free():
+                    # the jobs finishing frees space, keep the order
+                    break
+                if shared:
+                    job['grant'] = node_budget.try_acquire(shared, node_budget.job_id(), job['cpus'], job['mem'],
+                                                           label=job.get('label'))
+                    if not job['grant']:
+                        # keep the order, later jobs must not overtake the one waiting for the node
+                        break
+                elif running and (job['cpus'] > free_cpus or job['mem'] > free_mem):
+                    continue
+                try:
+                    job['process'] = instrument.Popen(job['cmd'], label=job.get('label'), container=job.get('container'))
+                except BaseException:
+                    if job.get('grant'):
+                        node_budget.release(shared, job['grant'])
+                    raise
+                job['start_time'] = time.time()
+                running.append(job)
+                pending.remove(job)
+                free_cpus -= job['cpus']
+                free_mem -= job['mem']
+
+            time.sleep(poll_interval if running or pending else 0)
+
+            for job in list(running):
+                returncode = job['process'].poll()
+                if returncode is None:
+                    continue
+                running.remove(job)
+                free_cpus += job['cpus']
+                free_mem += job['mem']
+                if job.get('grant'):
+                    node_budget.release(shared, job['grant'])
+                job['returncode'] = returncode
+                job['end_time'] = time.time()
+                if returncode != 0:
+                    kill_jobs(running)
+                    return job
+                for f in job.get('cleanup', []):
+                    if os.path.isfile(f): os.remove(f)
+    except BaseException:
+        # interrupted or failed to start a job, the running ones do not outlive the scheduler
+        kill_jobs(running)
+        raise
+
+    return None
+
+
+def kill_jobs(jobs):
+    for job in jobs:
+        if job.get('kill_cmd'):
+            subprocess.run(job['kill_cmd'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        job['process'].terminate()
+    for job in jobs:
+        try:
+            job['process'].wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            job['process'].kill()
+        if job.get('grant'):
+            node_budget.release(node_budget.budget_dir(), job['grant'])
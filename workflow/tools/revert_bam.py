@@ -1,25 +1,42 @@
 #!/usr/bin/env python3
 
 import os
-import subprocess
 import sys
 import json
 import glob
 import re
 import datetime
+import fused_revert
+import parallel_revert
+import intermediate_codec
+from readgroup_metadata import readgroup_replacements, comments
+import task_cache
+import instrument
+import scratch_plan
 
 """
 Major steps:
 - produce an unmapped BAM (uBAM) from a previously aligned BAM
+- in fused mode, also replace the read groups and add the header comments from the metadata
+  in the same pass, instead of running replace_readgroup.py and add_comment.py afterwards
+- with more than one revert worker, split by read group first and sort the read groups in
+  parallel (see parallel_revert.py), the lane BAMs are the same
+- with eager_cleanup, each downloaded BAM is deleted as soon as it is reverted, not after all
 """
 
 task_dict = json.loads(sys.argv[1])
 
+if task_cache.restore(task_dict):
+    sys.exit()
+
 cwd = os.getcwd()
 
 picard = task_dict['input'].get('picard_jar')
 input_format = task_dict['input'].get('input_format')
 download_files = task_dict['input'].get('download_files')
+fused = str(task_dict['input'].get('fused')).lower() == 'true'
+revert_workers = int(task_dict['input'].get('revert_workers') or 1)
+eager_cleanup = str(task_dict['input'].get('eager_cleanup')).lower() == 'true'
 
 with open(task_dict['input'].get('metadata_json'), 'r') as f:
     metadata = json.load(f)
@@ -40,6 +57,7 @@ if input_format == 'BAM':
             if bam_dict.get('path') == file_path and bam_dict.get('name') == file_name:
                 file_with_path = bam_dict.get('local_path')
                 break
+        else:
             sys.exit('Error: can not find the input BAM file specified in metadata YAML: %s, %s' % (file_name, file_path))
 
         # check whether the download files exist
@@ -47,32 +65,56 @@ if input_format == 'BAM':
 
         # Revert the bam to unaligned and lane level bam sorted by query name
         # Suggested options from: https://github.com/broadinstitute/picard/issues/849#issuecomment-313128088
+        revert_args = ['I=%s' % file_with_path,
+                       'SANITIZE=true',
+                       'ATTRIBUTE_TO_CLEAR=XT',
+                       'ATTRIBUTE_TO_CLEAR=XN',
+                       'ATTRIBUTE_TO_CLEAR=AS',
+                       'ATTRIBUTE_TO_CLEAR=OC',
+                       'ATTRIBUTE_TO_CLEAR=OP',
+                       'SORT_ORDER=queryname',
+                       'RESTORE_ORIGINAL_QUALITIES=true',
+                       'REMOVE_DUPLICATE_INFORMATION=true',
+                       'REMOVE_ALIGNMENT_INFORMATION=true',
+                       'VALIDATION_STRINGENCY=LENIENT']
+
+        if fused:
+            rg_replace = readgroup_replacements(metadata, _file)
+            outputs = {}
+            for rg_old, rg_new in rg_replace.items():
+                # named as add_comment.py names the lane BAMs of the Picard chain
+                outputs[rg_old] = os.path.join(cwd, rg_new.get('ID').replace(':', '_')+".lane.bam")
+            error = fused_revert.run(picard, revert_args, rg_replace, comments(metadata), outputs)
+            if error:
+                sys.exit('\n%s: Fused RevertSam failed: %s' % (error, file_with_path))
+            output['bams'].extend([outputs[rg_old] for rg_old in rg_replace])
+            if eager_cleanup: scratch_plan.remove_intermediates([file_with_path], cwd)
+            continue
+
+        if revert_workers > 1:
+            lane_bams, error = parallel_revert.run(picard, file_with_path, revert_args, cwd, revert_workers)
+            if error:
+                sys.exit('\n%s: RevertSam failed: %s' % (error, file_with_path))
+            output['bams'].extend(lane_bams)
+            if eager_cleanup: scratch_plan.remove_intermediates([file_with_path], cwd)
+            continue
+
         try:
-            subprocess.run(['java', '-jar', picard,
-                            'RevertSam',
-                            'I=%s' % file_with_path,
-                            'SANITIZE=true',
-                            'ATTRIBUTE_TO_CLEAR=XT',
-                            'ATTRIBUTE_TO_CLEAR=XN',
-                            'ATTRIBUTE_TO_CLEAR=AS',
-                            'ATTRIBUTE_TO_CLEAR=OC',
-                            'ATTRIBUTE_TO_CLEAR=OP',
-                            'SORT_ORDER=queryname',
-                            'RESTORE_ORIGINAL_QUALITIES=true',
-                            'REMOVE_DUPLICATE_INFORMATION=true',
-                            'REMOVE_ALIGNMENT_INFORMATION=true',
-                            'OUTPUT_BY_READGROUP=true',
-                            'VALIDATION_STRINGENCY=LENIENT',
-                            'O=%s' % cwd], check=True)
+            instrument.run(['java'] + intermediate_codec.JAVA_OPTS + ['-jar', picard,
+                            'RevertSam'] + revert_args + intermediate_codec.picard_args() +
+                           ['OUTPUT_BY_READGROUP=true',
+                            'O=%s' % cwd], label='RevertSam', check=True)
         except Exception as e:
             sys.exit('\n%s: RevertSam failed: %s' %(e, file_with_path))
 
-        for filename in glob.glob(os.path.join(cwd, "*.bam")):
+        # in the order of the read group IDs, as parallel_revert.py returns them
+        for filename in sorted(glob.glob(os.path.join(cwd, "*.bam"))):
             # convert readGroupId to filename friendly
             readGroupId = os.path.basename(filename).replace(".bam", "")
             rg_fname = "".join([c if re.match(r"[a-zA-Z0-9\-_]", c) else "_" for c in readGroupId])
             os.rename(filename, os.path.join(cwd, rg_fname+".lane.bam"))
             output['bams'].append(os.path.join(cwd, rg_fname+".lane.bam"))
+        if eager_cleanup: scratch_plan.remove_intermediates([file_with_path], cwd)
 
 elif input_format == 'FASTQ':
     output['bams'] = task_dict['input'].get('bams')
@@ -82,8 +124,10 @@ else:
 
 output['aligned_bam_basename'] = '.'.join([metadata.get('aliquotId'), str(len(output['bams'])), datetime.date.today().strftime("%Y%m%d"), 'wgs', 'grch38'])
 
-# delete the files at the very last step
-for file_dict in download_files:
+# delete the files at the very last step, the FASTQs of streamed lanes are read during the
+# alignment, bwa_mem_aligner_wrapper.py deletes those
+streamed = [b for b in output['bams'] if b.endswith('.stream.json')]
+for file_dict in download_files if not streamed else []:
     if not os.path.isfile(file_dict.get('local_path')):
         continue
     # remove only when the file is downloaded into another task dir of the same job
@@ -97,3 +141,5 @@ for file_dict in download_files:
 
 with open("output.json", "w") as o:
     o.write(json.dumps(output))
+
+task_cache.save(task_dict)
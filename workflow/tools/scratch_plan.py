@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import shutil
+import yaml
+import intermediate_codec
+
+"""
+Scratch space of a job, predicted up front and kept in check while it runs:
+- predict() walks the stages of the workflow with the fileSize of every input file from the
+  metadata, the size of what each stage writes is estimated relative to its input (see the
+  factors below), and returns the space in use at the peak of each stage
+- with eager cleanup an intermediate is deleted as soon as its last consumer finished: a
+  downloaded file once its read group (FASTQ) or its BAM is reverted, a lane BAM once its lane
+  is aligned, the aligned lane BAMs once they are merged. Without it the downloads go at the
+  end of revert_bam.py and the lane BAMs and aligned lane BAMs stay until the job is removed
+- the alignment is predicted one lane at a time, the least it can be run with, with a scratch
+  quota bwa_mem_aligner_wrapper.py starts the next lane only when the predicted size of its
+  output fits next to what is on disk (free_gb)
+- streamed lanes have no lane BAM on disk, the prediction is an upper bound for them
+
+  scratch_plan.py [--eager] [--cram] <metadata.yaml> ...
+"""
+
+GB = 1024 ** 3
+# size of a lane BAM relative to its input, FASTQs are converted as they are, a reverted BAM
+# lost its alignment information. At Picard's default level, the lane BAMs are written at the
+# level of the intermediate BAMs (intermediate_codec.py)
+LANE_BAM_FACTOR = {'FASTQ': 1.0, 'BAM': 0.8}
+# aligned lane BAM relative to its lane BAM at Picard's default level
+ALIGNED_FACTOR = 1.3
+# merged BAM with the duplicates marked relative to the aligned lane BAMs, the CRAM to the BAM
+MERGED_FACTOR = 1.0
+CRAM_FACTOR = 0.5
+
+
+def input_format(metadata):
+    files = metadata['files'] if 'files' in metadata else metadata['readGroups'][0]['files']
+    return files[0]['fileType']
+
+
+def input_units(metadata):
+    """
+    (downloaded bytes, [lane bytes]) of each unit a download is deleted after: a read group of
+    FASTQ input, a file of BAM input, whose read groups are taken to be of the same size
+    """
+    fmt = input_format(metadata)
+    factor = LANE_BAM_FACTOR[fmt] * intermediate_codec.size_factor()
+    if fmt == 'FASTQ':
+        return [(sum([int(f['fileSize']) for f in rg['files']]),
+                 [sum([int(f['fileSize']) for f in rg['files']]) * factor])
+                for rg in metadata['readGroups']]
+
+    # a BAM is listed under each of its read groups in the metadata YAML, once in the reshaped one
+    files = {}
+    for rg in metadata['readGroups'] if 'files' not in metadata else []:
+        for f in rg['files']:
+            files.setdefault(f['fileName'], [int(f['fileSize']), 0])[1] += 1
+    for f in metadata.get('files', []):
+        files[f['fileName']] = [int(f['fileSize']), len(f['readGroups'])]
+    return [(size, [size * factor / n] * n) for size, n in files.values()]
+
+
+def predict(metadata, eager=False, cram=False):
+    """
+    Returns {'stages': [{'stage', 'peak_gb', 'after_gb'}], 'peak_gb'}, the space in use at
+    the peak of each stage and once it finished
+    """
+    units = input_units(metadata)
+    stages = []
+
+    def stage(name):
+        stages.append({'stage': name, 'peak_gb': round(peak / GB, 3), 'after_gb': round(live / GB, 3)})
+
+    live = peak = sum([d for d, _ in units])
+    stage('download')
+
+    peak = live
+    for downloaded, lanes in units:
+        live += sum(lanes)
+        peak = max(peak, live)
+        if eager:
+            live -= downloaded
+    if not eager:
+        live -= sum([d for d, _ in units])
+    stage('lane_bams')
+
+    # largest lanes first, as they are scheduled
+    lanes = sorted([lane for _, unit_lanes in units for lane in unit_lanes], reverse=True)
+    peak = live
+    for lane in lanes:
+        live += lane * ALIGNED_FACTOR / intermediate_codec.size_factor()
+        peak = max(peak, live)
+        if eager:
+            live -= lane
+    stage('bwa_mem_aligner')
+
+    aligned = sum(lanes) * ALIGNED_FACTOR / intermediate_codec.size_factor()
+    merged = aligned * MERGED_FACTOR
+    live += merged
+    peak = live
+    if cram:
+        live += merged * CRAM_FACTOR
+        peak = live
+        live -= merged
+    if eager:
+        live -= aligned
+    stage('bam_merge_sort_markdup')
+
+    return {'stages': stages, 'peak_gb': max([s['peak_gb'] for s in stages])}
+
+
+def usage_gb(path):
+    """ Space taken by the files under 'path' """
+    used = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                used += os.lstat(os.path.join(root, f)).st_blocks * 512
+            except OSError:
+                pass  # deleted meanwhile
+    return used / GB
+
+
+def free_gb(job_dir, quota_gb=None):
+    """ Space the job can still write, the free space of the disk or what is left of the quota """
+    free = shutil.disk_usage(job_dir).free / GB
+    if quota_gb:
+        free = min(free, float(quota_gb) - usage_gb(job_dir))
+    return free
+
+
+def is_intermediate(path, cwd):
+    """ A file in another task dir of the same job, files from elsewhere are never deleted """
+    return path.split(os.sep)[:-2] == cwd.split(os.sep)[:-1]
+
+
+def remove_intermediates(paths, cwd):
+    for path in paths:
+        if os.path.isfile(path) and is_intermediate(path, cwd):
+            os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict the scratch space of the workflow from metadata YAMLs')
+    parser.add_argument('metadata_yaml', nargs='+')
+    parser.add_argument('--eager', action='store_true', help='with eager_cleanup')
+    parser.add_argument('--cram', action='store_true', help='with cram_primary')
+    args = parser.parse_args()
+
+    plans = {}
+    for path in args.metadata_yaml:
+        with open(path, 'r') as f:
+            plans[path] = predict(yaml.safe_load(f), args.eager, args.cram)
+    print(json.dumps(plans if len(plans) > 1 else plans[args.metadata_yaml[0]], indent=2))
+
+
+if __name__ == "__main__":
+    main()
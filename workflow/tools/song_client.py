@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.client
+import json
+import os
+import queue
+import random
+import ssl
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from file_checksum import SIDECAR_SUFFIX
+
+"""
+SONG client shared by the upload, save, manifest and publish steps:
+- keep-alive connections are pooled per SONG server, so the calls of a step, and of the
+  repositories of a batch, do not each open a new TLS connection
+- failed calls are retried with exponential backoff and jitter, up to MAX_RETRIES times:
+  any call whose connection could not be opened, and 429 responses, which the server rejected
+  unprocessed. Idempotent calls (GET, PUT, DELETE) also on lost connections and 5xx responses,
+  a POST (upload, save) that may have reached the server is not sent again, other errors fail
+  right away
+- batch() runs calls against several SONG servers (collab, aws) concurrently
+Only the standard library is used, any http:// URL works, e.g. benchmark/stubs/song_server.py.
+The pooled, retrying JsonClient underneath is also used for the object store (object_upload.py).
+
+Used as a module, and from the workflow as
+  song_client.py <upload|save|manifest|publish|submit> --url ... --study ... [options]
+which writes output.json for the task.
+"""
+
+MAX_RETRIES = 5
+BACKOFF = 1.0  # seconds before the first retry, doubled for each further one
+MAX_BACKOFF = 60
+TIMEOUT = 300
+POOL_SIZE = 4
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# rejected before it was processed, retried whatever the method
+UNPROCESSED_STATUS = (429,)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+
+class RequestError(Exception):
+    def __init__(self, message, status=None, body=None):
+        super(RequestError, self).__init__(message)
+        self.status = status
+        self.body = body
+
+
+class SongError(RequestError):
+    pass
+
+
+class ConnectionPool(object):
+    """ Idle keep-alive connections to one server, at most 'size' are kept """
+    def __init__(self, url, size=POOL_SIZE, timeout=TIMEOUT):
+        parsed = urllib.parse.urlsplit(url)
+        self.https = parsed.scheme == 'https'
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.base_path = parsed.path.rstrip('/')
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+
+    def new(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout,
+                                               context=ssl.create_default_context())
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def get(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.new()
+
+    def put(self, conn):
+        if self.idle.qsize() < self.size:
+            self.idle.put(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+class JsonClient(object):
+    """ JSON over HTTP with pooled connections and retries, raises 'Error' when a call fails """
+    Error = RequestError
+
+    def __init__(self, url, token=None, retries=MAX_RETRIES, backoff=BACKOFF, timeout=TIMEOUT, pool_size=POOL_SIZE):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = ConnectionPool(self.url, pool_size, timeout)
+
+    def request(self, method, path, body=None, content_type='application/json'):
+        """ Returns the decoded JSON response (None when empty), raises 'Error' once the retries are used up """
+        headers = {'Accept': 'application/json', 'Content-Type': content_type}
+        if self.token:
+            headers['Authorization'] = 'Bearer %s' % self.token
+        if body is not None and not isinstance(body, (bytes, str)):
+            body = json.dumps(body)
+
+        idempotent = method in IDEMPOTENT_METHODS
+        for attempt in range(self.retries + 1):
+            # a kept-alive connection closed by the server in the meantime would fail a POST
+            # that may have reached it, those get a connection of their own
+            conn = self.pool.get() if idempotent else self.pool.new()
+            sent = False
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                sent = True
+                conn.request(method, self.pool.base_path + path, body=body, headers=headers)
+                res = conn.getresponse()
+                data = res.read()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                error = self.Error('%s %s%s failed: %s' % (method, self.url, path, e))
+                if sent and not idempotent:
+                    raise error
+            else:
+                if res.will_close:
+                    conn.close()
+                else:
+                    self.pool.put(conn)
+                if 200 <= res.status < 300:
+                    return json.loads(data.decode()) if data.strip() else None
+                error = self.Error('%s %s%s failed with %s: %s' % (method, self.url, path, res.status, data.decode(errors='replace')[:1000]),
+                                  status=res.status, body=data)
+                if res.status not in (RETRY_STATUS if idempotent else UNPROCESSED_STATUS):
+                    raise error
+
+            if attempt < self.retries:
+                delay = min(MAX_BACKOFF, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+                print('%s, retrying in %.1fs' % (error, delay), file=sys.stderr)
+                time.sleep(delay)
+        raise error
+
+    def close(self):
+        self.pool.close()
+
+
+class SongClient(JsonClient):
+    Error = SongError
+
+    def __init__(self, url, token=None, **kwargs):
+        token = token if token is not None else os.environ.get('ACCESSTOKEN', os.environ.get('SONG_TOKEN'))
+        super(SongClient, self).__init__(url, token, **kwargs)
+
+    def upload(self, study, payload):
+        return self.request('POST', '/upload/%s' % study, payload)
+
+    def save(self, study, upload_id):
+        return self.request('POST', '/upload/%s/save/%s' % (study, upload_id))
+
+    def analysis(self, study, analysis_id):
+        return self.request('GET', '/studies/%s/analysis/%s' % (study, analysis_id))
+
+    def publish(self, study, analysis_id):
+        return self.request('PUT', '/studies/%s/analysis/publish/%s' % (study, analysis_id))
+
+    def submit(self, study, payload):
+        """ upload and save, returns the response of the save, holding the analysisId """
+        return self.save(study, self.upload(study, payload)['uploadId'])
+
+    def manifest(self, study, analysis_id, input_dir, manifest_file):
+        """ score-client upload manifest of the files of a saved analysis, found in 'input_dir' """
+        song_metadata = self.analysis(study, analysis_id)
+        with open(manifest_file, 'w') as m:
+            m.write('%s\t\t\n' % song_metadata['analysisId'])
+            for f in song_metadata['file']:
+                local_file = os.path.join(input_dir, f['fileName'])
+                # the md5 recorded when the file was written, a file changed since the payload was
+                # made fails here instead of after its upload
+                if os.path.isfile(local_file + SIDECAR_SUFFIX):
+                    with open(local_file + SIDECAR_SUFFIX, 'r') as s:
+                        sidecar = json.load(s)
+                    if sidecar['fileMd5sum'] != f['fileMd5sum'] or sidecar['fileSize'] != os.path.getsize(local_file):
+                        raise SongError('Local file %s does not match the saved SONG analysis' % f['fileName'])
+                m.write('%s\t%s\t%s\n' % (f['objectId'], local_file, f['fileMd5sum']))
+        return manifest_file
+
+
+def batch(calls, workers=None):
+    """
+    Runs calls like (client, 'upload', study, payload) concurrently, returns their results in
+    order, a call that failed has its exception in place of the result.
+    """
+    def call(c):
+        try:
+            return getattr(c[0], c[1])(*c[2:])
+        except Exception as e:
+            return e
+
+    if not calls:
+        return []
+    with ThreadPoolExecutor(max_workers=workers or len(calls)) as executor:
+        return list(executor.map(call, calls))
+
+
+def write_output(output):
+    with open('output.json', 'w') as o:
+        o.write(json.dumps(output))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SONG upload, save, manifest and publish, writing output.json for the task')
+    parser.add_argument('command', choices=['upload', 'save', 'manifest', 'publish', 'submit'])
+    parser.add_argument('--url', action='append', required=True, help='SONG server, several with submit')
+    parser.add_argument('--study', required=True)
+    parser.add_argument('--is-allowed', dest='is_allowed', action='append',
+                        help='"True" unless the step is skipped, one per --url with submit')
+    parser.add_argument('--payload')
+    parser.add_argument('--upload-id', dest='upload_id')
+    parser.add_argument('--analysis-id', dest='analysis_id')
+    parser.add_argument('--input-dir', dest='input_dir', help='where the files of the analysis are, for manifest')
+    parser.add_argument('--retries', type=int, default=MAX_RETRIES)
+    args = parser.parse_args()
+
+    allowed = [a == 'True' for a in (args.is_allowed or ['True'] * len(args.url))]
+    if len(allowed) != len(args.url):
+        sys.exit('Give one --is-allowed per --url')
+
+    if args.command == 'submit':
+        # upload and save to all the allowed SONG servers at the same time
+        with open(args.payload, 'r') as f:
+            payload = f.read()
+        clients = [SongClient(url, retries=args.retries) for url, a in zip(args.url, allowed) if a]
+        results = batch([(c, 'submit', args.study, payload) for c in clients])
+        failed = ['%s: %s' % (c.url, r) for c, r in zip(clients, results) if isinstance(r, Exception)]
+        if failed:
+            sys.exit('SONG submit failed: %s' % '; '.join(failed))
+        write_output({'analyses': [{'song_metadata_url': c.url, 'analysisId': r['analysisId']}
+                                   for c, r in zip(clients, results)]})
+        return
+
+    skipped = {
+        'upload': {'task_skipped': True, 'status': '', 'uploadId': ''},
+        'save': {'task_skipped': True, 'status': '', 'analysisId': ''},
+        'manifest': {'task_skipped': True, 'manifest_file': ''},
+        'publish': {'task_skipped': True}
+    }
+    if not allowed[0]:
+        write_output(skipped[args.command])
+        return
+
+    client = SongClient(args.url[0], retries=args.retries)
+    try:
+        if args.command == 'upload':
+            with open(args.payload, 'r') as f:
+                write_output(client.upload(args.study, f.read()))
+        elif args.command == 'save':
+            write_output(client.save(args.study, args.upload_id))
+        elif args.command == 'manifest':
+            manifest_file = os.path.join(os.getcwd(), 'manifest.txt')
+            write_output({'manifest_file': client.manifest(args.study, args.analysis_id, args.input_dir, manifest_file)})
+        elif args.command == 'publish':
+            client.publish(args.study, args.analysis_id)
+            print('Publishing succeeded for %s' % args.analysis_id)
+            write_output({'task_skipped': False, 'status': 'ok'})
+    except SongError as e:
+        sys.exit('SONG %s failed: %s' % (args.command, e))
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
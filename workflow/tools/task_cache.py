@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+import argparse
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import docker_image
+import instrument
+from file_checksum import md5_file
+
+"""
+Task result cache, so a re-submitted job restores the tasks that already completed instead
+of running them again. Enabled by the TASK_CACHE_DIR environment variable:
+- the key of a task is the hash of its tool name, the tools' source code, main.jt and its
+  input, where input values naming files or directories are replaced by the md5 of their
+  content, and docker images by the digest they resolve to
+- the md5 of a file is computed once, kept under <TASK_CACHE_DIR>/md5 for its inode, size and
+  mtime, download.py records the md5 it verified against the metadata there
+- on success the task directory and output.json are saved under the key, files are hard linked
+  when the cache is on the same filesystem, copied otherwise. A task whose files take more
+  than MAX_ENTRY_FRACTION of the cache size (TASK_CACHE_MAX_GB, MAX_DISK_FRACTION of the disk
+  by default) is not saved, the bulk intermediates are left to the scratch space of the job,
+  the least recently used tasks are evicted to keep the cache within its size
+- a task with a saved key gets its files linked back, output.json and the other JSON files
+  (the stream specs of fastq_to_sam.py) rewritten for the paths of the new job, every lookup
+  is appended to <TASK_CACHE_DIR>/report.jsonl
+"""
+
+MAX_DISK_FRACTION = 0.2
+MAX_ENTRY_FRACTION = 0.25
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKFLOW_FILE = os.path.join(TOOLS_DIR, '..', 'main.jt')
+
+# key computed by restore() before the task ran, the task may remove or add files to its inputs
+_task_key = None
+
+
+def cache_dir():
+    return os.environ.get('TASK_CACHE_DIR')
+
+
+def tool_name():
+    return os.path.splitext(os.path.basename(sys.argv[0]))[0]
+
+
+def max_bytes():
+    if os.environ.get('TASK_CACHE_MAX_GB'):
+        return float(os.environ['TASK_CACHE_MAX_GB']) * 1024 ** 3
+    return shutil.disk_usage(cache_dir()).total * MAX_DISK_FRACTION
+
+
+def tools_version():
+    md5 = hashlib.md5()
+    for f in sorted(os.listdir(TOOLS_DIR)):
+        if f.endswith('.py') or f.endswith('.java'):
+            with open(os.path.join(TOOLS_DIR, f), 'rb') as s:
+                md5.update(f.encode() + s.read())
+    if os.path.isfile(WORKFLOW_FILE):
+        with open(WORKFLOW_FILE, 'rb') as s:
+            md5.update(b'main.jt' + s.read())
+    return md5.hexdigest()
+
+
+def md5_record(path):
+    """ Where the md5 of the file at 'path' is kept, for as long as its inode, size and mtime do not change """
+    st = os.stat(path)
+    name = hashlib.md5(('%s:%s:%s:%s' % (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)).encode()).hexdigest()
+    return os.path.join(cache_dir(), 'md5', name[:2], name)
+
+
+def remember_md5(path, md5):
+    """ Records the md5 of a file verified by the caller, so it is not read again for the key """
+    if not cache_dir():
+        return
+    record_file = md5_record(path)
+    if not os.path.isdir(os.path.dirname(record_file)): os.makedirs(os.path.dirname(record_file), exist_ok=True)
+    tmp = '%s.%s' % (record_file, os.getpid())
+    with open(tmp, 'w') as r:
+        r.write(md5)
+    os.rename(tmp, record_file)
+
+
+def file_fingerprint(path):
+    record_file = md5_record(path)
+    if os.path.isfile(record_file):
+        with open(record_file, 'r') as r:
+            md5 = r.read()
+    else:
+        md5 = md5_file(path)
+        remember_md5(path, md5)
+    return '%s:%s' % (os.path.getsize(path), md5)
+
+
+def is_image(key):
+    return key.endswith('_docker') or key.endswith('_dckr')
+
+
+def fingerprint(value, ttl=docker_image.DEFAULT_TTL):
+    """
+    'value' with the paths of existing files and directories replaced by content fingerprints,
+    and the docker images by the reference they resolve to
+    """
+    if isinstance(value, dict):
+        return {k: {'image': docker_image.resolve(v, ttl=ttl)} if is_image(k) and v else fingerprint(v, ttl)
+                for k, v in value.items()}
+    if isinstance(value, list):
+        return [fingerprint(v, ttl) for v in value]
+    if isinstance(value, str) and os.path.isabs(value):
+        if os.path.isfile(value):
+            return {'file': file_fingerprint(value)}
+        if os.path.isdir(value):
+            files = {}
+            for root, _, names in os.walk(value):
+                for name in names:
+                    path = os.path.join(root, name)
+                    # output.json of an upstream task holds the absolute paths of its job
+                    if name == 'output.json' or not os.path.isfile(path):
+                        continue
+                    files[os.path.relpath(path, value)] = file_fingerprint(path)
+            return {'dir': files}
+    return value
+
+
+def task_key(task_dict):
+    return hashlib.sha256(json.dumps({
+        'tool': tool_name(),
+        'version': tools_version(),
+        'input': fingerprint(task_dict['input'], task_dict['input'].get('docker_image_ttl') or docker_image.DEFAULT_TTL)
+    }, sort_keys=True).encode()).hexdigest()
+
+
+def path_pairs(old, new):
+    """ (old path, new path) for the path strings at the same place in two task inputs """
+    if isinstance(old, dict) and isinstance(new, dict):
+        return [p for k in old if k in new for p in path_pairs(old[k], new[k])]
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        return [p for o, n in zip(old, new) for p in path_pairs(o, n)]
+    if isinstance(old, str) and isinstance(new, str) and os.path.isabs(old) and os.path.isabs(new) and old != new:
+        return [(old.rstrip(os.sep), new.rstrip(os.sep)),
+                (os.path.dirname(old.rstrip(os.sep)), os.path.dirname(new.rstrip(os.sep)))]
+    return []
+
+
+def remap(value, pairs):
+    """
+    Replace the longest matching old path prefix in every string of 'value', also in the
+    NAME=path arguments of Picard
+    """
+    if isinstance(value, dict):
+        return {k: remap(v, pairs) for k, v in value.items()}
+    if isinstance(value, list):
+        return [remap(v, pairs) for v in value]
+    if isinstance(value, str):
+        name, sep, path = value.partition('=') if not value.startswith(os.sep) else ('', '', value)
+        for old, new in pairs:
+            if path == old or path.startswith(old + os.sep):
+                return name + sep + new + path[len(old):]
+    return value
+
+
+def link_or_copy(src, dst):
+    if not os.path.isdir(os.path.dirname(dst)): os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        print('Task cache on another filesystem than %s, copied' % src, file=sys.stderr)
+        shutil.copy2(src, dst)
+
+
+def locked(exclusive):
+    """ The lock of the entries, shared while a task is restored, exclusive while saving or evicting """
+    f = open(os.path.join(cache_dir(), 'tasks', '.lock'), 'a')
+    fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    return f
+
+
+def entries():
+    """ (last use, bytes, path) of the saved tasks, least recently used first """
+    tasks_dir = os.path.join(cache_dir(), 'tasks')
+    found = []
+    for key in os.listdir(tasks_dir):
+        meta_file = os.path.join(tasks_dir, key, 'meta.json')
+        # entries being saved start with a dot
+        if key.startswith('.') or not os.path.isfile(meta_file):
+            continue
+        with open(meta_file, 'r') as m:
+            found.append((os.path.getmtime(meta_file), json.load(m).get('bytes', 0), os.path.join(tasks_dir, key)))
+    return sorted(found)
+
+
+def evict(limit):
+    """ Removes the least recently used entries until the cache is within 'limit' bytes, the lock held """
+    saved = entries()
+    total = sum([e[1] for e in saved])
+    for _, size, entry in saved:
+        if total <= limit:
+            break
+        evicted = os.path.join(os.path.dirname(entry), '.evicted-%s' % os.path.basename(entry))
+        os.rename(entry, evicted)
+        shutil.rmtree(evicted, ignore_errors=True)
+        total -= size
+
+
+def record(key, hit):
+    with open(os.path.join(cache_dir(), 'report.jsonl'), 'a') as r:
+        r.write(json.dumps({'tool': tool_name(), 'key': key, 'hit': hit, 'task_dir': os.getcwd(), 'time': time.time()}) + '\n')
+
+
+def restore(task_dict):
+    """ Restores the task from the cache, returns False when it has to run """
+    global _task_key
+    if not cache_dir():
+        return False
+    if not os.path.isdir(os.path.join(cache_dir(), 'tasks')): os.makedirs(os.path.join(cache_dir(), 'tasks'), exist_ok=True)
+    key = _task_key = task_key(task_dict)
+    entry = os.path.join(cache_dir(), 'tasks', key)
+    with locked(exclusive=False):
+        if not os.path.isfile(os.path.join(entry, 'meta.json')):
+            record(key, False)
+            return False
+
+        # recently used, evicted last
+        os.utime(os.path.join(entry, 'meta.json'))
+        with open(os.path.join(entry, 'meta.json'), 'r') as m:
+            meta = json.load(m)
+        cwd = os.getcwd()
+        pairs = sorted([(meta['task_dir'], cwd)] + path_pairs(meta['input'], task_dict['input']),
+                       key=lambda p: len(p[0]), reverse=True)
+
+        files_dir = os.path.join(entry, 'files')
+        for root, _, names in os.walk(files_dir):
+            for name in names:
+                rel = os.path.relpath(os.path.join(root, name), files_dir)
+                if os.path.exists(os.path.join(cwd, rel)):
+                    continue
+                if name.endswith('.json'):
+                    # holds the absolute paths of the job that saved it
+                    with open(os.path.join(root, name), 'r') as s, open(os.path.join(cwd, rel), 'w') as t:
+                        t.write(json.dumps(remap(json.load(s), pairs)))
+                else:
+                    link_or_copy(os.path.join(root, name), os.path.join(cwd, rel))
+        # files the task wrote next to its inputs
+        for path, stored in meta['extra_files'].items():
+            target = remap(path, pairs)
+            if not os.path.exists(target):
+                link_or_copy(os.path.join(entry, 'extra', stored), target)
+
+    with open('output.json', 'w') as o:
+        o.write(json.dumps(remap(meta['output'], pairs)))
+    record(key, True)
+    print('Restored %s from the task cache, key %s' % (tool_name(), key), file=sys.stderr)
+    return True
+
+
+def save(task_dict, extra_files=()):
+    """ Saves the finished task, 'extra_files' are outputs written outside the task directory """
+    if not cache_dir():
+        return
+    key = _task_key or task_key(task_dict)
+    entry = os.path.join(cache_dir(), 'tasks', key)
+    if os.path.isdir(entry):
+        return
+
+    cwd = os.getcwd()
+    files = []
+    for root, _, names in os.walk(cwd):
+        for name in names:
+            path = os.path.join(root, name)
+            # resource usage belongs to the run that produced the files, not to the restores
+            if path in (os.path.join(cwd, 'output.json'), os.path.join(cwd, instrument.USAGE_FILE)) or not os.path.isfile(path):
+                continue
+            files.append(path)
+    extra_files = [f for f in extra_files if os.path.isfile(f)]
+    size = sum([os.path.getsize(f) for f in files + extra_files])
+    limit = max_bytes()
+    if size > limit * MAX_ENTRY_FRACTION:
+        print('%s not saved to the task cache, its %.1f GB are more than %s of the cache size' %
+              (tool_name(), size / 1024 ** 3, MAX_ENTRY_FRACTION), file=sys.stderr)
+        return
+
+    tmp = tempfile.mkdtemp(prefix='.saving-', dir=os.path.join(cache_dir(), 'tasks'))
+    for path in files:
+        link_or_copy(path, os.path.join(tmp, 'files', os.path.relpath(path, cwd)))
+    extra = {}
+    for i, path in enumerate(extra_files):
+        extra[os.path.abspath(path)] = '%s.%s' % (i, os.path.basename(path))
+        link_or_copy(path, os.path.join(tmp, 'extra', extra[os.path.abspath(path)]))
+
+    with open('output.json', 'r') as o:
+        output = json.load(o)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as m:
+        m.write(json.dumps({'tool': tool_name(), 'task_dir': cwd, 'input': task_dict['input'],
+                            'output': output, 'extra_files': extra, 'bytes': size}))
+    with locked(exclusive=True):
+        try:
+            os.rename(tmp, entry)
+        except OSError:  # saved concurrently by another job
+            shutil.rmtree(tmp, ignore_errors=True)
+        evict(limit)
+
+
+def report(cache):
+    """ Hits and misses per tool """
+    summary = {}
+    if not os.path.isfile(os.path.join(cache, 'report.jsonl')):
+        return summary
+    with open(os.path.join(cache, 'report.jsonl'), 'r') as r:
+        for line in r:
+            lookup = json.loads(line)
+            counts = summary.setdefault(lookup['tool'], {'hits': 0, 'misses': 0})
+            counts['hits' if lookup['hit'] else 'misses'] += 1
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Task cache hits and misses per tool')
+    parser.add_argument('cache_dir', nargs='?', default=cache_dir())
+    args = parser.parse_args()
+    if not args.cache_dir:
+        sys.exit('No cache directory given and TASK_CACHE_DIR is not set')
+
+    print('%-30s %8s %8s' % ('tool', 'hits', 'misses'))
+    for tool, counts in sorted(report(args.cache_dir).items()):
+        print('%-30s %8s %8s' % (tool, counts['hits'], counts['misses']))
+
+
+if __name__ == "__main__":
+    main()
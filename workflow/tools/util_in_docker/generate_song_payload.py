@@ -12,16 +12,25 @@ from overture_song_payload import SongPayload
 import re, os
 import uuid
 import tarfile
+import glob
 import json
 import sys
+import hashlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 8 * 1024 * 1024
+# written by aligned_bam_qc.py for the BAM/CRAM and its index, by file_checksum.py for the tarball
+SIDECAR_SUFFIX = '.checksum.json'
 
 
 def main():
     """ Main program """
     parser = argparse.ArgumentParser(description='Convert yaml file to song payload')
     parser.add_argument('yaml_file', type=argparse.FileType('r'))
-    parser.add_argument('bam_file')
-    parser.add_argument('bai_file')
+    parser.add_argument('bam_file', help='the aligned BAM, or the CRAM when it is the published output')
+    parser.add_argument('bai_file', help='its BAI, or CRAI')
     parser.add_argument('tar_file')
     parser.add_argument('lane_unaligned_dir')
     parser.add_argument('oxog_metrics_dir')
@@ -33,12 +42,16 @@ def main():
     parser.add_argument('--wf-execution-runner-name',dest="wf_exec_runner_name", default="JTracker")
     parser.add_argument('--wf-execution-runner-version', dest="wf_exec_runner_ver", required=True)
     parser.add_argument('--wf-execution-job_id', dest="wf_exec_job", required=True)
+    parser.add_argument('--resource-usage-dir', dest="resource_usage_dir", default=None,
+                        help='job directory holding the task directories with resource_usage.json')
+    parser.add_argument('--checksum-dir', dest="checksum_dir", default=None,
+                        help='directory holding the <file>.checksum.json sidecars of the BAM, BAI and tgz')
     results = parser.parse_args()
 
     with open(os.path.join(results.multiple_metrics_dir,'multiple_metrics.insert_size_metrics'),'r') as fp:
         insert_size_metrics = load_insert_size_metrics(fp)
     quality_yield_metrics_dir = results.lane_unaligned_dir
-    yaml_data = yaml.load(results.yaml_file)
+    yaml_data = yaml.load(results.yaml_file, Loader=yaml.SafeLoader)
 
     song_payload = SongPayload(
         analysis_id=None,
@@ -51,7 +64,8 @@ def main():
                                           results.wf_exec_runner_name,
                                           results.wf_exec_runner_ver,
                                           results.wf_exec_job,
-                                          yaml_data)
+                                          yaml_data,
+                                          results.resource_usage_dir)
         },
         experiment_payload=ExperimentPayload(
             aligned=get_experiment_aligned(yaml_data),
@@ -96,7 +110,7 @@ def main():
                 }
             )
         ],
-        file_payloads=get_files(results.bam_file, results.bai_file, results.tar_file)
+        file_payloads=get_files(results.bam_file, results.bai_file, results.tar_file, results.checksum_dir)
     )
 
     payload = json.loads(song_payload.to_json())
@@ -109,23 +123,24 @@ def main():
     return 0  # why this is needed?
 
 
-def get_files(bam_file, bai_file, tar_file):
+def get_files(bam_file, bai_file, tar_file, checksum_dir=None):
+    checksums = get_checksums([bam_file, bai_file, tar_file], checksum_dir)
     file_payloads = []
     for file in [bam_file,bai_file]:
         file_payloads.append(FilePayload(
             file_access='controlled',
             file_name=os.path.basename(file),
-            md5sum=FilePayload.calculate_md5(file),
-            file_size=FilePayload.calculate_size(file),
-            file_type=FilePayload.retrieve_file_type(file),
+            md5sum=checksums[file][0],
+            file_size=checksums[file][1],
+            file_type=get_file_type(file),
             info={}
         ))
 
     file_payloads.append(FilePayload(
         file_access='controlled',
         file_name=os.path.basename(tar_file),
-        md5sum=FilePayload.calculate_md5(tar_file),
-        file_size=FilePayload.calculate_size(tar_file),
+        md5sum=checksums[tar_file][0],
+        file_size=checksums[tar_file][1],
         #TODO
         file_type=FilePayload.retrieve_file_type(tar_file),
         info={
@@ -152,6 +167,63 @@ def get_files(bam_file, bai_file, tar_file):
 
     return file_payloads
 
+def get_file_type(file):
+    # CRAM/CRAI are SONG file types too, not necessarily known to the payload library
+    for suffix, file_type in (('.cram', 'CRAM'), ('.crai', 'CRAI')):
+        if file.endswith(suffix):
+            return file_type
+    return FilePayload.retrieve_file_type(file)
+
+def get_checksums(files, checksum_dir=None):
+    """ (md5, size) of each file, from its sidecar when it matches the file, the others are hashed in parallel """
+    checksums = {}
+    for file in files:
+        sidecar = load_sidecar(file, checksum_dir) if checksum_dir else None
+        if sidecar is not None:
+            checksums[file] = sidecar
+    missing = [f for f in files if f not in checksums]
+    if missing:
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            checksums.update(zip(missing, executor.map(calculate_md5_size, missing)))
+    return checksums
+
+def load_sidecar(file, checksum_dir):
+    try:
+        with open(os.path.join(checksum_dir, os.path.basename(file) + SIDECAR_SUFFIX), 'r') as fp:
+            sidecar = json.load(fp)
+        st = os.stat(file)
+    except (OSError, ValueError):
+        return None
+    # a file rewritten after its sidecar gets hashed again
+    if st.st_size != sidecar.get('fileSize') or st.st_mtime_ns != sidecar.get('mtime_ns'):
+        return None
+    return sidecar['fileMd5sum'], sidecar['fileSize']
+
+def calculate_md5_size(file):
+    """ md5 and size of a file, the next chunk is read while the current one is hashed """
+    chunks = queue.Queue(maxsize=4)
+    def read():
+        try:
+            with open(file, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+                    chunks.put(chunk)
+            chunks.put(None)
+        except OSError as e:
+            chunks.put(e)
+    threading.Thread(target=read, daemon=True).start()
+
+    md5 = hashlib.md5()
+    size = 0
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        if isinstance(chunk, Exception):
+            raise chunk
+        md5.update(chunk)
+        size += len(chunk)
+    return md5.hexdigest(), size
+
 def list_files_tar_gz(fp_gz):
     files = []
     for member in fp_gz.getmembers():
@@ -224,8 +296,8 @@ def parse_quality_yield_metrics(metrics_fp):
                 lines.append(line.rstrip().split('\t'))
     return dict(zip(lines[0], lines[1]))
 
-def get_workflow_data(wf_name, wf_version, execution_runner_name, execution_runner_version, execution_job_id,yaml_data):
-    return {
+def get_workflow_data(wf_name, wf_version, execution_runner_name, execution_runner_version, execution_job_id,yaml_data,resource_usage_dir=None):
+    workflow_data = {
         'name': wf_name,
         'version': wf_version,
         'execution': {
@@ -235,6 +307,19 @@ def get_workflow_data(wf_name, wf_version, execution_runner_name, execution_runn
         },
         'input': get_workflow_data_files(yaml_data)
     }
+    if resource_usage_dir:
+        workflow_data['resourceUsage'] = get_workflow_resource_usage(resource_usage_dir)
+    return workflow_data
+
+def get_workflow_resource_usage(job_dir):
+    # summaries written by the tools' instrument.py, per task directory
+    usage = {}
+    for usage_file in sorted(glob.glob(os.path.join(job_dir, '*', 'resource_usage.json'))):
+        with open(usage_file, 'r') as f:
+            task_usage = json.load(f)
+        if task_usage.get('summary'):
+            usage[task_usage.get('task', os.path.basename(os.path.dirname(usage_file)))] = task_usage['summary']
+    return usage
 
 def get_workflow_data_files(yaml_data):
     files = []
@@ -1,15 +1,28 @@
 #!/usr/bin/env python3
+import argparse
 import yaml
 import os
 import sys
 import json
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 """
 Major steps:
 - validate the input metadata YAML
+
+Also validates metadata YAMLs in bulk, before they get scheduled:
+  validate_metadata.py [--workers N] [--report report.json] <yaml or directory> ...
+collects all the errors of every file, in worker processes, and reports them as JSON.
 """
 
+# the libyaml loader when PyYAML was built with it, several times faster
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+UUID = re.compile(r'^([a-f\d]{8}(-[a-f\d]{4}){3}-[a-f\d]{12})$')
+FIELDS = ['study', 'donorSubmitterId', 'specimenSubmitterId', 'sampleSubmitterId', 'aliquotId', 'specimenType', 'libraryStrategy', 'useCntl', 'readGroups']
+RG_FIELDS = ['readGroupId', 'sequencingPlatform', 'platformUnit', 'libraryName', 'files']
+FILE_FIELDS = ['fileName', 'fileSize', 'readGroupIdInFile', 'fileMd5sum', 'path', 'fileType']
+
 def reshape_metadata(input_metadata):
     output_metadata = {}
     output_files = {}
@@ -40,102 +53,209 @@ def reshape_metadata(input_metadata):
     return output_metadata
 
 
-task_dict = json.loads(sys.argv[1])
+def metadata_errors(input_metadata):
+    """
+    All the problems found in the metadata, as dicts with the 'location' of the field
+    (e.g. readGroups[1].files[0].fileSize) and the 'message', in the order they are checked
+    """
+    errors = []
+
+    def error(location, message):
+        errors.append({'location': location, 'message': message})
+
+    if not isinstance(input_metadata, dict):
+        error('', 'The metadata YAML must be a mapping of fields')
+        return errors
+
+    for field_name in FIELDS:
+        if not input_metadata.get(field_name):
+            error(field_name, 'The metadata YAML must contain and specify field: %s' % field_name)
+        elif field_name == 'aliquotId' and not UUID.match(str(input_metadata['aliquotId'])):
+            error(field_name, 'Must specify aliquotId in UUID format!')
+        elif field_name == 'useCntl' and input_metadata.get('specimenType'):
+            normal = 'normal' in str(input_metadata['specimenType']).lower()
+            if not normal and not UUID.match(str(input_metadata['useCntl'])):
+                error(field_name, 'Must specify useCntl for Tumor in metadata YAML file as UUID')
+            elif normal and not input_metadata['useCntl'] == 'N/A':
+                error(field_name, 'Must specify useCntl for Normal in metadata YAML file as N/A')
+
+    input_format = set()
+    read_groups = input_metadata.get('readGroups')
+    for i, readGroup in enumerate(read_groups if isinstance(read_groups, list) else []):
+        if not isinstance(readGroup, dict):
+            error('readGroups[%s]' % i, 'The metadata YAML must contain readGroup fields')
+            continue
+        for rg_field in RG_FIELDS:
+            if not readGroup.get(rg_field):
+                error('readGroups[%s].%s' % (i, rg_field), 'The metadata YAML must contain readGroup field: %s' % rg_field)
+        files = readGroup.get('files')
+        for j, fileInfo in enumerate(files if isinstance(files, list) else []):
+            if not isinstance(fileInfo, dict):
+                error('readGroups[%s].files[%s]' % (i, j), 'The metadata YAML must contain file fields')
+                continue
+            for file_field in FILE_FIELDS:
+                if not fileInfo.get(file_field):
+                    error('readGroups[%s].files[%s].%s' % (i, j, file_field), 'The metadata YAML must contain file field: %s' % file_field)
+            input_format.add(fileInfo.get('fileType'))
+
+    if errors:
+        # the format is only checked on otherwise complete metadata, as it was when the first error ended the check
+        return errors
+    if not len(input_format) == 1:
+        error('fileType', '\nError: The input files should have the same format.')
+    elif list(input_format)[0] not in ('FASTQ', 'BAM'):
+        error('fileType', '\n%s: Input files format are not FASTQ or BAM' % list(input_format)[0])
+    return errors
+
+
+def check_metadata(input_metadata):
+    """ Returns the message of the first problem found in the metadata, None when it is valid """
+    errors = metadata_errors(input_metadata)
+    return errors[0]['message'] if errors else None
+
+
+def load_metadata(path):
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=Loader)
+
+
+def validate_file(path):
+    """ Report entry of one metadata YAML """
+    result = {'metadata_yaml': path, 'valid': False}
+    try:
+        input_metadata = load_metadata(path)
+    except (OSError, yaml.YAMLError) as e:
+        result['errors'] = [{'location': '', 'message': 'Cannot read the metadata YAML: %s' % e}]
+        return result
+    result['errors'] = metadata_errors(input_metadata)
+    result['valid'] = not result['errors']
+    if result['valid']:
+        result.update({
+            'aliquot_id': input_metadata['aliquotId'],
+            'study': input_metadata['study'],
+            'input_format': input_metadata['readGroups'][0]['files'][0]['fileType'],
+            'number_of_lanes': len(input_metadata['readGroups']),
+            # a BAM listed under several read groups counts once
+            'input_bytes': sum(dict([(fi['fileName'], fi['fileSize']) for rg in input_metadata['readGroups']
+                                     for fi in rg['files']]).values())
+        })
+    return result
+
+
+def validate_files(paths, workers=None):
+    """ Validates the metadata YAMLs in worker processes, returns their report entries in order """
+    if len(paths) < 2 or workers == 1:
+        return [validate_file(p) for p in paths]
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(validate_file, paths, chunksize=max(1, min(64, len(paths) // (workers * 4)))))
+
+
+def bulk_main(argv):
+    parser = argparse.ArgumentParser(description='Validate many metadata YAMLs, reporting all the errors of each')
+    parser.add_argument('paths', nargs='+', help='metadata YAMLs, or directories searched for *.yaml / *.yml')
+    parser.add_argument('--workers', type=int, help='worker processes, one per core by default')
+    parser.add_argument('--report', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                paths.extend([os.path.join(root, f) for f in sorted(files) if f.endswith(('.yaml', '.yml'))])
+        else:
+            paths.append(path)
+
+    results = validate_files(paths, args.workers)
+    invalid = [r for r in results if not r['valid']]
+    report = json.dumps({'total': len(results), 'valid': len(results) - len(invalid), 'invalid': len(invalid),
+                         'files': results}, indent=2)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(report)
+        for r in invalid:
+            print('%s: %s' % (r['metadata_yaml'], '; '.join([e['message'].strip() for e in r['errors']])), file=sys.stderr)
+    else:
+        print(report)
+    return 1 if invalid else 0
 
-cwd = os.getcwd()
 
-# read the yaml file
-with open(task_dict['input'].get('metadata_yaml'), 'r') as f:
-    input_metadata=yaml.load(f)
+def main():
+    task_dict = json.loads(sys.argv[1])
 
-# metadata validate
-fields_to_check = ['study', 'donorSubmitterId', 'specimenSubmitterId', 'sampleSubmitterId', 'aliquotId', 'specimenType', 'libraryStrategy', 'useCntl', 'readGroups']
-for field_name in fields_to_check:
-    if field_name not in input_metadata.keys() or not input_metadata.get(field_name):
-        sys.exit('The metadata YAML must contain and specify field: %s' % field_name)
-    if field_name == 'useCntl':
-        if 'normal' not in input_metadata.get('specimenType').lower() and \
-                not re.match(r'^([a-f\d]{8}(-[a-f\d]{4}){3}-[a-f\d]{12})$', str(input_metadata['useCntl'])):
-            sys.exit('Must specify useCntl for Tumor in metadata YAML file as UUID')
-        elif 'normal' in input_metadata.get('specimenType').lower() and not input_metadata['useCntl'] == 'N/A':
-            sys.exit('Must specify useCntl for Normal in metadata YAML file as N/A')
-    if field_name == 'aliquotId' and not re.match(r'^([a-f\d]{8}(-[a-f\d]{4}){3}-[a-f\d]{12})$', str(input_metadata['aliquotId'])):
-        sys.exit('Must specify aliquotId in UUID format!')
+    cwd = os.getcwd()
 
-# readGroups fields validate
-rg_fields_to_check = ['readGroupId', 'sequencingPlatform', 'platformUnit', 'libraryName', 'files']
-# files fields validate
-file_fields_to_check = ['fileName', 'fileSize', 'readGroupIdInFile', 'fileMd5sum', 'path', 'fileType']
+    # read the yaml file
+    input_metadata = load_metadata(task_dict['input'].get('metadata_yaml'))
 
-for readGroup in input_metadata['readGroups']:
-    for rg_field in rg_fields_to_check:
-        if rg_field not in readGroup.keys() or not readGroup.get(rg_field):
-            sys.exit('The metadata YAML must contain readGroup field: %s' % rg_field)
-        elif rg_field == 'files':
-            for fileInfo in readGroup['files']:
-                for file_field in file_fields_to_check:
-                    if file_field not in fileInfo.keys() or not fileInfo.get(file_field):
-                        sys.exit('The metadata YAML must contain file field: %s' % file_field)
+    errors = metadata_errors(input_metadata)
+    if errors: sys.exit('\n'.join([e['message'] for e in errors]))
 
+    # detect the input format
+    input_format = set()
+    for rg in input_metadata['readGroups']:
+        for rg_file in rg['files']:
+            input_format.add(rg_file.get('fileType'))
 
-# detect the input format
-input_format = set()
-for rg in input_metadata['readGroups']:
-    for rg_file in rg['files']:
-        input_format.add(rg_file.get('fileType'))
+    # the inputs are BAM
+    input_format = input_format.pop()
 
-if not len(input_format) == 1: sys.exit('\nError: The input files should have the same format.')
+    output = {'input_format': input_format}
 
-# the inputs are BAM
-input_format = input_format.pop()
 
-output = {'input_format': input_format}
+    if input_format == 'BAM':
+        # reshape the metadata
+        metadata=reshape_metadata(input_metadata)
 
+    elif input_format == 'FASTQ':
+        metadata = input_metadata
 
-if input_format == 'BAM':
-    # reshape the metadata
-    metadata=reshape_metadata(input_metadata)
+    else:
+        sys.exit('\n%s: Input files format are not FASTQ or BAM')
 
-elif input_format == 'FASTQ':
-    metadata = input_metadata
 
-else:
-    sys.exit('\n%s: Input files format are not FASTQ or BAM')
+    aliquot_id = input_metadata['aliquotId']
+    number_of_lanes = len(input_metadata['readGroups'])
+    study = input_metadata['study']
 
+    aws_allowed_studies = { 'LIRI-JP', 'PACA-CA', 'PRAD-CA', 'RECA-EU', 'PAEN-AU',
+                            'PACA-AU', 'BOCA-UK','OV-AU', 'MELA-AU', 'BRCA-UK',
+                            'PRAD-UK', 'CMDI-UK', 'LINC-JP', 'ORCA-IN', 'BTCA-SG',
+                            'LAML-KR', 'LICA-FR', 'CLLE-ES', 'ESAD-UK', 'PAEN-IT' }
+    aws_upload_allowed = study in aws_allowed_studies
 
-aliquot_id = input_metadata['aliquotId']
-number_of_lanes = len(input_metadata['readGroups'])
-study = input_metadata['study']
+    cgc_allowed_studies = { 'LIRI-JP', 'PACA-CA', 'PRAD-CA', 'RECA-EU', 'PAEN-AU',
+                            'PACA-AU', 'BOCA-UK','OV-AU', 'MELA-AU', 'BRCA-UK',
+                            'PRAD-UK', 'CMDI-UK', 'LINC-JP', 'ORCA-IN', 'BTCA-SG',
+                            'LAML-KR', 'LICA-FR', 'CLLE-ES', 'ESAD-UK', 'PAEN-IT' }
 
-aws_allowed_studies = { 'LIRI-JP', 'PACA-CA', 'PRAD-CA', 'RECA-EU', 'PAEN-AU',
-                        'PACA-AU', 'BOCA-UK','OV-AU', 'MELA-AU', 'BRCA-UK',
-                        'PRAD-UK', 'CMDI-UK', 'LINC-JP', 'ORCA-IN', 'BTCA-SG',
-                        'LAML-KR', 'LICA-FR', 'CLLE-ES', 'ESAD-UK', 'PAEN-IT' }
-aws_upload_allowed = study in aws_allowed_studies
+    cgc_upload_allowed = study in cgc_allowed_studies \
+                         and task_dict['input'].get('cgc_project_name') is not None \
+                         and len(task_dict['input'].get('cgc_project_name')) > 0
 
-cgc_allowed_studies = { 'LIRI-JP', 'PACA-CA', 'PRAD-CA', 'RECA-EU', 'PAEN-AU',
-                        'PACA-AU', 'BOCA-UK','OV-AU', 'MELA-AU', 'BRCA-UK',
-                        'PRAD-UK', 'CMDI-UK', 'LINC-JP', 'ORCA-IN', 'BTCA-SG',
-                        'LAML-KR', 'LICA-FR', 'CLLE-ES', 'ESAD-UK', 'PAEN-IT' }
+    output.update({
+            'aliquot_id': aliquot_id,
+            'number_of_lanes': str(number_of_lanes),
+            'study': study,
+            'aws_upload_allowed': str(aws_upload_allowed),
+            'cgc_upload_allowed': str(cgc_upload_allowed),
+            'collab_upload_allowed': str(True)  # always true for collab
+        })
 
-cgc_upload_allowed = study in cgc_allowed_studies \
-                     and task_dict['input'].get('cgc_project_name') is not None \
-                     and len(task_dict['input'].get('cgc_project_name')) > 0
+    # write to the metadata json file
+    with open('metadata.json', 'w') as f:
+        f.write(json.dumps(metadata, indent=2))
 
-output.update({
-        'aliquot_id': aliquot_id,
-        'number_of_lanes': str(number_of_lanes),
-        'study': study,
-        'aws_upload_allowed': str(aws_upload_allowed),
-        'cgc_upload_allowed': str(cgc_upload_allowed),
-        'collab_upload_allowed': str(True)  # always true for collab
-    })
+    output['metadata_json'] = os.path.join(cwd, 'metadata.json')
 
-# write to the metadata json file
-with open('metadata.json', 'w') as f:
-    f.write(json.dumps(metadata, indent=2))
+    with open("output.json", "w") as o:
+        o.write(json.dumps(output))
 
-output['metadata_json'] = os.path.join(cwd, 'metadata.json')
 
-with open("output.json", "w") as o:
-    o.write(json.dumps(output))
+if __name__ == "__main__":
+    # the workflow passes the task JSON, anything else is a bulk validation
+    if len(sys.argv) > 1 and sys.argv[1].lstrip().startswith('{'):
+        main()
+    else:
+        sys.exit(bulk_main(sys.argv[1:]))